@@ -0,0 +1,308 @@
+"""
+Asyncio front-end for a database, which never blocks the event loop.
+
+Reads run in a pool of threads, each with its own read-only connection, so
+a slow disk stalls a worker instead of the loop. The gets made while the
+loop runs one step are looked up together, in a single descent of the tree,
+and concurrent gets of the same key share one read. Writes are kept in
+memory until committed; commits queue up for the one writer connection,
+which takes the file lock only while committing, and commits queued behind
+one another are written as one:
+
+    db = await async_db.connect("/tmp/test.dbdb")
+    await db.set("a", "1")
+    await db.commit()
+    await db.get("a")
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from red_black_tree.immutable_tree import WriteBuffer
+from red_black_tree.red_black_tree import connect as connect_file
+
+#returned by reads of keys that are not in the database
+MISSING = WriteBuffer.MISSING
+
+
+class AsyncDBDB(object):
+    """
+    Database connection whose reads and commits are awaited.
+    """
+
+    def __init__(self, dbname, readers=4, cache_size=1024, use_mmap=False,
+                 **options):
+        """
+        The constructor of the class takes for arguments the path of the database, and is called by connect
+
+        Parameters
+        ----------
+
+        dbname: path of the database
+        readers: number of threads reading the file, optional
+        cache_size: number of decoded nodes each connection keeps in memory, optional
+        use_mmap: whether reads go through a memory map of the file, optional
+        options: arguments of red_black_tree.connect for the writer connection, e.g. value_codec, optional
+
+        Attributes
+        ----------
+
+        self._pending: writes not committed yet, as a WriteBuffer
+        self._inflight: the WriteBuffers of commits queued or being written
+        self._batch: (key, future) pairs of the reads waiting for the next lookup
+        self._reading: future of each hashable key being read
+        """
+        if readers < 1:
+            raise ValueError('At least one reader thread is needed.')
+        self._dbname = dbname
+        self._cache_size = cache_size
+        self._use_mmap = use_mmap
+        self._options = options
+        self._loop = asyncio.get_running_loop()
+        self._readers = ThreadPoolExecutor(readers)
+        #one thread, so the writer connection is only used by it
+        self._writer = ThreadPoolExecutor(1)
+        self._writer_db = None
+        self._local = threading.local()
+        self._reader_dbs = []
+        self._reader_dbs_lock = threading.Lock()
+        self._pending = WriteBuffer()
+        self._inflight = []
+        self._batch = []
+        self._reading = {}
+        self._queue = asyncio.Queue()
+        self._writer_task = None
+        self._closed = False
+
+    async def _start(self):
+        "open the writer connection, creating the file, and start taking commits"
+        await self._loop.run_in_executor(self._writer, self._open_writer)
+        self._writer_task = self._loop.create_task(self._write_loop())
+
+    def _open_writer(self):
+        self._writer_db = connect_file(self._dbname, self._cache_size,
+                                       self._use_mmap, **self._options)
+
+    def _reader_db(self):
+        "return the read-only connection of the calling reader thread"
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = connect_file(self._dbname, self._cache_size, self._use_mmap,
+                              readonly=True)
+            self._local.db = db
+            with self._reader_dbs_lock:
+                self._reader_dbs.append(db)
+        return db
+
+    def _assert_not_closed(self):
+        if self._closed:
+            raise ValueError('Database closed.')
+
+    def _buffered(self, key):
+        "return the uncommitted value of key, DELETED, or MISSING if it was not written"
+        for buffer in [self._pending] + self._inflight[::-1]:
+            value = buffer.lookup(key)
+            if value is not WriteBuffer.MISSING:
+                return value
+        return MISSING
+
+    def _read(self, key):
+        """
+        Method that returns a future of the committed value of key, MISSING if it is absent.
+
+        Parameter
+        ---------
+
+        key: a lookup value
+
+        Notes
+        -----
+
+        The key joins the batch looked up once the loop has run the callers
+        ready now, unless a read of the same key is already on its way.
+
+        """
+        try:
+            future = self._reading.get(key)
+        except TypeError:
+            #keys need only be orderable; unhashable ones are not shared
+            future = None
+            hashable = False
+        else:
+            hashable = True
+        if future is not None:
+            return future
+        future = self._loop.create_future()
+        if hashable:
+            self._reading[key] = future
+        if not self._batch:
+            self._loop.call_soon(self._flush_reads)
+        self._batch.append((key, future))
+        return future
+
+    def _flush_reads(self):
+        "send the batched reads to a reader thread"
+        batch, self._batch = self._batch, []
+        done = self._loop.run_in_executor(
+            self._readers, self._read_many, [key for key, _ in batch])
+        done.add_done_callback(lambda done: self._resolve(batch, done))
+
+    def _read_many(self, keys):
+        #one descent of the tree for the whole batch
+        return self._reader_db().get_many(keys, MISSING)
+
+    def _resolve(self, batch, done):
+        "hand the values of a batch, or its error, to the readers waiting for them"
+        error = done.exception()
+        values = [None] * len(batch) if error else done.result()
+        for (key, future), value in zip(batch, values):
+            try:
+                if self._reading.get(key) is future:
+                    del self._reading[key]
+            except TypeError:
+                pass
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(value)
+
+    async def _get(self, key, default):
+        value = self._buffered(key)
+        if value is MISSING:
+            #shielded, so a caller giving up does not cancel a shared read
+            value = await asyncio.shield(self._read(key))
+        if value is MISSING or value is WriteBuffer.DELETED:
+            return default
+        return value
+
+    async def get(self, key):
+        self._assert_not_closed()
+        value = await self._get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    async def get_many(self, keys, default=None):
+        self._assert_not_closed()
+        return list(await asyncio.gather(
+            *[self._get(key, default) for key in keys]))
+
+    async def contains(self, key):
+        self._assert_not_closed()
+        return await self._get(key, MISSING) is not MISSING
+
+    async def set(self, key, value):
+        self._assert_not_closed()
+        self._pending.put(key, value)
+
+    async def set_many(self, pairs):
+        self._assert_not_closed()
+        for key, value in pairs:
+            self._pending.put(key, value)
+
+    async def delete(self, key):
+        #raises KeyError for missing keys, as the tree does
+        await self.get(key)
+        self._pending.put(key, WriteBuffer.DELETED)
+
+    async def commit(self):
+        """
+        Method that writes the writes made so far and waits until they are committed.
+
+        Notes
+        -----
+
+        The writes stay readable while the commit is queued. If it fails
+        they are dropped and the error is raised here.
+
+        """
+        self._assert_not_closed()
+        buffer, self._pending = self._pending, WriteBuffer()
+        self._inflight.append(buffer)
+        future = self._loop.create_future()
+        await self._queue.put((buffer, future))
+        await asyncio.shield(future)
+
+    async def _write_loop(self):
+        "write the queued commits, those queued together in one commit"
+        while True:
+            queued = [await self._queue.get()]
+            while not self._queue.empty():
+                queued.append(self._queue.get_nowait())
+            closing = queued[-1] is None
+            queued = [item for item in queued if item is not None]
+            if queued:
+                merged = WriteBuffer()
+                for buffer, _ in queued:
+                    for key, value in buffer.range():
+                        merged.put(key, value)
+                try:
+                    await self._loop.run_in_executor(
+                        self._writer, self._write, merged)
+                except Exception as error:
+                    result = error
+                else:
+                    result = None
+                for buffer, future in queued:
+                    self._inflight.remove(buffer)
+                    if result is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(result)
+                #later gets must not share reads started before the commit
+                self._reading.clear()
+            if closing:
+                return
+
+    def _write(self, buffer):
+        "apply the writes of a buffer to the writer connection and commit them"
+        db = self._writer_db
+        pairs, deleted = buffer.drain()
+        try:
+            if pairs:
+                db.set_many(pairs)
+            for key in deleted:
+                try:
+                    db.delete(key)
+                except KeyError:
+                    #deleted meanwhile by another connection
+                    pass
+            db.commit()
+        except BaseException:
+            #nothing of a failed commit may reach the next one
+            db.close()
+            self._open_writer()
+            raise
+
+    async def close(self):
+        "wait for the queued commits, then close every connection; uncommitted writes are dropped"
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer_task is not None:
+            await self._queue.put(None)
+            await self._writer_task
+        await self._loop.run_in_executor(None, self._shutdown)
+
+    def _shutdown(self):
+        self._readers.shutdown()
+        for db in self._reader_dbs:
+            db.close()
+        self._writer.shutdown()
+        if self._writer_db is not None:
+            self._writer_db.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def connect(dbname, readers=4, cache_size=1024, use_mmap=False,
+                  **options):
+    db = AsyncDBDB(dbname, readers, cache_size, use_mmap, **options)
+    await db._start()
+    return db
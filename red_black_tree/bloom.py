@@ -0,0 +1,190 @@
+"""
+Bloom filters over database keys.
+
+A Bloom filter answers whether a key may be in a set, with no false
+negatives and a chosen rate of false positives, from a few bits per key:
+
+    bloom = BloomFilter.for_capacity(len(keys))
+    for key in keys:
+        bloom.add(key)
+    key in bloom
+
+Keys are hashed from a stable encoding, not from hash(), so a filter saved
+with to_bytes is valid in any process.
+"""
+import hashlib
+import math
+import numbers
+import pickle
+import struct
+
+#the bit array is tracked for rewriting in pages of this many bytes
+PAGE_SIZE = 4096
+
+
+def key_bytes(key):
+    """
+    Function that returns the bytes a key is hashed from.
+
+    Parameter
+    ---------
+
+    key: a database key
+
+    Notes
+    -----
+
+    Keys that compare equal, such as 1, 1.0, True and NumPy's int64(1), get
+    the same bytes, as the tree would find one with the other.
+
+    """
+    if type(key) is int:
+        #the common case, without the slower checks against the number types
+        return b'i' + str(key).encode('ascii')
+    if isinstance(key, numbers.Real) and not isinstance(key, numbers.Integral):
+        key = float(key)
+        if not key.is_integer():
+            return b'f' + struct.pack("!d", key)
+    if isinstance(key, numbers.Real):
+        return b'i' + str(int(key)).encode('ascii')
+    if isinstance(key, str):
+        return b's' + key.encode('utf-8')
+    if isinstance(key, bytes):
+        return b'b' + key
+    return b'p' + pickle.dumps(key)
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of a fixed number of bits, set by a fixed number of hashes per key.
+    """
+    #number of bits, number of hashes, keys sized for, keys added
+    HEADER = struct.Struct("!QBQQ")
+
+    def __init__(self, bits, hashes, data=None, capacity=0, count=0):
+        """
+        The constructor of the class takes for arguments the size of the filter
+
+        Parameters
+        ----------
+
+        bits: number of bits of the filter
+        hashes: number of bits set for each key
+        data: the bit array of a saved filter, optional
+        capacity: number of keys the filter was sized for, optional
+        count: number of keys added so far, optional
+
+        Attributes
+        ----------
+
+        self.dirty: the pages of PAGE_SIZE bytes of the bit array changed since dirty was last cleared
+        """
+        if bits < 1 or hashes < 1:
+            raise ValueError('A filter needs bits and hashes.')
+        self.bits = bits
+        self.hashes = hashes
+        self.capacity = capacity
+        self.count = count
+        self.dirty = set()
+        self._data = bytearray((bits + 7) // 8) if data is None \
+            else bytearray(data)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        """
+        Method that returns an empty filter sized for a number of keys and false positive rate.
+
+        Parameters
+        ----------
+
+        capacity: number of keys the filter is meant to hold
+        error_rate: wanted rate of false positives at capacity, optional
+
+        """
+        capacity = max(capacity, 1)
+        bits = max(int(math.ceil(-capacity * math.log(error_rate) /
+                                 math.log(2) ** 2)), 8)
+        hashes = max(int(round(bits / capacity * math.log(2))), 1)
+        return cls(bits, min(hashes, 255), capacity=capacity)
+
+    @staticmethod
+    def hash_key(key):
+        """
+        Method that returns the two hashes the bits of a key are derived from.
+
+        Parameter
+        ---------
+
+        key: a database key
+
+        Notes
+        -----
+
+        The hashes do not depend on the size of the filter, so a key tested
+        against several filters is hashed once, with contains_hash.
+
+        """
+        digest = hashlib.blake2b(key_bytes(key), digest_size=16).digest()
+        return struct.unpack("!QQ", digest)
+
+    def _positions(self, hashes):
+        "return the bits of a key, by double hashing"
+        first, second = hashes
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        """
+        Method that adds a key to the filter
+
+        Parameter
+        ---------
+
+        key: a database key
+
+        """
+        data = self._data
+        for position in self._positions(self.hash_key(key)):
+            data[position >> 3] |= 1 << (position & 7)
+            self.dirty.add((position >> 3) // PAGE_SIZE)
+        self.count += 1
+
+    def __contains__(self, key):
+        return self.contains_hash(self.hash_key(key))
+
+    def contains_hash(self, hashes):
+        "return whether the key of hashes, from hash_key, may be in the filter"
+        data = self._data
+        return all(data[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(hashes))
+
+    def header(self):
+        "return the header of to_bytes, which holds the number of keys added"
+        return self.HEADER.pack(self.bits, self.hashes, self.capacity,
+                                self.count)
+
+    def page(self, index):
+        "return one page of the bit array, as written at index * PAGE_SIZE after the header"
+        return bytes(self._data[index * PAGE_SIZE:(index + 1) * PAGE_SIZE])
+
+    @classmethod
+    def data_size(cls, header):
+        "return the length of the bit array following a header"
+        return (cls.HEADER.unpack_from(header)[0] + 7) // 8
+
+    def to_bytes(self):
+        "return the filter as bytes, to be read back with from_bytes"
+        return self.header() + bytes(self._data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Method that reads back a filter saved with to_bytes.
+
+        Parameter
+        ---------
+
+        data: the saved filter
+
+        """
+        bits, hashes, capacity, count = cls.HEADER.unpack_from(data)
+        return cls(bits, hashes, data[cls.HEADER.size:], capacity, count)
@@ -0,0 +1,887 @@
+"""
+B+tree engine: a tree of wide pages behind the same interface as the red-black tree.
+
+Keys and values are kept in leaf pages of up to ORDER entries, and internal
+pages hold up to ORDER children with the keys separating them and the number
+of keys under each child, so a lookup among 10^8 keys reads 4 or 5 pages
+instead of about 27 nodes. Like red-black nodes, pages are never changed once
+written: a change copies the pages on its path from the root, and a commit
+writes them, children before parents, and then the new root address. Each
+page is a single record kept within one 4 KiB page of the file.
+
+The engine is chosen when a file is created and recorded in its superblock:
+
+    db = connect("/tmp/test.dbdb", engine='btree')
+"""
+import bisect
+import struct
+
+from red_black_tree.immutable_tree import BinaryTree, ValueRef
+from red_black_tree.red_black_tree import RedBlackNodeRef
+
+PAGE_SIZE = 4096
+
+
+class BTreePage(object):
+    """
+    A page of the tree: the keys and value references of a leaf, or the separating keys and child references of an internal page.
+
+    Child i of an internal page holds the keys k with keys[i - 1] <= k < keys[i].
+    """
+    __slots__ = ('keys', 'children', 'leaf', 'size')
+
+    def __init__(self, keys, children, leaf):
+        """
+        The constructor of the class takes for arguments the keys and children of the page
+
+        Parameters
+        ----------
+
+        keys: sorted keys of a leaf, or the len(children) - 1 separating keys of an internal page
+        children: ValueRefs of the keys of a leaf, or PageRefs of the subtrees of an internal page
+        leaf: whether the page is a leaf
+
+        Attributes
+        ----------
+
+        self.size: number of keys in the subtree of the page
+        """
+        self.keys = keys
+        self.children = children
+        self.leaf = leaf
+        self.size = (len(keys) if leaf
+                     else sum(child.size for child in children))
+
+    def store_refs(self, storage):
+        """
+        Method that stores the values or child pages of the page
+
+        Parameter
+        ---------
+
+        storage: the storage the page is written to
+
+        """
+        for child in self.children:
+            if self.leaf:
+                child.store(storage, storage.inline_threshold)
+            else:
+                child.store(storage)
+
+
+class PageRef(ValueRef):
+    """
+    This class produces a reference to a B+tree page on the disk.
+
+    A page is written as a version byte, a kind byte and the number of
+    entries. A leaf entry is a typed, length-prefixed key followed by the
+    address of its value, or by the value itself when it encodes to fewer
+    bytes than the storage's inline threshold. An internal page lists the
+    address and subtree size of each child, then the separating keys.
+    """
+    cacheable = True
+    __slots__ = ('_size',)
+    PAGE_VERSION = 1
+    LEAF = 0
+    INTERNAL = 1
+    #version, kind, number of entries
+    HEADER = struct.Struct("!BBH")
+    #key type, key length, value address, inline value length
+    LEAF_ENTRY = struct.Struct("!BIQI")
+    #address, size
+    CHILD = struct.Struct("!QQ")
+    #key type, key length
+    KEY = struct.Struct("!BI")
+
+    def __init__(self, referent=None, address=0, size=None):
+        """
+        The constructor of the class takes for arguments a referent and address
+
+        Parameters
+        ----------
+
+        referent: the page, optional
+        address: address of the stored page, optional
+        size: number of keys in the subtree at address, if known, optional
+        """
+        ValueRef.__init__(self, referent, address)
+        self._size = size
+
+    @property
+    def size(self):
+        """
+        Method that returns the number of keys in the referenced subtree.
+
+        """
+        if self._referent is not None:
+            return self._referent.size
+        if not self._address:
+            return 0
+        return self._size
+
+    def prepare_to_store(self, storage):
+        """
+        Method that stores the values and child pages of the page
+
+        Parameter
+        ---------
+
+        storage: the storage the page is written to
+
+        """
+        if self._referent:
+            self._referent.store_refs(storage)
+
+    def store(self, storage):
+        """
+        Method that stores the page, after its values and child pages, to the disk.
+
+        Parameter
+        ---------
+
+        storage: the storage the page is written to
+
+        """
+        if self._referent is not None and not self._address:
+            self.prepare_to_store(storage)
+            data = self.referent_to_bytes(self._referent, storage)
+            if not storage.compression:
+                #compressed records are not page sized, so only plain
+                #pages are moved to a fresh disk page when they would
+                #straddle one
+                storage.align(storage.INTEGER_LENGTH + len(data), PAGE_SIZE)
+            self._address = storage.write(data)
+
+    @classmethod
+    def referent_to_bytes(cls, referent, storage=None):
+        """
+        Method that converts a page whose values and children are stored to bytes
+
+        Parameters
+        ----------
+
+        referent: the page
+        storage: the storage the bytes are written to, optional
+
+        """
+        if referent.leaf:
+            chunks = [cls.HEADER.pack(cls.PAGE_VERSION, cls.LEAF,
+                                      len(referent.keys))]
+            for key, value_ref in zip(referent.keys, referent.children):
+                key_type, key = RedBlackNodeRef.key_to_bytes(key)
+                value = value_ref.inline
+                if value is None:
+                    value = b''
+                chunks.append(cls.LEAF_ENTRY.pack(
+                    key_type, len(key), value_ref.address, len(value)))
+                chunks.append(key)
+                chunks.append(value)
+            return b''.join(chunks)
+        chunks = [cls.HEADER.pack(cls.PAGE_VERSION, cls.INTERNAL,
+                                  len(referent.children))]
+        for child in referent.children:
+            chunks.append(cls.CHILD.pack(child.address, child.size))
+        for key in referent.keys:
+            key_type, key = RedBlackNodeRef.key_to_bytes(key)
+            chunks.append(cls.KEY.pack(key_type, len(key)))
+            chunks.append(key)
+        return b''.join(chunks)
+
+    @classmethod
+    def bytes_to_referent(cls, string, storage=None):
+        """
+        Method that decodes a stored page
+
+        Parameters
+        ----------
+
+        string: the encoded page
+        storage: the storage the bytes were read from, optional
+
+        """
+        version, kind, count = cls.HEADER.unpack_from(string)
+        if version != cls.PAGE_VERSION:
+            raise ValueError('Unknown page version %d.' % version)
+        offset = cls.HEADER.size
+        keys = []
+        children = []
+        if kind == cls.LEAF:
+            for _ in range(count):
+                key_type, key_length, address, value_length = \
+                    cls.LEAF_ENTRY.unpack_from(string, offset)
+                offset += cls.LEAF_ENTRY.size
+                keys.append(RedBlackNodeRef.bytes_to_key(
+                    key_type, string[offset:offset + key_length]))
+                offset += key_length
+                if address:
+                    children.append(ValueRef(address=address))
+                else:
+                    #the value is decoded from these bytes only when asked for
+                    children.append(ValueRef(
+                        inline=string[offset:offset + value_length]))
+                offset += value_length
+            return BTreePage(keys, children, True)
+        for _ in range(count):
+            address, size = cls.CHILD.unpack_from(string, offset)
+            offset += cls.CHILD.size
+            children.append(PageRef(address=address, size=size))
+        for _ in range(count - 1):
+            key_type, key_length = cls.KEY.unpack_from(string, offset)
+            offset += cls.KEY.size
+            keys.append(RedBlackNodeRef.bytes_to_key(
+                key_type, string[offset:offset + key_length]))
+            offset += key_length
+        return BTreePage(keys, children, False)
+
+
+class BTree(BinaryTree):
+    """
+    Immutable B+tree. Constructs new pages on changes.
+    """
+    #largest number of entries of a page
+    ORDER = 64
+
+    def __init__(self, storage, cache_size=1024, order=ORDER,
+                 root_address=None):
+        """
+        The constructor of the class takes for arguments a storage reference
+
+        Parameters
+        ----------
+
+        storage: storage reference address, compulsory
+        cache_size: number of decoded pages kept in memory, 0 disables the cache, optional
+        order: largest number of entries of a page written by this tree, optional
+        root_address: root the tree is pinned to instead of following commits, optional
+
+        """
+        if order < 4:
+            raise ValueError('Pages must hold at least 4 entries.')
+        self.order = order
+        self._root_address = root_address
+        self._tree_ref = None
+        BinaryTree.__init__(self, storage, cache_size)
+
+    def _refresh_tree_ref(self):
+        """
+        Method to get reference to new tree if it has changed
+
+        """
+        if self._root_address is not None:
+            #a pinned tree never leaves its root, nor reads the superblock
+            address = self._root_address
+        else:
+            address = self._storage.get_root_address()
+        if (self._tree_ref is not None and address
+                and self._tree_ref.address == address):
+            #nothing was committed since, so keep the decoded root
+            return
+        self._tree_ref = PageRef(address=address)
+
+    def pin(self):
+        """
+        Method that makes reads use the current committed root until unpin is called
+
+        """
+        if self._storage.locked:
+            raise ValueError('Commit changes before pinning the root.')
+        self._root_address = None
+        self._refresh_tree_ref()
+        self._root_address = self._tree_ref.address
+
+    def unpin(self):
+        """
+        Method that makes reads follow new commits again
+
+        """
+        self._root_address = None
+
+    def rootkey(self):
+        """
+        Method that collects the first key of the tree's root page.
+
+        """
+        root = self._follow(self._tree_ref)
+        if root is None or not root.keys:
+            return None
+        return root.keys[0]
+
+    def _leaf_index(self, page, key):
+        "return the position of key in a leaf, or None if it is not there"
+        i = bisect.bisect_left(page.keys, key)
+        if i < len(page.keys) and not key < page.keys[i]:
+            return i
+        return None
+
+    def get(self, key):
+        """
+        Method that obtains the value stored for a given key
+
+        Parameter
+        ---------
+
+        key: a lookup value that will throw a KeyError if it doesn't exist in the tree
+
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        page = self._follow(self._tree_ref)
+        if page is None:
+            raise KeyError
+        while not page.leaf:
+            page = self._follow(
+                page.children[bisect.bisect_right(page.keys, key)])
+        i = self._leaf_index(page, key)
+        if i is None:
+            raise KeyError
+        return self._follow(page.children[i])
+
+    def get_many(self, keys, default=None, strict=False):
+        """
+        Method that looks up many keys in a single descent of the tree.
+
+        Parameters
+        ----------
+
+        keys: sequence of keys, or a NumPy array of keys
+        default: value returned for keys that are not in the tree, optional
+        strict: throw a KeyError for the first missing key instead of returning default, optional
+
+        Notes
+        -----
+
+        The sorted keys are split between the children of each page on the
+        way down, so every page is read at most once for the whole batch.
+        Returns a list of the values in the order of keys.
+
+        """
+        keys, order, sorted_keys = self._sort_batch(keys)
+        values = [default] * len(order)
+        missing = []
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        stack = [(self._tree_ref, 0, len(order))]
+        while stack:
+            ref, lo, hi = stack.pop()
+            if lo == hi:
+                continue
+            page = self._follow(ref)
+            if page is None:
+                missing.extend(range(lo, hi))
+            elif page.leaf:
+                previous = value = None
+                for position in range(lo, hi):
+                    i = self._leaf_index(page, sorted_keys[position])
+                    if i is None:
+                        missing.append(position)
+                        continue
+                    if i != previous:
+                        #a repeated key reuses the value just read
+                        previous, value = i, self._follow(page.children[i])
+                    values[order[position]] = value
+            else:
+                start = lo
+                for i, separator in enumerate(page.keys):
+                    end = bisect.bisect_left(sorted_keys, separator, start, hi)
+                    stack.append((page.children[i], start, end))
+                    start = end
+                stack.append((page.children[-1], start, hi))
+        if strict and missing:
+            raise KeyError(keys[min(order[i] for i in missing)])
+        return values
+
+    def _split(self, keys, children, leaf):
+        """
+        Method that cuts the entries of an overfull page in two pages.
+
+        Notes
+        -----
+
+        Returns the left page, the key separating the pages and the right page.
+
+        """
+        middle = len(children) // 2
+        if leaf:
+            return (BTreePage(keys[:middle], children[:middle], True),
+                    keys[middle],
+                    BTreePage(keys[middle:], children[middle:], True))
+        return (BTreePage(keys[:middle - 1], children[:middle], False),
+                keys[middle - 1],
+                BTreePage(keys[middle:], children[middle:], False))
+
+    def set(self, key, value):
+        """
+        Method that sets a new value in the tree. Since the tree is immutable, new pages are created.
+
+        Parameters
+        ----------
+
+        key: a lookup value
+        value: the value that will be stored for the key
+
+        """
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        self._set(key, ValueRef(value))
+
+    def _set(self, key, value_ref):
+        "insert or replace a key on the locked tree, splitting the root if it overflows"
+        root = self._follow(self._tree_ref)
+        if root is None:
+            self._tree_ref = PageRef(BTreePage([key], [value_ref], True))
+            return
+        page, separator, right = self._insert(root, key, value_ref)
+        if right is not None:
+            #the tree grows a level at the root only
+            page = BTreePage([separator], [PageRef(page), PageRef(right)],
+                             False)
+        self._tree_ref = PageRef(page)
+
+    def _insert(self, page, key, value_ref):
+        """
+        Method that inserts a key under a page, creating a new path of pages.
+
+        Parameters
+        ----------
+
+        page: the page under which the key goes
+        key: a lookup value
+        value_ref: the reference to the value of the key
+
+        Notes
+        -----
+
+        Returns the new page and, when it had to be split, the separating key
+        and the new right page, else None twice.
+
+        """
+        keys = list(page.keys)
+        children = list(page.children)
+        if page.leaf:
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and not key < keys[i]:
+                children[i] = value_ref
+                return BTreePage(keys, children, True), None, None
+            keys.insert(i, key)
+            children.insert(i, value_ref)
+        else:
+            i = bisect.bisect_right(keys, key)
+            child, separator, right = self._insert(
+                self._follow(children[i]), key, value_ref)
+            children[i] = PageRef(child)
+            if right is not None:
+                keys.insert(i, separator)
+                children.insert(i + 1, PageRef(right))
+        if len(children) > self.order:
+            return self._split(keys, children, page.leaf)
+        return BTreePage(keys, children, page.leaf), None, None
+
+    def set_many(self, pairs):
+        """
+        Method that sets many values in the tree. Since the tree is immutable, new pages are created.
+
+        Parameter
+        ---------
+
+        pairs: iterable of (key, value) pairs; for a repeated key the last value wins
+
+        """
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        #in key order, consecutive inserts copy the same path of pages,
+        #so the copies left behind are never written
+        for key, value in sorted(pairs, key=lambda pair: pair[0]):
+            self._set(key, ValueRef(value))
+
+    def delete(self, key):
+        """
+        Method that deletes a key. Since the tree is immutable, new pages are created.
+
+        Parameter
+        ---------
+
+        key: a lookup value that will throw a KeyError if it doesn't exist in the tree
+
+        """
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        root = self._follow(self._tree_ref)
+        if root is None:
+            raise KeyError
+        root = self._remove(root, key)
+        #the tree shrinks a level when the root is left with one child
+        while not root.leaf and len(root.children) == 1:
+            root = self._follow(root.children[0])
+        self._tree_ref = PageRef(root) if root.size else PageRef()
+
+    def _remove(self, page, key):
+        """
+        Method that removes a key under a page, returning the new page, which may be underfull.
+
+        Notes
+        -----
+
+        A child left with fewer than order // 2 entries is merged with a
+        neighbour, and the pair is split again evenly if it overflows.
+
+        """
+        keys = list(page.keys)
+        children = list(page.children)
+        if page.leaf:
+            i = self._leaf_index(page, key)
+            if i is None:
+                raise KeyError
+            del keys[i], children[i]
+            return BTreePage(keys, children, True)
+        i = bisect.bisect_right(keys, key)
+        child = self._remove(self._follow(children[i]), key)
+        if len(child.children) >= self.order // 2 or len(children) == 1:
+            children[i] = PageRef(child)
+            return BTreePage(keys, children, False)
+        #merge with the right neighbour, or the left one for the last child
+        j = i if i + 1 < len(children) else i - 1
+        left = child if j == i else self._follow(children[j])
+        right = self._follow(children[j + 1]) if j == i else child
+        if left.leaf:
+            merged_keys = left.keys + right.keys
+        else:
+            merged_keys = left.keys + [keys[j]] + right.keys
+        merged_children = left.children + right.children
+        if len(merged_children) > self.order:
+            left, separator, right = self._split(merged_keys, merged_children,
+                                                 left.leaf)
+            keys[j] = separator
+            children[j:j + 2] = [PageRef(left), PageRef(right)]
+        else:
+            del keys[j]
+            children[j:j + 2] = [PageRef(BTreePage(
+                merged_keys, merged_children, left.leaf))]
+        return BTreePage(keys, children, False)
+
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Method that lazily yields the (key, value) pairs with lo <= key < hi in key order.
+
+        Parameters
+        ----------
+
+        lo: smallest key to yield, None for no lower bound, optional
+        hi: key at which to stop, excluded, None for no upper bound, optional
+        reverse: yield the pairs in descending key order, optional
+
+        Notes
+        -----
+
+        Leaves hold no links to their neighbours, since a copy-on-write
+        change to one leaf would then have to copy every leaf before it.
+        The scan keeps instead the stack of pages above the current leaf,
+        so memory stays proportional to the height of the tree. The root is
+        read once, so the scan sees the tree as it was when started.
+
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        return ((key, self._follow(value_ref))
+                for key, value_ref in self._walk(self._tree_ref, lo, hi,
+                                                 reverse))
+
+    def items(self):
+        """
+        Method that lazily yields every (key, value) pair in key order.
+
+        """
+        return self.range()
+
+    def keys(self):
+        """
+        Method that lazily yields every key in order, without reading the values.
+
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        return (key for key, _ in self._walk(self._tree_ref))
+
+    def _walk(self, tree_ref, lo=None, hi=None, reverse=False):
+        """
+        Method that lazily yields the (key, value_ref) pairs with lo <= key < hi of a tree in key order.
+
+        """
+        root = self._follow(tree_ref)
+        if root is None:
+            return
+        #each entry is a page and the positions of it still to be visited
+        stack = [(root, self._span(root, lo, hi, reverse))]
+        while stack:
+            page, positions = stack[-1]
+            i = next(positions, None)
+            if i is None:
+                stack.pop()
+            elif page.leaf:
+                yield page.keys[i], page.children[i]
+            else:
+                child = self._follow(page.children[i])
+                stack.append((child, self._span(child, lo, hi, reverse)))
+
+    @staticmethod
+    def _span(page, lo, hi, reverse):
+        "return an iterator over the positions of a page that may hold keys in [lo, hi)"
+        if page.leaf:
+            start = 0 if lo is None else bisect.bisect_left(page.keys, lo)
+            end = (len(page.keys) if hi is None
+                   else bisect.bisect_left(page.keys, hi))
+        else:
+            start = 0 if lo is None else bisect.bisect_right(page.keys, lo)
+            end = (len(page.children) if hi is None
+                   else bisect.bisect_left(page.keys, hi) + 1)
+        positions = range(start, end)
+        return iter(reversed(positions) if reverse else positions)
+
+    def __len__(self):
+        """
+        Method that returns the number of keys in the tree.
+
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        return self._size(self._tree_ref)
+
+    def _size(self, ref):
+        "return the number of keys under a reference, reading the page only for a root"
+        size = ref.size
+        if size is None:
+            size = self._follow(ref).size
+        return size
+
+    def rank(self, key):
+        """
+        Method that returns the number of keys smaller than a key, whether or not the key is present.
+
+        Parameter
+        ---------
+
+        key: a lookup value
+
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        rank = 0
+        page = self._follow(self._tree_ref)
+        if page is None:
+            return 0
+        while not page.leaf:
+            i = bisect.bisect_right(page.keys, key)
+            rank += sum(child.size for child in page.children[:i])
+            page = self._follow(page.children[i])
+        return rank + bisect.bisect_left(page.keys, key)
+
+    def select(self, index):
+        """
+        Method that returns the key at a position in key order, counting from 0.
+
+        Parameter
+        ---------
+
+        index: position of the key, negative values count from the end; an IndexError is thrown if it is out of range
+
+        """
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('Index out of range.')
+        page = self._follow(self._tree_ref)
+        while not page.leaf:
+            for child in page.children:
+                if index < child.size:
+                    break
+                index -= child.size
+            page = self._follow(child)
+        return page.keys[index]
+
+    def count(self, lo=None, hi=None):
+        """
+        Method that returns the number of keys with lo <= key < hi.
+
+        Parameters
+        ----------
+
+        lo: smallest key counted, None for no lower bound, optional
+        hi: key at which to stop counting, excluded, None for no upper bound, optional
+
+        """
+        upper = len(self) if hi is None else self.rank(hi)
+        lower = 0 if lo is None else self.rank(lo)
+        return max(upper - lower, 0)
+
+    def load_sorted(self, pairs, count=None):
+        """
+        Method that fills an empty tree from pairs sorted by key, writing pages as they are filled.
+
+        Parameters
+        ----------
+
+        pairs: iterable of (key, value) pairs with strictly increasing keys
+        count: ignored, pages are filled whatever the number of pairs, optional
+
+        Notes
+        -----
+
+        Pages are filled from the left, one open page per level, and each is
+        written as soon as it is full, so only O(log n) pages are held in
+        memory. Returns the number of pairs loaded.
+
+        """
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        if self._follow(self._tree_ref) is not None:
+            raise ValueError('The tree is not empty.')
+        self._tree_ref, count = self._build_stream(self._stored_pairs(pairs))
+        self.commit()
+        return count
+
+    def _build_stream(self, stream):
+        """
+        Method that builds and writes a tree from a stream of (key, value_ref) pairs in key order.
+
+        Notes
+        -----
+
+        Returns a reference to the root and the number of pairs.
+
+        """
+        #the entries of the open page of each level, as (smallest key, ref)
+        levels = []
+        count = 0
+        for key, value_ref in stream:
+            self._add_entry(levels, 0, key, value_ref)
+            count += 1
+        level = 0
+        while level < len(levels):
+            entries = levels[level]
+            if level > 0 and level == len(levels) - 1 and len(entries) == 1:
+                return entries[0][1], count
+            if entries:
+                levels[level] = []
+                self._add_entry(levels, level + 1, entries[0][0],
+                                self._write_page(entries, level == 0))
+            level += 1
+        return PageRef(), count
+
+    def _add_entry(self, levels, level, key, ref):
+        "add an entry to the open page of a level, writing the page once full"
+        if level == len(levels):
+            levels.append([])
+        entries = levels[level]
+        entries.append((key, ref))
+        if len(entries) == self.order:
+            levels[level] = []
+            self._add_entry(levels, level + 1, entries[0][0],
+                            self._write_page(entries, level == 0))
+
+    def _write_page(self, entries, leaf):
+        "write a page of (smallest key, ref) entries, returning an address-only reference"
+        keys = [key for key, _ in entries]
+        page_ref = PageRef(BTreePage(keys if leaf else keys[1:],
+                                     [ref for _, ref in entries], leaf))
+        page_ref.store(self._storage)
+        #keep only the address so that written pages can be freed
+        return PageRef(address=page_ref.address, size=page_ref.size)
+
+    def lock_for_writing(self):
+        """
+        Method that takes the writer lock, loading the latest committed root unless it was held already.
+
+        """
+        if self._storage.lock():
+            self._refresh_tree_ref()
+
+    def copy_to(self, storage, layout=None):
+        """
+        Method that writes the reachable part of the tree to another storage and commits it there.
+
+        Parameters
+        ----------
+
+        storage: an empty storage receiving the copy
+        layout: must be None, layouts only apply to red-black trees, optional
+
+        Notes
+        -----
+
+        Keys are streamed in order into full pages. Value records are copied
+        as raw bytes without being decoded. Returns the number of keys copied.
+
+        """
+        if layout is not None:
+            raise ValueError('Layouts only apply to red-black trees.')
+        target = BTree(storage, cache_size=0, order=self.order)
+        if target._follow(target._tree_ref) is not None:
+            raise ValueError('The target storage is not empty.')
+        stream = ((key, self._copy_value(value_ref, storage))
+                  for key, value_ref in self._walk(self._tree_ref))
+        target._tree_ref, count = target._build_stream(stream)
+        target.commit()
+        return count
+
+    def sample_values(self, samples):
+        """
+        Method that returns the stored bytes of about samples values spread evenly over the keys.
+
+        Parameter
+        ---------
+
+        samples: number of values wanted
+
+        """
+        step = max(self._size(self._tree_ref) // max(samples, 1), 1)
+        return [self._value_bytes(value_ref)
+                for i, (_, value_ref) in enumerate(self._walk(self._tree_ref))
+                if i % step == 0][:samples]
+
+    def validate(self):
+        """
+        Method that checks the B+tree invariants of the whole tree.
+
+        Notes
+        -----
+
+        Raises ValueError when the keys are out of order or outside the range
+        of their parent's separators, a page has too many entries, the leaves
+        are not all at the same depth or a stored subtree size is wrong.
+        Otherwise returns the number of keys and the height.
+
+        """
+        root = self._follow(self._tree_ref)
+        if root is None:
+            return 0, 0
+        return self._validate(root, None, None)
+
+    def _validate(self, page, lo, hi):
+        "check the subtree of a page whose keys must lie in [lo, hi)"
+        for first, second in zip(page.keys, page.keys[1:]):
+            if not first < second:
+                raise ValueError('Keys out of order at %r.' % (second,))
+        if page.keys and ((lo is not None and page.keys[0] < lo) or
+                          (hi is not None and not page.keys[-1] < hi)):
+            raise ValueError('Key out of range at %r.' % (page.keys[0],))
+        if len(page.children) > self.order:
+            raise ValueError('Page with %d entries.' % len(page.children))
+        if page.leaf:
+            if len(page.keys) != len(page.children):
+                raise ValueError('Leaf with unmatched values.')
+            return len(page.keys), 1
+        if len(page.children) != len(page.keys) + 1:
+            raise ValueError('Internal page with unmatched children.')
+        bounds = [lo] + page.keys + [hi]
+        heights = set()
+        size = 0
+        for i, child_ref in enumerate(page.children):
+            child_size, height = self._validate(
+                self._follow(child_ref), bounds[i], bounds[i + 1])
+            if child_ref.size != child_size:
+                raise ValueError('Wrong subtree size under %r.' % (bounds[i],))
+            heights.add(height)
+            size += child_size
+        if len(heights) != 1:
+            raise ValueError('Leaves at different depths.')
+        return size, heights.pop() + 1
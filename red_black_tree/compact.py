@@ -0,0 +1,54 @@
+"""
+Command line tool that compacts red-black tree database files.
+
+Only the keys and values reachable from the committed root are copied to a
+new file, which then atomically replaces the old one:
+
+    python -m red_black_tree.compact /tmp/test.dbdb
+"""
+import argparse
+
+from red_black_tree.red_black_tree import connect
+
+
+def compact(dbname, layout=None):
+    """
+    Function that compacts a database file in place.
+    
+    Parameters
+    ----------
+    
+    dbname: path of the database
+    layout: order in which nodes are written, 'depth_first' or 'blocked', optional
+    
+    Notes
+    -----
+    
+    Returns a CompactionStats with the bytes reclaimed and elapsed time.
+    
+    """
+    db = connect(dbname)
+    try:
+        return db.compact(layout)
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compact red-black tree database files.')
+    parser.add_argument('dbnames', nargs='+', metavar='dbname',
+                        help='path of a database file')
+    parser.add_argument('--layout', choices=['depth_first', 'blocked'],
+                        help='write nodes depth-first or clustered in '
+                             'page-sized blocks')
+    args = parser.parse_args(argv)
+    for dbname in args.dbnames:
+        stats = compact(dbname, args.layout)
+        print('%s: %d keys, %d -> %d bytes, %d bytes reclaimed in %.3fs' % (
+            dbname, stats.keys, stats.bytes_before, stats.bytes_after,
+            stats.bytes_reclaimed, stats.elapsed))
+
+
+if __name__ == '__main__':
+    main()
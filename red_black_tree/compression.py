@@ -0,0 +1,165 @@
+"""
+Record compression for database files.
+
+A file created with compression prefixes every record with a one-byte tag
+saying how the rest of it is stored. Records below a size threshold, and
+records that do not shrink, are stored raw behind the tag. A file may also
+hold a zlib dictionary, trained on sample values when the file is bulk loaded
+or compacted, which lets even short values compress:
+
+    db = connect("/tmp/test.dbdb", compression='zlib')
+"""
+import lzma
+import zlib
+from collections import Counter
+
+NONE = 0
+ZLIB = 1
+LZMA = 2
+METHODS = {None: NONE, 'zlib': ZLIB, 'lzma': LZMA}
+NAMES = {NONE: None, ZLIB: 'zlib', LZMA: 'lzma'}
+
+#record tags
+RAW = 0
+ZLIB_RECORD = 1
+LZMA_RECORD = 2
+ZLIB_DICT_RECORD = 3
+
+#zlib only looks back 32 KiB, so a longer dictionary is never used
+DICTIONARY_SIZE = 32 * 1024
+#substrings counted when training, and the pieces a dictionary is built of
+GRAM_LENGTH = 8
+SEGMENT_LENGTH = 32
+#raw lzma streams, without the 60-odd bytes of container a small record
+#cannot afford; the lowest preset, since the setup of larger ones costs
+#more than compressing a record
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 0}]
+
+
+def method_id(name):
+    """
+    Function that returns the id recorded in the superblock for a compression method.
+
+    Parameter
+    ---------
+
+    name: None, 'zlib' or 'lzma'
+
+    """
+    if name not in METHODS:
+        raise ValueError('Unknown compression %r.' % (name,))
+    return METHODS[name]
+
+
+def dictionary_compressor(zdict):
+    """
+    Function that returns a zlib compressor primed with a dictionary, to be copied for each record.
+
+    Parameter
+    ---------
+
+    zdict: a trained zlib dictionary
+
+    """
+    return zlib.compressobj(zdict=zdict)
+
+
+def compress(data, method, threshold, primed=None):
+    """
+    Function that returns the tagged record for data.
+
+    Parameters
+    ----------
+
+    data: the record to store
+    method: ZLIB or LZMA
+    threshold: records shorter than this are stored raw
+    primed: the compressor returned by dictionary_compressor for the file's dictionary, optional
+
+    """
+    if len(data) >= threshold:
+        if method == LZMA:
+            tag = LZMA_RECORD
+            packed = lzma.compress(data, format=lzma.FORMAT_RAW,
+                                   filters=LZMA_FILTERS)
+        elif primed is not None:
+            #copying skips loading the dictionary for every record
+            compressor = primed.copy()
+            tag = ZLIB_DICT_RECORD
+            packed = compressor.compress(data) + compressor.flush()
+        else:
+            tag, packed = ZLIB_RECORD, zlib.compress(data)
+        if len(packed) < len(data):
+            return bytes((tag,)) + packed
+    return bytes((RAW,)) + bytes(data)
+
+
+def decompress(record, zdict=None):
+    """
+    Function that returns the data stored in a tagged record.
+
+    Parameters
+    ----------
+
+    record: the record as read from the file
+    zdict: the file's zlib dictionary, needed for records compressed with it
+
+    """
+    tag = record[0]
+    if tag == RAW:
+        #a slice of a memoryview, so mapped reads still do not copy
+        return record[1:]
+    if tag == ZLIB_RECORD:
+        return zlib.decompress(record[1:])
+    if tag == LZMA_RECORD:
+        return lzma.decompress(record[1:], format=lzma.FORMAT_RAW,
+                               filters=LZMA_FILTERS)
+    if tag == ZLIB_DICT_RECORD:
+        if zdict is None:
+            raise ValueError('The record needs the file dictionary.')
+        decompressor = zlib.decompressobj(zdict=zdict)
+        return decompressor.decompress(record[1:]) + decompressor.flush()
+    raise ValueError('Unknown record tag %d.' % tag)
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """
+    Function that builds a zlib dictionary from sample records.
+
+    Parameters
+    ----------
+
+    samples: list of bytes-like records, e.g. encoded values
+    size: largest dictionary returned, optional
+
+    Notes
+    -----
+
+    Every substring of GRAM_LENGTH bytes is scored by the number of samples
+    it occurs in. The samples are cut into segments, and the segments whose
+    substrings are shared most widely are kept, best last, since zlib finds
+    the end of the dictionary cheapest to refer to.
+
+    """
+    samples = [bytes(sample) for sample in samples]
+    frequency = Counter()
+    for sample in samples:
+        frequency.update(set(sample[i:i + GRAM_LENGTH]
+                             for i in range(len(sample) - GRAM_LENGTH + 1)))
+    scores = {}
+    for sample in samples:
+        for start in range(0, len(sample), SEGMENT_LENGTH):
+            segment = sample[start:start + SEGMENT_LENGTH]
+            if segment in scores:
+                continue
+            scores[segment] = sum(
+                frequency[segment[i:i + GRAM_LENGTH]] - 1
+                for i in range(len(segment) - GRAM_LENGTH + 1))
+    chosen = []
+    length = 0
+    for segment in sorted(scores, key=scores.get, reverse=True):
+        if scores[segment] <= 0 or length + len(segment) > size:
+            break
+        chosen.append(segment)
+        length += len(segment)
+    return b''.join(reversed(chosen))
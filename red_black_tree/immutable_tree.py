@@ -1,14 +1,28 @@
+import bisect
 import os
 import struct
 import portalocker
 import pickle
+import mmap
+import threading
+import time
+import weakref
+from collections import OrderedDict, namedtuple
+from red_black_tree.value_codecs import StrCodec, get_codec
+from red_black_tree import compression as record_compression
+from red_black_tree.bloom import BloomFilter, PAGE_SIZE as BLOOM_PAGE_SIZE
 
 class ValueRef(object):
     """
     This class produces a reference to a string value on the disk.   
     """
+    #whether referents of this class may be kept in a NodeCache
+    cacheable = False
+    #refs are created for every node of every copied path, so they carry
+    #no per-instance dictionary
+    __slots__ = ('_referent', '_address', '_inline')
 
-    def __init__(self, referent=None, address=0):
+    def __init__(self, referent=None, address=0, inline=None):
         """
         The constructor of the class takes for arguments a referent and address
         
@@ -17,15 +31,18 @@ class ValueRef(object):
         
         referent: value to store for the string, optional
         address: target address for the string value, optional
+        inline: encoded value read from the parent node record, optional
         
         Attributes
         ----------
         
         self._referent: value
         self._address: address
+        self._inline: encoded value stored in the parent node, if any
         """
         self._referent = referent #value to store
         self._address = address #address to store at
+        self._inline = inline
         
     @property
     def address(self):
@@ -34,6 +51,14 @@ class ValueRef(object):
         
         """
         return self._address
+
+    @property
+    def inline(self):
+        """
+        Method that returns the encoded value when it is stored in the parent node record, else None.
+        
+        """
+        return self._inline
     
     def prepare_to_store(self, storage):
         """
@@ -48,66 +73,93 @@ class ValueRef(object):
         pass
 
     @staticmethod
-    def referent_to_bytes(referent):
+    def referent_to_bytes(referent, storage=None):
         """
-        Method that encodes the referent in utf-8
+        Method that encodes the referent with the storage's value codec, utf-8 by default
         
-        Parameter
-        ---------
+        Parameters
+        ----------
         
         referent: the value to be stored in the class
+        storage: the storage the bytes are written to, optional
         
         """
-        return referent.encode('utf-8')
+        if storage is None:
+            return StrCodec.encode(referent)
+        return storage.value_codec.encode(referent)
 
     @staticmethod
-    def bytes_to_referent(bytes):
+    def bytes_to_referent(bytes, storage=None):
         """
-        Method that decodes the stored bytes in utf-8
+        Method that decodes the stored bytes with the storage's value codec, utf-8 by default
         
-        Parameter
-        ---------
+        Parameters
+        ----------
         
-        bytes: the storage encoded in utf-8
+        bytes: the stored value
+        storage: the storage the bytes were read from, optional
         
         """
-        return bytes.decode('utf-8')
+        if storage is None:
+            return StrCodec.decode(bytes)
+        return storage.value_codec.decode(bytes)
 
     
-    def get(self, storage):
+    def get(self, storage, cache=None):
         """
         Method that reads bytes for the value from the disk.
         
-        Parameter
-        ---------
+        Parameters
+        ----------
         
         storage: the referent's storage address, to be decoded and then obtained through self._referent.
+        cache: a NodeCache to look the address up in first, optional
         
         """
         "read bytes for value from disk"
+        if self._referent is None and self._inline is not None:
+            self._referent = self.bytes_to_referent(self._inline, storage)
         if self._referent is None and self._address:
-            self._referent = self.bytes_to_referent(storage.read(self._address))
+            if cache is not None:
+                #the referent is left unset on the ref, so that nodes held
+                #by the cache do not pin their decoded children in memory
+                referent = cache.get(self._address)
+                if referent is None:
+                    referent = self.bytes_to_referent(
+                        storage.read(self._address), storage)
+                    cache.put(self._address, referent)
+                return referent
+            self._referent = self.bytes_to_referent(
+                storage.read(self._address), storage)
         return self._referent
 
-    def store(self, storage):
+    def store(self, storage, inline_threshold=0):
         """
         Method that stores bytes for the value to the disk.
         
-        Parameter
-        ---------
+        Parameters
+        ----------
         
         storage: the referent's storage address, to be encoded and then stored in self._address,
+        inline_threshold: values encoding to fewer bytes are kept for the parent node record instead, optional
         
         """
         #called by BinaryNode.store_refs
-        if self._referent is not None and not self._address:
+        if (self._referent is not None and not self._address
+                and self._inline is None):
             self.prepare_to_store(storage)
-            self._address = storage.write(self.referent_to_bytes(self._referent))
+            data = self.referent_to_bytes(self._referent, storage)
+            if len(data) < inline_threshold:
+                self._inline = data
+            else:
+                self._address = storage.write(data)
 
 class BinaryNodeRef(ValueRef):
     """
     This class produces a reference to a binary search tree node on the disk.   
     """
+    cacheable = True
+    __slots__ = ()
     
     #calls the BinaryNode's store_refs
     def prepare_to_store(self, storage):
@@ -124,14 +176,15 @@ class BinaryNodeRef(ValueRef):
             self._referent.store_refs(storage)
 
     @staticmethod
-    def referent_to_bytes(referent):
+    def referent_to_bytes(referent, storage=None):
         """
         Method that uses pickle to convert the node to bytes
         
-        Parameter
-        ---------
+        Parameters
+        ----------
         
         referent: the value to be stored in the node
+        storage: the storage the bytes are written to, optional
         
         """
         return pickle.dumps({
@@ -142,14 +195,15 @@ class BinaryNodeRef(ValueRef):
         })
 
     @staticmethod
-    def bytes_to_referent(string):
+    def bytes_to_referent(string, storage=None):
         """
         Method that unpickles bytes to obtain a node object
         
-        Parameter
-        ---------
+        Parameters
+        ----------
         
-        referent: the value to be stored in the node
+        string: the pickled node
+        storage: the storage the bytes were read from, optional
         
         """
         d = pickle.loads(string)
@@ -164,6 +218,8 @@ class BinaryNode(object):
     """
     This class stores data associated with a particular node whose refs are stored in BinaryNodeRef
     """
+    __slots__ = ('left_ref', 'key', 'value_ref', 'right_ref')
+
     @classmethod
     def from_node(cls, node, **kwargs):
         """
@@ -228,12 +284,96 @@ class BinaryNode(object):
         self.right_ref.store(storage)
         
         
+class NodeCache(object):
+    """
+    Bounded least-recently-used cache of decoded nodes, keyed by address.
+
+    Nodes are never modified once written to the append-only file, so an
+    entry can never go stale.
+    """
+
+    def __init__(self, capacity=1024):
+        """
+        The constructor of the class takes for arguments the cache capacity
+        
+        Parameters
+        ----------
+        
+        capacity: the maximum number of nodes kept, optional
+        
+        Attributes
+        ----------
+        
+        self.capacity: maximum number of nodes
+        self.hits: lookups served from the cache
+        self.misses: lookups that had to read the disk
+        self.evictions: nodes dropped to respect the capacity
+        """
+        self.capacity = capacity
+        self._nodes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def get(self, address):
+        """
+        Method that returns the node cached at an address, or None
+        
+        Parameter
+        ---------
+        
+        address: the address the node was read from
+        
+        """
+        node = self._nodes.get(address)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._nodes.move_to_end(address)
+        return node
+
+    def put(self, address, node):
+        """
+        Method that caches a node, evicting the least recently used ones
+        
+        Parameters
+        ----------
+        
+        address: the address the node was read from
+        node: the decoded node
+        
+        """
+        self._nodes[address] = node
+        self._nodes.move_to_end(address)
+        while len(self._nodes) > self.capacity:
+            self._nodes.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        "drop every cached node, keeping the counters"
+        self._nodes.clear()
+
+    def stats(self):
+        "return the cache counters as a dictionary"
+        return {
+            'size': len(self._nodes),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
 class BinaryTree(object):
     """
     Immutable Binary Tree class. Constructs new tree on changes.
     """
     
-    def __init__(self, storage):
+    def __init__(self, storage, cache_size=1024):
         """
         The constructor of the class takes for arguments a storage reference
         
@@ -241,14 +381,17 @@ class BinaryTree(object):
         ----------
         
         storage: storage reference address, compulsory
+        cache_size: number of decoded nodes kept in memory, 0 disables the cache, optional
         
         Attributes
         ----------
         
         self._storage: address
+        self._cache: NodeCache shared by every lookup, or None
         self._refresh_tree_ref(): address
         """
         self._storage = storage
+        self._cache = NodeCache(cache_size) if cache_size else None
         self._refresh_tree_ref()
 
     def commit(self):
@@ -421,9 +564,75 @@ class BinaryTree(object):
         
         """        
         
-        #calls BinaryNodeRef.get
+        #calls BinaryNodeRef.get, going through the node cache for nodes
+        if ref.cacheable:
+            return ref.get(self._storage, self._cache)
         return ref.get(self._storage)
 
+    def cache_stats(self):
+        """
+        Method that returns the node cache's hit, miss and eviction counters.
+        
+        """
+        if self._cache is None:
+            return None
+        return self._cache.stats()
+
+    def _value_bytes(self, value_ref):
+        "return the encoded bytes of a stored value, inline or not"
+        if value_ref.inline is not None:
+            return value_ref.inline
+        return self._storage.read(value_ref.address)
+
+    def _copy_value(self, value_ref, storage):
+        """
+        Method that copies the encoded bytes of a value to another storage, returning a reference to the copy.
+        
+        """
+        data = self._value_bytes(value_ref)
+        if len(data) < storage.inline_threshold:
+            return ValueRef(inline=bytes(data))
+        return ValueRef(address=storage.write(data))
+
+    def _stored_pairs(self, pairs):
+        """
+        Method that writes each value as it is consumed, yielding (key, value_ref) pairs.
+        
+        """
+        previous = None
+        first = True
+        for key, value in pairs:
+            if not first and not previous < key:
+                raise ValueError('Keys must be strictly increasing.')
+            first = False
+            previous = key
+            value_ref = ValueRef(value)
+            value_ref.store(self._storage, self._storage.inline_threshold)
+            yield key, value_ref
+
+    @staticmethod
+    def _sort_batch(keys):
+        """
+        Method that sorts the keys of a batched lookup.
+        
+        Notes
+        -----
+        
+        Returns the keys as a sequence, the positions of the keys in sorted
+        order, and the sorted keys.
+        
+        """
+        if hasattr(keys, 'argsort'):
+            #NumPy sorts the array without a Python object per comparison
+            order = keys.argsort(kind='stable')
+            sorted_keys = keys[order].tolist()
+            order = order.tolist()
+        else:
+            keys = list(keys)
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            sorted_keys = [keys[i] for i in order]
+        return keys, order, sorted_keys
+
     def _find_max(self, node):
         """
         Method that finds the right-most node associated with a particular node,
@@ -441,31 +650,571 @@ class BinaryTree(object):
                 return node
             node = next_node
 
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Method that lazily yields the (key, value) pairs with lo <= key < hi in key order.
+        
+        Parameters
+        ----------
+        
+        lo: smallest key to yield, None for no lower bound, optional
+        hi: key at which to stop, excluded, None for no upper bound, optional
+        reverse: yield the pairs in descending key order, optional
+        
+        Notes
+        -----
+        
+        The tree is walked in order with an explicit stack of the nodes whose
+        key is still to be yielded, so memory stays proportional to the height
+        of the tree. Values are only read when their pair is consumed. The
+        root is read once, so the scan sees the tree as it was when started.
+        
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        return ((node.key, self._follow(node.value_ref))
+                for node in self._walk(self._tree_ref, lo, hi, reverse))
+
+    def _walk(self, tree_ref, lo=None, hi=None, reverse=False):
+        """
+        Method that lazily yields the nodes with lo <= key < hi of a tree in key order.
+        
+        Parameters
+        ----------
+        
+        tree_ref: reference to the root of the tree
+        lo: smallest key to yield, None for no lower bound, optional
+        hi: key at which to stop, excluded, None for no upper bound, optional
+        reverse: yield the nodes in descending key order, optional
+        
+        """
+        if reverse:
+            near, far = 'right_ref', 'left_ref'
+            before = lambda key: hi is not None and not key < hi
+            past = lambda key: lo is not None and key < lo
+        else:
+            near, far = 'left_ref', 'right_ref'
+            before = lambda key: lo is not None and key < lo
+            past = lambda key: hi is not None and not key < hi
+        stack = []
+        node = self._follow(tree_ref)
+        #descend to the first node in range, stacking the ones left to visit
+        while node is not None:
+            if before(node.key):
+                node = self._follow(getattr(node, far))
+            else:
+                stack.append(node)
+                node = self._follow(getattr(node, near))
+        while stack:
+            node = stack.pop()
+            if past(node.key):
+                return
+            yield node
+            child = self._follow(getattr(node, far))
+            while child is not None:
+                stack.append(child)
+                child = self._follow(getattr(child, near))
+
+    def items(self):
+        """
+        Method that lazily yields every (key, value) pair in key order.
+        
+        """
+        return self.range()
+
+    def keys(self):
+        """
+        Method that lazily yields every key in order, without reading the values.
+        
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        return (node.key for node in self._walk(self._tree_ref))
+
+class WriteBuffer(object):
+    """
+    This class holds the sets and deletes made since the last commit, sorted by key.
+
+    Keys are kept in a sorted list rather than a dictionary, so that, as in
+    the tree, they need only be orderable. A later write to a key replaces
+    the buffered one, so each key reaches the tree once per commit.
+    """
+    #returned by lookup for keys the buffer holds nothing for
+    MISSING = object()
+    #buffered for keys deleted since the last commit
+    DELETED = object()
+
+    def __init__(self):
+        """
+        The constructor of the class starts with an empty buffer
+        
+        Attributes
+        ----------
+        
+        self._keys: the buffered keys, sorted
+        self._values: the value, or DELETED, of each key
+        """
+        self._keys = []
+        self._values = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _find(self, key):
+        "return where key is or would go, and whether it is there"
+        i = bisect.bisect_left(self._keys, key)
+        return i, i < len(self._keys) and not key < self._keys[i]
+
+    def put(self, key, value):
+        """
+        Method that buffers the value of a key, DELETED for a delete
+        
+        Parameters
+        ----------
+        
+        key: a lookup value
+        value: the value of the key
+        
+        """
+        i, found = self._find(key)
+        if found:
+            self._values[i] = value
+        else:
+            self._keys.insert(i, key)
+            self._values.insert(i, value)
+
+    def discard(self, key):
+        "forget a buffered key, if any"
+        i, found = self._find(key)
+        if found:
+            del self._keys[i], self._values[i]
+
+    def lookup(self, key):
+        """
+        Method that returns the buffered value of a key, DELETED, or MISSING if the key was not written
+        
+        Parameter
+        ---------
+        
+        key: a lookup value
+        
+        """
+        i, found = self._find(key)
+        return self._values[i] if found else self.MISSING
+
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Method that returns the buffered (key, value) pairs with lo <= key < hi in key order, DELETED for deletes
+
+        Parameters
+        ----------
+
+        lo: smallest key returned, None for no lower bound, optional
+        hi: key at which to stop, excluded, None for no upper bound, optional
+        reverse: return the pairs in descending key order, optional
+
+        Notes
+        -----
+
+        The pairs are copied, so later writes to the buffer do not change them.
+
+        """
+        start = 0 if lo is None else bisect.bisect_left(self._keys, lo)
+        stop = len(self._keys) if hi is None else \
+            bisect.bisect_left(self._keys, hi)
+        pairs = list(zip(self._keys[start:stop], self._values[start:stop]))
+        if reverse:
+            pairs.reverse()
+        return pairs
+
+    def drain(self):
+        """
+        Method that empties the buffer, returning the (key, value) pairs set and the keys deleted, both in key order.
+        
+        """
+        pairs = [(key, value) for key, value in zip(self._keys, self._values)
+                 if value is not self.DELETED]
+        deleted = [key for key, value in zip(self._keys, self._values)
+                   if value is self.DELETED]
+        self._keys = []
+        self._values = []
+        return pairs, deleted
+
+
+class CommitStats(object):
+    """
+    This class counts commits and their latency for a connection.
+    """
+
+    def __init__(self):
+        """
+        The constructor of the class starts every counter at zero
+        
+        Attributes
+        ----------
+        
+        self.commits: number of commits
+        self.total_latency: seconds spent in commits
+        self.max_latency: longest commit in seconds
+        self._first: start time of the first commit
+        self._last: end time of the last commit
+        """
+        self.commits = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._first = None
+        self._last = None
+
+    def record(self, start, end):
+        """
+        Method that counts a commit that ran from start to end
+        
+        Parameters
+        ----------
+        
+        start: time.perf_counter() when the commit started
+        end: time.perf_counter() when the commit returned
+        
+        """
+        latency = end - start
+        self.commits += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if self._first is None:
+            self._first = start
+        self._last = end
+
+    def stats(self, syncs=0):
+        "return the commit counters as a dictionary"
+        elapsed = (self._last - self._first) if self.commits else 0.0
+        return {
+            'commits': self.commits,
+            'syncs': syncs,
+            'mean_latency': (self.total_latency / self.commits
+                             if self.commits else 0.0),
+            'max_latency': self.max_latency,
+            'commits_per_second': (self.commits / elapsed
+                                   if elapsed > 0 else 0.0),
+        }
+
+
+class GroupCommit(object):
+    """
+    This class lets the connections of one process to one file share fsyncs.
+    
+    A committing writer flushes its records, submits its root and releases the
+    file lock, so the next writer can start from that root at once. It then
+    waits until some commit of the group becomes leader, syncs the data of
+    every root submitted so far with one fsync, writes the newest root to the
+    superblock and syncs that.
+    
+    Every Storage of the process open on the file shares its group, whatever
+    its durability: writers start from the newest submitted root, and those
+    writing the superblock themselves drain the group first, so that no late
+    root from a leader overwrites theirs. Writers in other processes cannot
+    see roots that are still waiting, so a file in group mode must only be
+    written from one process.
+    """
+    #groups are shared by every Storage open on the same file
+    _groups = weakref.WeakValueDictionary()
+    _groups_lock = threading.Lock()
+
+    @classmethod
+    def for_file(cls, f):
+        "return the group of the file f is open on, creating it if needed"
+        st = os.fstat(f.fileno())
+        key = (st.st_dev, st.st_ino)
+        with cls._groups_lock:
+            group = cls._groups.get(key)
+            if group is None:
+                group = cls._groups[key] = cls()
+            return group
+
+    def __init__(self):
+        """
+        The constructor of the class starts with nothing submitted
+        
+        Attributes
+        ----------
+        
+        self.pending_root: newest submitted root address
+        self.pending_history: address of the commit record of the newest submitted root
+        self.submitted: number of roots submitted
+        self.durable: number of roots known to be on disk
+        self.leading: whether a leader is syncing now
+        """
+        self._condition = threading.Condition()
+        self.pending_root = None
+        self.pending_history = None
+        self.submitted = 0
+        self.durable = 0
+        self.leading = False
+
+    def latest_root(self):
+        "return the newest submitted root if it is not yet on disk, else None"
+        with self._condition:
+            if self.submitted > self.durable:
+                return self.pending_root
+            return None
+
+    def latest_history(self):
+        "return the commit record address of the newest submitted root if it is not yet on disk, else None"
+        with self._condition:
+            if self.submitted > self.durable:
+                return self.pending_history
+            return None
+
+    def submit(self, root_address, history_address=0):
+        """
+        Method that queues a root whose records are flushed, returning its ticket
+        
+        Parameters
+        ----------
+        
+        root_address: address of the committed root node
+        history_address: address of the commit record written for it, optional
+        
+        """
+        with self._condition:
+            self.pending_root = root_address
+            self.pending_history = history_address
+            self.submitted += 1
+            return self.submitted
+
+    def drain(self, storage):
+        """
+        Method that returns once every submitted root is durable, so that the caller holding the file lock may write the superblock.
+        
+        Parameter
+        ---------
+        
+        storage: the Storage used to sync when leading
+        
+        """
+        with self._condition:
+            ticket = self.submitted
+        self.wait(ticket, storage)
+
+    def wait(self, ticket, storage):
+        """
+        Method that returns once the root with the given ticket is durable, leading a sync if nobody is.
+        
+        Parameters
+        ----------
+        
+        ticket: the number returned by submit
+        storage: the Storage used to sync when leading
+        
+        """
+        with self._condition:
+            while self.durable < ticket:
+                if self.leading:
+                    self._condition.wait()
+                    continue
+                self.leading = True
+                batch = self.submitted
+                root_address = self.pending_root
+                history_address = self.pending_history
+                self._condition.release()
+                try:
+                    storage._write_durable_root(root_address, history_address)
+                except BaseException:
+                    self._condition.acquire()
+                    self.leading = False
+                    self._condition.notify_all()
+                    raise
+                self._condition.acquire()
+                self.leading = False
+                self.durable = batch
+                self._condition.notify_all()
+
+
+#one entry of a file's commit history
+CommitRecord = namedtuple(
+    'CommitRecord', ['commit_id', 'timestamp', 'root_address', 'address'])
+
+
+class StorageRetired(Exception):
+    """
+    Raised when a file has been replaced by a compacted copy and must be reopened.
+    """
+
+
 class Storage(object):
     SUPERBLOCK_SIZE = 4096
     INTEGER_FORMAT = "!Q"
     INTEGER_LENGTH = 8
+    #the header follows the root address in the superblock and records
+    #how node records and values are encoded, how records are compressed
+    #and where the compression dictionary is. Files written before the
+    #header existed have zeros there and are read as pickle and utf-8.
+    HEADER_OFFSET = 8
+    HEADER_FORMAT = "!4sBBBQ"
+    DICTIONARY_OFFSET = HEADER_OFFSET + 7
+    MAGIC = b'RBDB'
+    #address of the newest commit record, zero in files without history.
+    #Each record holds its commit id, time, root and the previous record.
+    HISTORY_OFFSET = 32
+    HISTORY_RECORD = struct.Struct("!QdQQ")
+    #address of the file's key filter, zero in files without one. The
+    #filter is the root it was last updated for followed by a BloomFilter,
+    #and is rewritten in place, since bits are only ever added. It is only
+    #trusted while that root is the committed one, so a filter left behind
+    #by a crash, or by a writer that did not update it, is never used.
+    BLOOM_OFFSET = 40
+    FORMAT_PICKLE = 0
+    FORMAT_BINARY = 1
+    #pages of a B+tree instead of red-black nodes
+    FORMAT_BTREE = 2
+    #root address left in a file that was replaced by a compacted copy
+    RETIRED = 2 ** 64 - 1
+    #what a commit waits for before returning: the OS having the data, the
+    #disk having the data, or the disk via a sync shared with the other
+    #committers of the process. Flushing is the minimum, since other
+    #connections only see what reached the OS before the lock is released.
+    DURABILITY_FLUSH = 'flush'
+    DURABILITY_FSYNC = 'fsync'
+    DURABILITY_GROUP = 'group'
+    DURABILITIES = (DURABILITY_FLUSH, DURABILITY_FSYNC, DURABILITY_GROUP)
 
-    def __init__(self, f):
+    def __init__(self, f, use_mmap=False, durability=DURABILITY_FLUSH,
+                 value_codec=None, compression=None, compress_threshold=64,
+                 inline_threshold=64, node_format=None):
+        if durability not in self.DURABILITIES:
+            raise ValueError('Unknown durability %r.' % (durability,))
+        #the codec and compression a new file is created with; an existing
+        #file keeps its own
+        requested_codec = None if value_codec is None else get_codec(value_codec)
+        requested_compression = record_compression.method_id(compression)
+        #records shorter than this are not compressed
+        self.compress_threshold = compress_threshold
         self._f = f
         self.locked = False
+        #a file opened for reading only is never locked or written
+        self.readonly = not f.writable()
+        self.durability = durability
+        #number of fsyncs issued through this storage
+        self.syncs = 0
+        #id given to the first commit of a file without history
+        self.first_commit_id = 1
+        #(address, commit id) of the newest commit record we know of
+        self._last_commit = (0, 0)
+        #the key filter of the file as this connection knows it, with keys
+        #written under the lock added; it is stale when it may miss keys of
+        #the tree, and is then rebuilt with set_bloom before the next commit
+        self.bloom = None
+        self.bloom_stale = False
+        #(address, root) of the filter record self.bloom was read from or
+        #written to, None until the superblock exists
+        self._bloom_at = None
+        self._group = GroupCommit.for_file(f)
+        #with use_mmap, reads are served as memoryview slices of a
+        #read-only map of the file instead of seek/read calls
+        self._use_mmap = use_mmap
+        self._map = None
+        self._view = None
         #we ensure that we start in a sector boundary
-        self._ensure_superblock()
+        self._ensure_superblock(
+            requested_codec or StrCodec, requested_compression,
+            self.FORMAT_BINARY if node_format is None else node_format)
+        if requested_codec not in (None, self.value_codec):
+            raise ValueError('The file stores %s values, not %s.' % (
+                self.value_codec.name, requested_codec.name))
+        if requested_compression not in (record_compression.NONE,
+                                         self.compression):
+            raise ValueError('The file was created with compression %r.' % (
+                record_compression.NAMES[self.compression],))
+        #values encoding to fewer bytes are written inside their node
+        #record; pickled nodes have no room for them
+        self.inline_threshold = (inline_threshold
+                                 if self.node_format != self.FORMAT_PICKLE
+                                 else 0)
+        if use_mmap:
+            self._remap()
+        self._bloom_at = (0, 0)
 
-    def _ensure_superblock(self):
+    def _ensure_superblock(self, value_codec, compression, node_format):
         "guarantee that the next write will start on a sector boundary"
+        if os.fstat(self._f.fileno()).st_size >= self.SUPERBLOCK_SIZE:
+            #the superblock exists, so opening need not wait for a writer
+            self._read_header()
+            return
         self.lock()
         self._seek_end()
         end_address = self._f.tell()
         if end_address < self.SUPERBLOCK_SIZE:
             self._f.write(b'\x00' * (self.SUPERBLOCK_SIZE - end_address))
+            #a brand new file gets the node format asked for
+            self._f.seek(self.HEADER_OFFSET)
+            self._f.write(struct.pack(
+                self.HEADER_FORMAT, self.MAGIC, node_format,
+                value_codec.id, compression, 0))
+        self._read_header()
         self.unlock()
 
+    def _read_header(self):
+        "set the formats, codec and compression recorded in the superblock header"
+        self._f.flush()
+        self._f.seek(self.HEADER_OFFSET)
+        magic, node_format, codec_id, compression, dictionary = struct.unpack(
+            self.HEADER_FORMAT,
+            self._f.read(struct.calcsize(self.HEADER_FORMAT)))
+        self.dictionary = self._compressor = None
+        if magic != self.MAGIC:
+            self.node_format = self.FORMAT_PICKLE
+            self.value_codec = StrCodec
+            self.compression = record_compression.NONE
+            return
+        if node_format > self.FORMAT_BTREE:
+            raise ValueError('Unsupported node format %d.' % node_format)
+        if compression not in record_compression.NAMES:
+            raise ValueError('Unsupported compression %d.' % compression)
+        self.node_format = node_format
+        self.value_codec = get_codec(codec_id)
+        self.compression = compression
+        if dictionary:
+            self._f.seek(dictionary)
+            self.dictionary = self._f.read(self._read_integer())
+            self._compressor = record_compression.dictionary_compressor(
+                self.dictionary)
+
+    def set_dictionary(self, dictionary):
+        """
+        Method that stores a zlib dictionary in a new zlib-compressed file, for records written from now on
+        
+        Parameter
+        ---------
+        
+        dictionary: bytes, as returned by compression.train_dictionary
+        
+        """
+        if self.compression != record_compression.ZLIB:
+            raise ValueError('Dictionaries are only used by zlib compression.')
+        if self.dictionary is not None:
+            #records compressed with the old one could not be read any more
+            raise ValueError('The file already has a dictionary.')
+        if not dictionary:
+            return
+        self.lock()
+        self._seek_end()
+        address = self._f.tell()
+        self._write_integer(len(dictionary))
+        self._f.write(dictionary)
+        self._f.seek(self.DICTIONARY_OFFSET)
+        self._write_integer(address)
+        self.dictionary = bytes(dictionary)
+        self._compressor = record_compression.dictionary_compressor(
+            self.dictionary)
+
     def lock(self):
         "if not locked, lock the file for writing"
+        if self.readonly:
+            raise ValueError('The database was opened read-only.')
         if not self.locked:
             portalocker.lock(self._f, portalocker.LOCK_EX)
             self.locked = True
+            if self._bloom_at is not None:
+                self._load_bloom()
             return True
         else:
             return False
@@ -502,37 +1251,310 @@ class Storage(object):
         #write data, unlock <==WRONG, dont want to unlock here
         #your code here
         self.lock()
+        if self.compression:
+            data = record_compression.compress(
+                data, self.compression, self.compress_threshold,
+                self._compressor)
         self._seek_end()
         object_address = self._f.tell()
         self._write_integer(len(data))
         self._f.write(data)
         return object_address
 
+    def align(self, length, boundary):
+        "pad the file so that the next length bytes do not straddle a boundary"
+        self.lock()
+        self._seek_end()
+        offset = self._f.tell() % boundary
+        if length <= boundary and offset + length > boundary:
+            self._f.write(b'\x00' * (boundary - offset))
+
     def read(self, address):
-        self._f.seek(address)
-        length = self._read_integer()
-        data = self._f.read(length)
+        if self._view is not None:
+            data = self._read_mapped(address)
+        else:
+            self._f.seek(address)
+            length = self._read_integer()
+            data = self._f.read(length)
+        if self.compression:
+            if (data[0] == record_compression.ZLIB_DICT_RECORD
+                    and self.dictionary is None):
+                #another connection stored the dictionary after we opened
+                self._read_header()
+            data = record_compression.decompress(data, self.dictionary)
         return data
 
+    def _remap(self):
+        "map the whole file as it is now, dropping the previous map"
+        self._f.flush()
+        old_map, old_view = self._map, self._view
+        self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        if old_map is not None:
+            self._release_map(old_map, old_view)
+
+    @staticmethod
+    def _release_map(old_map, old_view):
+        "close a map unless slices handed out by read are still alive"
+        try:
+            old_view.release()
+            old_map.close()
+        except BufferError:
+            #the map is closed when the last slice is garbage collected
+            pass
+
+    def _read_mapped(self, address):
+        "return the record at address as a slice of the map, without copying"
+        start = address + self.INTEGER_LENGTH
+        if start > len(self._view):
+            #the file grew since it was mapped, e.g. by another process
+            self._remap()
+        length = struct.unpack_from(
+            self.INTEGER_FORMAT, self._view, address)[0]
+        if start + length > len(self._view):
+            self._remap()
+        return self._view[start:start + length]
+
     def commit_root_address(self, root_address):
         self.lock()
-        self._f.flush()
+        if self.bloom is not None:
+            #readers must never see a root whose keys the filter misses
+            self._store_bloom(root_address)
+        history_address = self._append_history(root_address)
+        if self.durability == self.DURABILITY_GROUP:
+            #the next writer may start from this root before it is durable
+            self._f.flush()
+            ticket = self._group.submit(root_address, history_address)
+            self.unlock()
+            self._group.wait(ticket, self)
+            if self._view is not None:
+                self._remap()
+            return
+        #a leader must not write an older root over this one later
+        self._group.drain(self)
+        if self.durability == self.DURABILITY_FSYNC:
+            #the records must be on disk before the root pointing to them
+            self.sync()
+        else:
+            self._f.flush()
         #make sure you write root address at position 0
         self._seek_superblock()
         #write is atomic because we store the address on a sector boundary.
         self._write_integer(root_address)
-        self._f.flush()
+        self._f.seek(self.HISTORY_OFFSET)
+        self._write_integer(history_address)
+        if self.durability == self.DURABILITY_FSYNC:
+            self.sync()
+        else:
+            self._f.flush()
+        if self._view is not None:
+            #extend the map over everything appended by this commit
+            self._remap()
         self.unlock()
 
+    def _write_durable_root(self, root_address, history_address):
+        "sync every flushed record, then write and sync the root, without the file lock"
+        os.fsync(self._f.fileno())
+        #a positioned write leaves the buffered file alone, since another
+        #writer of the group may hold the lock and be appending meanwhile
+        os.pwrite(self._f.fileno(), self._integer_to_bytes(root_address), 0)
+        os.pwrite(self._f.fileno(), self._integer_to_bytes(history_address),
+                  self.HISTORY_OFFSET)
+        os.fsync(self._f.fileno())
+        self.syncs += 2
+
+    def _read_superblock_integer(self, offset):
+        "read an integer of the superblock as other writers left it"
+        if self._view is not None:
+            #the map shares the page cache, so this sees other writers' commits
+            return struct.unpack_from(self.INTEGER_FORMAT, self._view, offset)[0]
+        if self.locked:
+            #our own superblock writes may still be buffered
+            self._f.flush()
+        #a positioned read bypasses the read buffer, which may hold a stale
+        #superblock, without dropping the buffered records
+        return self._bytes_to_integer(
+            os.pread(self._f.fileno(), self.INTEGER_LENGTH, offset))
+
+    def _read_raw(self, address, length):
+        "read bytes at an address as other writers left them"
+        if self._view is not None:
+            if address + length > len(self._view):
+                self._remap()
+            return bytes(self._view[address:address + length])
+        if self.locked:
+            self._f.flush()
+        return os.pread(self._f.fileno(), length, address)
+
+    def _read_bloom_root(self):
+        "return the address of the file's key filter and the root it covers, (0, 0) without one"
+        address = self._read_superblock_integer(self.BLOOM_OFFSET)
+        if not address:
+            return 0, 0
+        return address, self._bytes_to_integer(
+            self._read_raw(address, self.INTEGER_LENGTH))
+
+    def _read_bloom(self, address):
+        "read the BloomFilter of the filter record at address"
+        start = address + self.INTEGER_LENGTH
+        header = self._read_raw(start, BloomFilter.HEADER.size)
+        return BloomFilter.from_bytes(header + self._read_raw(
+            start + len(header), BloomFilter.data_size(header)))
+
+    def _load_bloom(self):
+        "on taking the lock, catch up with filter changes made by other writers"
+        at = self._read_bloom_root()
+        if not at[0]:
+            #a filter given to set_bloom stays until it is committed
+            if self._bloom_at[0]:
+                self.bloom = None
+            return
+        if at != self._bloom_at:
+            self.bloom = self._read_bloom(at[0])
+            self._bloom_at = at
+        #e.g. a writer crashed between updating the filter and the root
+        self.bloom_stale = at[1] != self.get_root_address()
+
+    def set_bloom(self, bloom):
+        """
+        Method that gives the file a new key filter, written at the next commit
+        
+        Parameter
+        ---------
+        
+        bloom: a BloomFilter holding every key of the tree being committed
+        
+        """
+        self.bloom = bloom
+        self.bloom_stale = False
+        self._bloom_at = (0, 0)
+
+    def _store_bloom(self, root_address):
+        "write the filter for a root about to be committed, in place when it is the file's"
+        if self.bloom_stale:
+            raise ValueError('The key filter must be rebuilt before committing.')
+        bloom = self.bloom
+        address = self._bloom_at[0]
+        if address and address == self._read_bloom_root()[0]:
+            #only the pages with new bits, then the root that they cover
+            start = address + self.INTEGER_LENGTH + BloomFilter.HEADER.size
+            for index in sorted(bloom.dirty):
+                self._f.seek(start + index * BLOOM_PAGE_SIZE)
+                self._f.write(bloom.page(index))
+            self._f.seek(address + self.INTEGER_LENGTH)
+            self._f.write(bloom.header())
+            self._f.seek(address)
+            self._write_integer(root_address)
+        else:
+            self._seek_end()
+            address = self._f.tell()
+            self._write_integer(root_address)
+            self._f.write(bloom.to_bytes())
+            self._f.seek(self.BLOOM_OFFSET)
+            self._write_integer(address)
+        bloom.dirty.clear()
+        self._bloom_at = (address, root_address)
+
+    def key_filter(self):
+        """
+        Method that returns the BloomFilter to check keys against before reading the tree, None if there is none to trust
+        
+        Notes
+        -----
+        
+        A writer uses its own filter, which has the keys it has not committed
+        yet. Otherwise the filter is read again whenever another connection
+        has changed it, and only trusted for the root it was written for.
+        
+        """
+        if self.locked:
+            return None if self.bloom_stale else self.bloom
+        at = self._read_bloom_root()
+        if not at[0]:
+            return None
+        if at != self._bloom_at:
+            self.bloom = self._read_bloom(at[0])
+            self._bloom_at = at
+        return self.bloom if at[1] == self.get_root_address() else None
+
     def get_root_address(self):
         #read the first integer in the file
-        #your code here
-        self._seek_superblock()
-        root_address = self._read_integer()
+        root_address = self._read_superblock_integer(0)
+        if root_address == self.RETIRED:
+            raise StorageRetired('The file was replaced by a compacted copy.')
+        if self.locked:
+            #a writer builds on roots still waiting for their group's sync
+            pending_root = self._group.latest_root()
+            if pending_root is not None:
+                return pending_root
         return root_address
 
+    def _append_history(self, root_address):
+        "write the commit record of a root, returning its address"
+        previous = self._history_address()
+        if previous == 0:
+            commit_id = self.first_commit_id
+        elif previous == self._last_commit[0]:
+            commit_id = self._last_commit[1] + 1
+        else:
+            commit_id = self.HISTORY_RECORD.unpack(self.read(previous))[0] + 1
+        address = self.write(self.HISTORY_RECORD.pack(
+            commit_id, time.time(), root_address, previous))
+        self._last_commit = (address, commit_id)
+        return address
+
+    def _history_address(self):
+        "return the address of the newest commit record, zero if there is none"
+        if self.locked:
+            pending_history = self._group.latest_history()
+            if pending_history is not None:
+                return pending_history
+        return self._read_superblock_integer(self.HISTORY_OFFSET)
+
+    def history(self):
+        """
+        Method that yields the file's CommitRecords, newest first
+        
+        Notes
+        -----
+        
+        Compaction writes a file with a single commit, so older records are
+        only reachable through connections opened before it.
+        
+        """
+        address = self._history_address()
+        while address:
+            commit_id, timestamp, root_address, previous = (
+                self.HISTORY_RECORD.unpack(self.read(address)))
+            yield CommitRecord(commit_id, timestamp, root_address, address)
+            address = previous
+
+    def retire(self):
+        "mark the file as replaced, so that other connections reopen its path"
+        self.lock()
+        self._group.drain(self)
+        self._f.flush()
+        self._seek_superblock()
+        self._write_integer(self.RETIRED)
+        self.sync()
+        self.unlock()
+
+    def sync(self):
+        "flush buffered writes and ask the OS to put them on disk"
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.syncs += 1
+
+    def size(self):
+        "return the size of the file in bytes"
+        self._f.flush()
+        return os.fstat(self._f.fileno()).st_size
+
     def close(self):
         self.unlock()
+        if self._map is not None:
+            self._release_map(self._map, self._view)
+            self._map = self._view = None
         self._f.close()
 
     @property
@@ -541,9 +1563,9 @@ class Storage(object):
         
 class it_DBDB(object):
 
-    def __init__(self, f):
-        self._storage = Storage(f)
-        self._tree = BinaryTree(self._storage)
+    def __init__(self, f, cache_size=1024, use_mmap=False):
+        self._storage = Storage(f, use_mmap)
+        self._tree = BinaryTree(self._storage, cache_size)
 
     def _assert_not_closed(self):
         if self._storage.closed:
@@ -568,10 +1590,21 @@ class it_DBDB(object):
         self._assert_not_closed()
         return self._tree.delete(key)
 
-def it_connect(dbname):
+    def range(self, lo=None, hi=None, reverse=False):
+        self._assert_not_closed()
+        return self._tree.range(lo, hi, reverse)
+
+    def items(self):
+        self._assert_not_closed()
+        return self._tree.items()
+
+    def cache_stats(self):
+        return self._tree.cache_stats()
+
+def it_connect(dbname, cache_size=1024, use_mmap=False):
     try:
         f = open(dbname, 'r+b')
     except IOError:
         fd = os.open(dbname, os.O_RDWR | os.O_CREAT)
         f = os.fdopen(fd, 'r+b')
-    return it_DBDB(f)
+    return it_DBDB(f, cache_size, use_mmap)
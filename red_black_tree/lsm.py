@@ -0,0 +1,490 @@
+"""
+Log-structured databases: writes go to memory and are flushed as immutable sorted runs.
+
+A log-structured database is a directory. Sets and deletes are kept in a
+sorted in-memory table until it fills up or is committed, and are then
+written out at once as a new run: an ordinary database file bulk loaded into
+a perfectly balanced red-black tree, with a Bloom filter of its keys beside
+it. Inserts therefore cost the same however large the database grows, since
+no existing tree is walked or rewritten.
+
+Reads look in the memory table, then in the runs from newest to oldest,
+skipping each run whose Bloom filter rules the key out. A background thread
+merges runs of similar sizes into one, so a lookup visits few runs. The
+MANIFEST file lists the live runs and is replaced atomically, so a crash
+leaves either the runs before a flush or merge or those after it:
+
+    db = lsm.connect("/tmp/test.lsm")
+    db.set("a", "1")
+    db.commit()
+"""
+import heapq
+import json
+import os
+import threading
+
+import portalocker
+
+from red_black_tree.bloom import BloomFilter
+from red_black_tree.immutable_tree import WriteBuffer
+from red_black_tree.red_black_tree import bulk_load, connect as connect_file
+from red_black_tree.value_codecs import get_codec
+
+MANIFEST = 'MANIFEST'
+LOCK = 'LOCK'
+#the first byte of each value stored in a run
+TOMBSTONE = b'\x00'
+LIVE = b'\x01'
+
+
+def _sync(path):
+    "flush a written file to disk"
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _merge_pairs(sources, reverse=False):
+    """
+    Function that merges sorted streams of (key, stored value) pairs, keeping the first stream's value of a key.
+
+    Parameters
+    ----------
+
+    sources: iterables of pairs sorted by key, newest first
+    reverse: whether the streams are in descending key order, optional
+
+    """
+    #ties go to the earlier stream, which holds the newer value
+    merged = heapq.merge(*sources, key=lambda pair: pair[0], reverse=reverse)
+    last = None
+    for pair in merged:
+        if last is not None and not (last[0] < pair[0] or pair[0] < last[0]):
+            continue
+        last = pair
+        yield pair
+
+
+class Run(object):
+    """
+    An immutable sorted run: a database file of stored values and the Bloom filter of its keys.
+    """
+
+    def __init__(self, directory, name, cache_size=1024):
+        """
+        The constructor of the class takes for arguments the directory and name of the run
+
+        Parameters
+        ----------
+
+        directory: directory of the log-structured database
+        name: file name of the run
+        cache_size: number of decoded nodes kept in memory, optional
+
+        """
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.db = connect_file(self.path, cache_size, readonly=True)
+        with open(self.path + '.bloom', 'rb') as f:
+            self.bloom = BloomFilter.from_bytes(f.read())
+        self.count = len(self.db)
+
+    def get(self, key, hashes):
+        "return the stored value of key, of BloomFilter hashes, None if the run does not hold it"
+        if not self.bloom.contains_hash(hashes):
+            return None
+        try:
+            return self.db.get(key)
+        except KeyError:
+            return None
+
+
+class LSMDB(object):
+    """
+    Log-structured database of a memory table and immutable sorted runs.
+    """
+    #runs are merged while the next older one is at most this many times
+    #the size of the newer ones together
+    MERGE_RATIO = 2
+
+    def __init__(self, path, memtable_size=65536, max_runs=8,
+                 value_codec=None, compression=None, error_rate=0.01,
+                 cache_size=1024, background=True):
+        """
+        The constructor of the class takes for arguments the directory of the database
+
+        Parameters
+        ----------
+
+        path: directory of the database, created if missing
+        memtable_size: number of keys written in memory before they are flushed to a run, optional
+        max_runs: number of runs above which runs are merged whatever their sizes, optional
+        value_codec: name of the codec the values are stored with, optional
+        compression: None, 'zlib' or 'lzma', for the runs, optional
+        error_rate: false positive rate of the Bloom filter of each run, optional
+        cache_size: number of decoded nodes each run keeps in memory, optional
+        background: whether runs are merged by a background thread, rather than only by merge(), optional
+
+        Attributes
+        ----------
+
+        self._memtable: writes not yet flushed, as a WriteBuffer
+        self._runs: the live runs, newest first; replaced, never changed in place
+        self._lock: guards the runs, the manifest and run names
+        self._merging: held for the whole of a merge, so merges never overlap
+        """
+        if memtable_size < 1 or max_runs < 1:
+            raise ValueError('The memory table and run limit must be positive.')
+        self.path = path
+        self.memtable_size = memtable_size
+        self.max_runs = max_runs
+        self.error_rate = error_rate
+        self._cache_size = cache_size
+        os.makedirs(path, exist_ok=True)
+        #one writer per directory, as one per database file
+        self._lock_file = open(os.path.join(path, LOCK), 'a+b')
+        portalocker.lock(self._lock_file, portalocker.LOCK_EX)
+        self._closed = False
+        self._lock = threading.Lock()
+        self._merging = threading.Lock()
+        try:
+            self._load_manifest(value_codec, compression)
+        except Exception:
+            portalocker.unlock(self._lock_file)
+            self._lock_file.close()
+            raise
+        self._memtable = WriteBuffer()
+        self._merge_error = None
+        self._wake = threading.Event()
+        self._merger = None
+        if background:
+            self._merger = threading.Thread(target=self._merge_forever,
+                                            daemon=True)
+            self._merger.start()
+            self._wake.set()
+
+    def _load_manifest(self, value_codec, compression):
+        "read the runs and settings of the directory, removing unlisted files"
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {'runs': [], 'next_run': 1,
+                        'value_codec': get_codec(value_codec or 'str').name,
+                        'compression': compression}
+        if value_codec is not None and \
+                get_codec(value_codec).name != manifest['value_codec']:
+            raise ValueError('The database stores %s values.' %
+                             manifest['value_codec'])
+        if compression is not None and compression != manifest['compression']:
+            raise ValueError('The database was created with %s compression.' %
+                             manifest['compression'])
+        self._codec = get_codec(manifest['value_codec'])
+        self._compression = manifest['compression']
+        self._next_run = manifest['next_run']
+        listed = set(manifest['runs'])
+        for name in os.listdir(self.path):
+            #runs of a flush or merge cut short by a crash
+            if name.startswith('run-') and \
+                    name.rsplit('.bloom', 1)[0] not in listed:
+                os.remove(os.path.join(self.path, name))
+        self._runs = [Run(self.path, name, self._cache_size)
+                      for name in manifest['runs']]
+        self._write_manifest()
+
+    def _write_manifest(self):
+        "atomically replace the manifest with the current runs"
+        manifest = {'runs': [run.name for run in self._runs],
+                    'next_run': self._next_run,
+                    'value_codec': self._codec.name,
+                    'compression': self._compression}
+        temporary = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, os.path.join(self.path, MANIFEST))
+
+    def _assert_not_closed(self):
+        if self._closed:
+            raise ValueError('Database closed.')
+        if self._merge_error is not None:
+            error, self._merge_error = self._merge_error, None
+            raise error
+
+    def _write_run(self, pairs, capacity, count=None):
+        """
+        Method that writes sorted (key, stored value) pairs to a new run and returns it, None if there were no pairs.
+
+        Parameters
+        ----------
+
+        pairs: iterable of pairs with strictly increasing keys
+        capacity: number of pairs, or an upper bound, to size the Bloom filter
+        count: exact number of pairs, if known, optional
+
+        """
+        with self._lock:
+            name = 'run-%08d.dbdb' % self._next_run
+            self._next_run += 1
+        path = os.path.join(self.path, name)
+        bloom = BloomFilter.for_capacity(capacity, self.error_rate)
+
+        def added(pairs):
+            for pair in pairs:
+                bloom.add(pair[0])
+                yield pair
+
+        count = bulk_load(path, added(pairs), count, value_codec='bytes',
+                          compression=self._compression)
+        if not count:
+            os.remove(path)
+            return None
+        with open(path + '.bloom', 'wb') as f:
+            f.write(bloom.to_bytes())
+        #the manifest may only name runs that are on disk
+        _sync(path)
+        _sync(path + '.bloom')
+        return Run(self.path, name, self._cache_size)
+
+    def _remove_run(self, run):
+        "delete the files of a run no longer in the manifest"
+        #readers still holding the run keep reading the open, unlinked file
+        os.remove(run.path)
+        os.remove(run.path + '.bloom')
+
+    def _encode(self, value):
+        "return the stored form of a memory table value"
+        if value is WriteBuffer.DELETED:
+            return TOMBSTONE
+        return LIVE + bytes(self._codec.encode(value))
+
+    def flush(self):
+        """
+        Method that writes the memory table to a new run.
+
+        """
+        if not len(self._memtable):
+            return
+        pairs = [(key, self._encode(value))
+                 for key, value in self._memtable.range()]
+        run = self._write_run(pairs, len(pairs), len(pairs))
+        with self._lock:
+            self._runs = [run] + self._runs
+            self._write_manifest()
+        self._memtable = WriteBuffer()
+        if self._merger is None:
+            return
+        if len(self._runs) >= 2 * self.max_runs:
+            #merges are falling behind: writes wait rather than reads slowing
+            self.merge()
+        if self._pick_merge(self._runs):
+            self._wake.set()
+
+    def commit(self):
+        "make the writes so far durable, by flushing them to a run"
+        self._assert_not_closed()
+        self.flush()
+
+    def _lookup(self, key):
+        "return the value of key, or raise KeyError"
+        value = self._memtable.lookup(key)
+        if value is WriteBuffer.DELETED:
+            raise KeyError(key)
+        if value is not WriteBuffer.MISSING:
+            return value
+        hashes = BloomFilter.hash_key(key)
+        for run in self._runs:
+            data = run.get(key, hashes)
+            if data is None:
+                continue
+            if data[:1] == TOMBSTONE:
+                raise KeyError(key)
+            return self._codec.decode(data[1:])
+        raise KeyError(key)
+
+    def get(self, key):
+        self._assert_not_closed()
+        return self._lookup(key)
+
+    def __contains__(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def set(self, key, value):
+        self._assert_not_closed()
+        #encoding now reports bad values at the set, not at the flush
+        self._codec.encode(value)
+        self._memtable.put(key, value)
+        if len(self._memtable) >= self.memtable_size:
+            self.flush()
+
+    def set_many(self, pairs):
+        for key, value in pairs:
+            self.set(key, value)
+
+    def delete(self, key):
+        self._assert_not_closed()
+        #raises KeyError for missing keys, as the tree does
+        self._lookup(key)
+        self._memtable.put(key, WriteBuffer.DELETED)
+        if len(self._memtable) >= self.memtable_size:
+            self.flush()
+
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Method that lazily yields the (key, value) pairs with lo <= key < hi in key order.
+
+        Parameters
+        ----------
+
+        lo: smallest key to yield, None for no lower bound, optional
+        hi: key at which to stop, excluded, None for no upper bound, optional
+        reverse: yield the pairs in descending key order, optional
+
+        Notes
+        -----
+
+        The memory table and every run are merged, the newest value of each
+        key winning. The scan sees the writes and runs of when it started.
+
+        """
+        self._assert_not_closed()
+        sources = [[(key, self._encode(value)) for key, value in
+                    self._memtable.range(lo, hi, reverse)]]
+        sources.extend(run.db.range(lo, hi, reverse) for run in self._runs)
+        return ((key, self._codec.decode(data[1:]))
+                for key, data in _merge_pairs(sources, reverse)
+                if data[:1] != TOMBSTONE)
+
+    def items(self):
+        return self.range()
+
+    def __len__(self):
+        "count the live keys, which takes a full scan"
+        return sum(1 for _ in self.range())
+
+    def runs(self):
+        "return the number of keys stored in each run, newest first"
+        return [run.count for run in self._runs]
+
+    def _pick_merge(self, runs):
+        """
+        Method that returns how many of the newest runs should be merged, 0 for none.
+
+        Parameter
+        ---------
+
+        runs: the runs, newest first
+
+        Notes
+        -----
+
+        The newest runs are merged for as long as the next older run is at
+        most MERGE_RATIO times their size together. Run sizes then grow
+        geometrically with age, so there are O(log n) runs and each key is
+        rewritten O(log n) times. Beyond max_runs, older runs are merged too.
+
+        """
+        if len(runs) < 2:
+            return 0
+        total = runs[0].count
+        group = 1
+        while group < len(runs) and \
+                runs[group].count <= self.MERGE_RATIO * total:
+            total += runs[group].count
+            group += 1
+        group = max(group, len(runs) - self.max_runs + 1)
+        return group if group >= 2 else 0
+
+    def merge(self):
+        """
+        Method that merges the newest runs picked by _pick_merge into one, returning whether it did.
+
+        Notes
+        -----
+
+        Runs are immutable, so the merge reads them through connections of
+        its own without holding any lock; flushes meanwhile only add newer
+        runs. Tombstones are dropped when the oldest run is merged, as no
+        older value is left for them to hide.
+
+        """
+        with self._merging:
+            return self._merge()
+
+    def _merge(self):
+        runs = self._runs
+        group = self._pick_merge(runs)
+        if not group:
+            return False
+        merged_runs = runs[:group]
+        keep_tombstones = group < len(runs)
+        sources = [connect_file(run.path, self._cache_size, readonly=True)
+                   for run in merged_runs]
+        try:
+            pairs = _merge_pairs([source.items() for source in sources])
+            if not keep_tombstones:
+                pairs = (pair for pair in pairs if pair[1][:1] != TOMBSTONE)
+            run = self._write_run(pairs, sum(run.count for run in merged_runs))
+        finally:
+            for source in sources:
+                source.close()
+        with self._lock:
+            start = self._runs.index(merged_runs[0])
+            self._runs = self._runs[:start] + ([run] if run else []) + \
+                self._runs[start + group:]
+            self._write_manifest()
+        for old in merged_runs:
+            self._remove_run(old)
+        return True
+
+    def _merge_forever(self):
+        "merge runs whenever woken, until the database is closed"
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._closed:
+                return
+            try:
+                while not self._closed and self.merge():
+                    pass
+            except Exception as error:
+                #reported by the next call on the database
+                self._merge_error = error
+
+    def wait_for_merges(self):
+        "merge in the calling thread until no merge is due"
+        self._assert_not_closed()
+        while self.merge():
+            pass
+
+    def close(self):
+        "stop merging and release the directory; writes not committed are dropped"
+        if self._closed:
+            return
+        self._closed = True
+        if self._merger is not None:
+            self._wake.set()
+            self._merger.join()
+        self._runs = []
+        portalocker.unlock(self._lock_file)
+        self._lock_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def connect(path, memtable_size=65536, max_runs=8, value_codec=None,
+            compression=None, error_rate=0.01, cache_size=1024,
+            background=True):
+    return LSMDB(path, memtable_size, max_runs, value_codec, compression,
+                 error_rate, cache_size, background)
@@ -1,5 +1,13 @@
 from red_black_tree.immutable_tree import *
+from red_black_tree import compression as record_compression
+from red_black_tree.bloom import BloomFilter
+import itertools
 import os
+import struct
+import bisect
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 
 class Color(object):
     """
@@ -10,9 +18,38 @@ class Color(object):
 
 class RedBlackNodeRef(ValueRef):
     """
-    This class produces a reference to a red-black binary search tree node on the disk.   
+    This class produces a reference to a red-black binary search tree node on the disk.
+
+    Nodes are written as fixed-layout records: a version byte, the left, value
+    and right addresses, the sizes of the two subtrees, the color, and a typed,
+    length-prefixed key. A value that encodes to fewer bytes than the storage's
+    inline threshold follows the key inside the record, with a value address
+    of 0, so that reading the node reads the value too. Files whose superblock
+    predates this layout are still read and written as pickle.
+
+    A reference knows the size of the subtree it points to without reading it,
+    either from its in-memory node or from the size stored in the parent record.
     """
-    def __init__(self, referent=None, address=0):
+    cacheable = True
+    __slots__ = ('_size',)
+    #version 3 records may end with an inline value, after the key, in place
+    #of a value address; version 2 records have the same fixed part
+    RECORD_VERSION = 3
+    #version, left, left size, value, right, right size, color, key type, key length
+    RECORD = struct.Struct("!BQQQQQBBI")
+    #version 1 records carry no subtree sizes
+    RECORD_V1 = struct.Struct("!BQQQBBI")
+    #written for a subtree whose size is not known, e.g. one from a pickle file
+    UNKNOWN_SIZE = 2 ** 64 - 1
+    KEY_STR = 0
+    KEY_BYTES = 1
+    KEY_INT = 2
+    KEY_FLOAT = 3
+    KEY_PICKLE = 4
+    INT_KEY = struct.Struct("!q")
+    FLOAT_KEY = struct.Struct("!d")
+
+    def __init__(self, referent=None, address=0, size=None):
         """
         The constructor of the class takes for arguments a referent and address
         
@@ -21,15 +58,38 @@ class RedBlackNodeRef(ValueRef):
         
         referent: value to store for the red-black tree node, optional
         address: target address for the red-black tree node value, optional
+        size: number of nodes in the subtree at address, if known, optional
         
         Attributes
         ----------
         
         self._referent: value
         self._address: address
+        self._size: subtree size
+        """
+        ValueRef.__init__(self, referent, address)
+        self._size = size
+
+    @property
+    def size(self):
+        """
+        Method that returns the number of nodes in the referenced subtree, or None if unknown.
+        
+        """
+        if self._referent is not None:
+            return self._referent.size
+        if not self._address:
+            return 0
+        return self._size
+
+    def release(self):
+        """
+        Method that drops the in-memory node of a stored reference, keeping its address and size.
+        
         """
-        self._referent = referent #value to store
-        self._address = address #address to store at
+        if self._address:
+            self._size = self.size
+            self._referent = None
 
     #calls the BinaryNode's store_refs
     def prepare_to_store(self, storage):
@@ -45,47 +105,176 @@ class RedBlackNodeRef(ValueRef):
         if self._referent:
             self._referent.store_refs(storage)
 
-    @staticmethod
-    def referent_to_bytes(referent):
+    @classmethod
+    def key_to_bytes(cls, key):
         """
-        Method that uses pickle to convert the node to bytes
-        
+        Method that encodes a key, returning its type tag and its bytes
+
         Parameter
         ---------
-        
-        referent: the value to be stored in the node
-        
+
+        key: the key to be encoded
+
         """
-        return pickle.dumps({
-            'left': referent.left_ref.address,
-            'key': referent.key,
-            'value': referent.value_ref.address,
-            'right': referent.right_ref.address,
-            'color': referent.color
-        })
+        if isinstance(key, str):
+            return cls.KEY_STR, key.encode('utf-8')
+        if isinstance(key, bytes):
+            return cls.KEY_BYTES, key
+        if isinstance(key, int) and not isinstance(key, bool) \
+                and -2**63 <= key < 2**63:
+            return cls.KEY_INT, cls.INT_KEY.pack(key)
+        if isinstance(key, float):
+            return cls.KEY_FLOAT, cls.FLOAT_KEY.pack(key)
+        return cls.KEY_PICKLE, pickle.dumps(key)
+
+    @classmethod
+    def bytes_to_key(cls, key_type, data):
+        """
+        Method that decodes a key from its type tag and its bytes
+
+        Parameters
+        ----------
+
+        key_type: the type tag written by key_to_bytes
+        data: the encoded key
 
-    @staticmethod
-    def bytes_to_referent(string):
         """
-        Method that unpickles bytes to obtain a node object
+        if key_type == cls.KEY_STR:
+            return str(data, 'utf-8')
+        if key_type == cls.KEY_BYTES:
+            return bytes(data)
+        if key_type == cls.KEY_INT:
+            return cls.INT_KEY.unpack(data)[0]
+        if key_type == cls.KEY_FLOAT:
+            return cls.FLOAT_KEY.unpack(data)[0]
+        if key_type == cls.KEY_PICKLE:
+            return pickle.loads(data)
+        raise ValueError('Unknown key type %d.' % key_type)
+
+    def store(self, storage, encoded_key=None):
+        """
+        Method that stores bytes for the node to the disk.
         
-        Parameter
-        ---------
+        Parameters
+        ----------
         
-        referent: the value to be stored in the node
+        storage: the storage the node is written to
+        encoded_key: the node's key as returned by key_to_bytes, if already encoded, optional
         
         """
-        d = pickle.loads(string)
+        if self._referent is not None and not self._address:
+            self.prepare_to_store(storage)
+            self._address = storage.write(
+                self.referent_to_bytes(self._referent, storage, encoded_key))
+
+    @classmethod
+    def referent_to_bytes(cls, referent, storage=None, encoded_key=None):
+        """
+        Method that converts the node to bytes in the storage's node format
+
+        Parameters
+        ----------
+
+        referent: the value to be stored in the node
+        storage: the storage the bytes are written to, optional
+        encoded_key: the key as returned by key_to_bytes, if already encoded, optional
+
+        """
+        if storage is not None and storage.node_format == Storage.FORMAT_PICKLE:
+            return pickle.dumps({
+                'left': referent.left_ref.address,
+                'key': referent.key,
+                'value': referent.value_ref.address,
+                'right': referent.right_ref.address,
+                'color': referent.color,
+                'left_size': referent.left_ref.size,
+                'right_size': referent.right_ref.size,
+            })
+        key_type, key = encoded_key or cls.key_to_bytes(referent.key)
+        left_size = referent.left_ref.size
+        right_size = referent.right_ref.size
+        value = referent.value_ref.inline
+        if value is None:
+            value = b''
+        return b''.join([cls.RECORD.pack(
+            cls.RECORD_VERSION,
+            referent.left_ref.address,
+            cls.UNKNOWN_SIZE if left_size is None else left_size,
+            referent.value_ref.address,
+            referent.right_ref.address,
+            cls.UNKNOWN_SIZE if right_size is None else right_size,
+            referent.color,
+            key_type,
+            len(key)), key, value])
+
+    @classmethod
+    def record_length(cls, referent, key):
+        """
+        Method that returns the length of a binary node record without encoding it
+
+        Parameters
+        ----------
+
+        referent: the node, whose value is already stored or inlined
+        key: the key bytes returned by key_to_bytes
+
+        """
+        value = referent.value_ref.inline
+        return cls.RECORD.size + len(key) + (0 if value is None else len(value))
+
+    @classmethod
+    def bytes_to_referent(cls, string, storage=None):
+        """
+        Method that decodes bytes in the storage's node format to obtain a node object
+
+        Parameters
+        ----------
+
+        string: the encoded node
+        storage: the storage the bytes were read from, optional
+
+        """
+        if storage is not None and storage.node_format == Storage.FORMAT_PICKLE:
+            d = pickle.loads(string)
+            return RedBlackNode(
+                RedBlackNodeRef(address=d['left'], size=d.get('left_size')),
+                d['key'],
+                ValueRef(address=d['value']),
+                RedBlackNodeRef(address=d['right'], size=d.get('right_size')),
+                d['color']
+            )
+        version = string[0]
+        if version in (cls.RECORD_VERSION, 2):
+            (_, left, left_size, value, right, right_size, color, key_type,
+             length) = cls.RECORD.unpack_from(string)
+            start = cls.RECORD.size
+        elif version == 1:
+            _, left, value, right, color, key_type, length = \
+                cls.RECORD_V1.unpack_from(string)
+            start = cls.RECORD_V1.size
+            left_size = right_size = cls.UNKNOWN_SIZE
+        else:
+            raise ValueError('Unknown node record version %d.' % version)
+        if left_size == cls.UNKNOWN_SIZE:
+            left_size = None
+        if right_size == cls.UNKNOWN_SIZE:
+            right_size = None
+        if value:
+            value_ref = ValueRef(address=value)
+        else:
+            #the value is decoded from these bytes only when it is asked for
+            value_ref = ValueRef(inline=string[start + length:])
         return RedBlackNode(
-            RedBlackNodeRef(address=d['left']),
-            d['key'],
-            ValueRef(address=d['value']),
-            RedBlackNodeRef(address=d['right']),
-            d['color']
+            RedBlackNodeRef(address=left, size=left_size),
+            cls.bytes_to_key(key_type, string[start:start + length]),
+            value_ref,
+            RedBlackNodeRef(address=right, size=right_size),
+            color
         )
 
 
 class RedBlackNode(BinaryNode):
+    __slots__ = ('color', 'size')
 
     @classmethod
     def from_node(cls, node, **kwargs):
@@ -126,6 +315,7 @@ class RedBlackNode(BinaryNode):
         self.key: value
         self.value_ref: ref address
         self.right_ref: ref address
+        self.size: number of nodes in the subtree, None if a child's size is unknown
         
         """
         self.left_ref = left_ref
@@ -133,6 +323,26 @@ class RedBlackNode(BinaryNode):
         self.value_ref = value_ref
         self.right_ref = right_ref
         self.color = color
+        left_size = left_ref.size
+        right_size = right_ref.size
+        if left_size is None or right_size is None:
+            self.size = None
+        else:
+            self.size = left_size + right_size + 1
+
+    def store_refs(self, storage):
+        """
+        Method that stores the node's value and children, keeping a small value for the node record
+        
+        Parameter
+        ---------
+        
+        storage: the storage at which to store refs
+        
+        """
+        self.value_ref.store(storage, storage.inline_threshold)
+        self.left_ref.store(storage)
+        self.right_ref.store(storage)
 
     def is_black(self):
         """
@@ -153,15 +363,177 @@ class RedBlackNode(BinaryNode):
         return False
 
 
+class BlockWriter(object):
+    """
+    This class writes new nodes in blocks of a few levels, each block stored contiguously within one page.
+    
+    Nodes are added in post-order with their depth. A node belongs to the block
+    rooted at its nearest ancestor whose depth is a multiple of the block
+    levels; when that ancestor is added, the whole block is written at once in
+    the order its nodes were added, so children still precede their parents.
+    A root-to-leaf lookup then touches about one page per block instead of one
+    per node.
+    """
+    PAGE_SIZE = 4096
+
+    def __init__(self, storage, levels=5, release=False):
+        """
+        The constructor of the class takes for arguments the storage written to and the block levels
+        
+        Parameters
+        ----------
+        
+        storage: the storage the nodes are written to
+        levels: number of tree levels per block, 2**levels - 1 nodes should fit a page, optional
+        release: drop each node from memory once written, optional
+        
+        Attributes
+        ----------
+        
+        self._pending: nodes waiting for their block root, per block level
+        """
+        self._storage = storage
+        self.levels = levels
+        self._release = release
+        self._pending = []
+
+    def add(self, ref, depth):
+        """
+        Method that queues a node whose children were added already, writing its block if it is the block's root
+        
+        Parameters
+        ----------
+        
+        ref: reference to the unsaved node
+        depth: depth of the node in the tree being written
+        
+        """
+        level = depth // self.levels
+        while len(self._pending) <= level:
+            self._pending.append([])
+        self._pending[level].append(ref)
+        if depth % self.levels == 0:
+            self._write(self._pending[level])
+            self._pending[level] = []
+
+    def _write(self, block):
+        "write a block, starting a new page first if it would straddle one"
+        if (self._storage.node_format == Storage.FORMAT_BINARY
+                and not self._storage.compression):
+            #binary records have a fixed part and the key, so the block size
+            #is known before the child addresses inside it are
+            keys = [ref.key_to_bytes(ref.get(self._storage).key)
+                    for ref in block]
+            self._storage.align(
+                sum(self._storage.INTEGER_LENGTH +
+                    ref.record_length(ref.get(self._storage), key)
+                    for ref, (_, key) in zip(block, keys)),
+                self.PAGE_SIZE)
+        else:
+            #pickled records grow with the addresses they hold and
+            #compressed ones with their content, so their size is only
+            #known once written; the block is left unaligned
+            keys = [None] * len(block)
+        for ref, encoded_key in zip(block, keys):
+            ref.store(self._storage, encoded_key)
+            if self._release:
+                ref.release()
+
+
 class RedBlackTree(BinaryTree):
+    LAYOUT_DEPTH_FIRST = 'depth_first'
+    LAYOUT_BLOCKED = 'blocked'
+
+    def __init__(self, storage, cache_size=1024, layout=LAYOUT_DEPTH_FIRST,
+                 root_address=None):
+        """
+        The constructor of the class takes for arguments a storage reference
+        
+        Parameters
+        ----------
+        
+        storage: storage reference address, compulsory
+        cache_size: number of decoded nodes kept in memory, 0 disables the cache, optional
+        layout: order in which new nodes are written, 'depth_first' or 'blocked', optional
+        root_address: root the tree is pinned to instead of following commits, optional
+        
+        """
+        if layout not in (self.LAYOUT_DEPTH_FIRST, self.LAYOUT_BLOCKED):
+            raise ValueError('Unknown layout %r.' % (layout,))
+        self._layout = layout
+        self._root_address = root_address
+        self._tree_ref = None
+        BinaryTree.__init__(self, storage, cache_size)
+
+    def _new_writer(self, release=False):
+        """
+        Method that returns the BlockWriter for the tree's layout, or None when nodes are written depth-first.
+        
+        """
+        if self._layout == self.LAYOUT_BLOCKED:
+            return BlockWriter(self._storage, release=release)
+        return None
+
+    def commit(self):
+        """
+        Method to ensure that changes are final only when committed
+        
+        """
+        writer = self._new_writer()
+        if writer is None:
+            BinaryTree.commit(self)
+            return
+        self._store_blocked(self._tree_ref, 0, writer)
+        self._storage.commit_root_address(self._tree_ref.address)
+
+    def _store_blocked(self, ref, depth, writer):
+        """
+        Method that writes the unsaved nodes under a reference through a BlockWriter.
+        
+        """
+        if ref.address:
+            return
+        node = self._follow(ref)
+        if node is None:
+            return
+        node.value_ref.store(self._storage, self._storage.inline_threshold)
+        self._store_blocked(node.left_ref, depth + 1, writer)
+        self._store_blocked(node.right_ref, depth + 1, writer)
+        writer.add(ref, depth)
 
     def _refresh_tree_ref(self):
         """
         Method to get reference to new tree if it has changed
         
         """
-        self._tree_ref = RedBlackNodeRef(
-            address=self._storage.get_root_address())
+        if self._root_address is not None:
+            #a pinned tree never leaves its root, nor reads the superblock
+            address = self._root_address
+        else:
+            address = self._storage.get_root_address()
+        if (self._tree_ref is not None and address
+                and self._tree_ref.address == address):
+            #nothing was committed since, so keep the decoded root
+            return
+        self._tree_ref = RedBlackNodeRef(address=address)
+
+    def pin(self):
+        """
+        Method that makes reads use the current committed root until unpin is called
+        
+        """
+        if self._storage.locked:
+            raise ValueError('Commit changes before pinning the root.')
+        self._root_address = None
+        self._refresh_tree_ref()
+        self._root_address = self._tree_ref.address
+
+    def unpin(self):
+        """
+        Method that makes reads follow new commits again
+        
+        """
+        self._root_address = None
 
     def is_empty(self):
         """
@@ -222,16 +594,9 @@ class RedBlackTree(BinaryTree):
         """    
         
         right = self._follow(node.right_ref)
-        if self._follow(right.left_ref) is not None:
-            newleft_right = RedBlackNode.from_node(self._follow(right.left_ref),
-                                                   left_ref = RedBlackNodeRef(),
-                                                   right_ref = RedBlackNodeRef(),
-                                                   color = node.color)
-            newleft_right_ref = RedBlackNodeRef(referent = newleft_right)
-        else:
-            newleft_right_ref = RedBlackNodeRef()
+        #the right child's left subtree is handed over whole
         newleft = RedBlackNode.from_node(node, 
-                                         right_ref = newleft_right_ref)
+                                         right_ref = right.left_ref)
         newnode = RedBlackNode.from_node(right,
                                          left_ref = RedBlackNodeRef(referent=newleft))
         return newnode
@@ -266,17 +631,9 @@ class RedBlackTree(BinaryTree):
         
         """
         left = self._follow(node.left_ref)
-        if self._follow(left.right_ref) is not None:
-            newright_left = RedBlackNode.from_node(self._follow(left.right_ref),
-                                                   left_ref = RedBlackNodeRef(),
-                                                   right_ref = RedBlackNodeRef(),
-                                                   color = node.color)
-            newright_left_ref = RedBlackNodeRef(referent = newleft_left)
-        else:
-            newright_left_ref = RedBlackNodeRef()
-                                        
+        #the left child's right subtree is handed over whole
         newright = RedBlackNode.from_node(node, 
-                                          left_ref = newright_left_ref)
+                                          left_ref = left.right_ref)
         newnode = RedBlackNode.from_node(left,
                                          right_ref = RedBlackNodeRef(referent=newright))
 
@@ -390,67 +747,1316 @@ class RedBlackTree(BinaryTree):
         node: address
         value_ref: the reference address of the new node as per its new path from the tree root
         
+        Notes
+        -----
+        
+        The search path is recorded on a stack on the way down, and the path
+        is copied bottom-up on the way back. Only a subtree whose new root is
+        red can break the red rule for the levels above it, so balance is
+        called once per level while that is the case, and the rest of the path
+        is copied without any further checks. Replacing the value of an
+        existing key changes no colors and never balances.
+        
         """
-        #create a tree if there was none so far
+        #the search path, as (node, went_left) pairs from the root down
+        path = []
+        while node is not None:
+            if key < node.key:
+                path.append((node, True))
+                node = self._follow(node.left_ref)
+            elif key > node.key:
+                path.append((node, False))
+                node = self._follow(node.right_ref)
+            else:
+                break
         if node is None:
-            #print ('a')
             new_node = RedBlackNode(
-               RedBlackNodeRef(), key, value_ref, RedBlackNodeRef())
-        elif key < node.key:
-            newleft_ref = self._insert(self._follow(node.left_ref), key, value_ref)
-            newleft = self.balance(self._follow(newleft_ref))
-            new_node = self.balance(RedBlackNode.from_node(
-                    node,
-                    left_ref=RedBlackNodeRef(referent=newleft)))
-        elif key > node.key:
-            newright_ref = self._insert(self._follow(node.right_ref), key, value_ref)
-            newright = self.balance(self._follow(newright_ref))
-            new_node = self.balance(RedBlackNode.from_node(
-                    node,
-                    right_ref=RedBlackNodeRef(referent=newright)))
+                RedBlackNodeRef(), key, value_ref, RedBlackNodeRef())
+            fixing = True
         else: #create a new node to represent this data
-            new_node = RedBlackNode.from_node(node, value_ref=value_ref)
-        #new_node = self._blacken(new_node)
+            new_node = RedBlackNode(node.left_ref, node.key, value_ref,
+                                    node.right_ref, node.color)
+            fixing = False
+        for parent, went_left in reversed(path):
+            child_ref = RedBlackNodeRef(referent=new_node)
+            if went_left:
+                new_node = RedBlackNode(child_ref, parent.key, parent.value_ref,
+                                        parent.right_ref, parent.color)
+            else:
+                new_node = RedBlackNode(parent.left_ref, parent.key,
+                                        parent.value_ref, child_ref,
+                                        parent.color)
+            if fixing:
+                new_node = self.balance(new_node)
+                #a black subtree root ends every violation below it
+                fixing = new_node.color == Color.RED
         return RedBlackNodeRef(referent=new_node)
 
+    def _new_ref(self, left_ref, key, value_ref, right_ref, color):
+        """
+        Method that wraps a freshly built node in a reference.
+        
+        """
+        return RedBlackNodeRef(referent=RedBlackNode(
+            left_ref, key, value_ref, right_ref, color))
 
-def connect(dbname):
-    try:
-        f = open(dbname, 'r+b')
-    except IOError:
-        fd = os.open(dbname, os.O_RDWR | os.O_CREAT)
-        f = os.fdopen(fd, 'r+b')
-    return DBDB(f)
+    def _black_height(self, ref):
+        """
+        Method that counts the black nodes on the path from a node to its leftmost leaf.
+        
+        Parameter
+        ---------
+        
+        ref: reference to the root of the subtree
+        
+        """
+        height = 0
+        node = self._follow(ref)
+        while node is not None:
+            if node.color == Color.BLACK:
+                height += 1
+            node = self._follow(node.left_ref)
+        return height
 
+    def _join(self, left_ref, left_height, key, value_ref, right_ref, right_height):
+        """
+        Method that joins two red-black subtrees around a key lying between them.
+        
+        Parameters
+        ----------
+        
+        left_ref: reference to the subtree holding the smaller keys
+        left_height: black height of the left subtree
+        key: the key placed between the two subtrees
+        value_ref: the reference to the key's value
+        right_ref: reference to the subtree holding the larger keys
+        right_height: black height of the right subtree
+        
+        Notes
+        -----
+        
+        Returns the reference to the joined tree and its black height. Only the
+        spine of the taller subtree is copied, down to the depth where the black
+        heights match, so the cost is proportional to the difference in heights.
+        Subtrees that are not on that spine are shared with the inputs.
+        
+        """
+        if left_height > right_height:
+            right_ref, right_height = self._blacken_ref(right_ref, right_height)
+        elif right_height > left_height:
+            left_ref, left_height = self._blacken_ref(left_ref, left_height)
+        if left_height == right_height:
+            if self._isred(self._follow(left_ref)) or \
+                    self._isred(self._follow(right_ref)):
+                return self._new_ref(left_ref, key, value_ref, right_ref,
+                                     Color.BLACK), left_height + 1
+            return self._new_ref(left_ref, key, value_ref, right_ref,
+                                 Color.RED), left_height
+        if left_height > right_height:
+            ref = self._join_right(left_ref, left_height, key, value_ref,
+                                   right_ref, right_height)
+            height = left_height
+            node = self._follow(ref)
+            if node.color == Color.RED and self._isred(self._follow(node.right_ref)):
+                ref, height = self._blacken_ref(ref, height)
+        else:
+            ref = self._join_left(right_ref, right_height, key, value_ref,
+                                  left_ref, left_height)
+            height = right_height
+            node = self._follow(ref)
+            if node.color == Color.RED and self._isred(self._follow(node.left_ref)):
+                ref, height = self._blacken_ref(ref, height)
+        return ref, height
 
-class DBDB(object):
+    def _blacken_ref(self, ref, height):
+        """
+        Method that makes the root of a subtree black, returning its reference and black height.
+        
+        """
+        node = self._follow(ref)
+        if not self._isred(node):
+            return ref, height
+        return self._blacken(node), height + 1
 
-    def __init__(self, f):
-        self._storage = Storage(f)
-        self._tree = RedBlackTree(self._storage)
+    def _join_right(self, ref, height, key, value_ref, right_ref, right_height):
+        """
+        Method that descends the right spine of the taller tree to hang the shorter one.
+        
+        """
+        node = self._follow(ref)
+        if height == right_height and not self._isred(node):
+            return self._new_ref(ref, key, value_ref, right_ref, Color.RED)
+        child_height = height - 1 if node.color == Color.BLACK else height
+        new_right = self._join_right(node.right_ref, child_height, key,
+                                     value_ref, right_ref, right_height)
+        right = self._follow(new_right)
+        if node.color == Color.BLACK and right.color == Color.RED:
+            right_right = self._follow(right.right_ref)
+            if self._isred(right_right):
+                #two reds in a row below a black node: rotate left
+                newleft = self._new_ref(node.left_ref, node.key, node.value_ref,
+                                        right.left_ref, Color.BLACK)
+                return self._new_ref(newleft, right.key, right.value_ref,
+                                     self._blacken(right_right), Color.RED)
+        return RedBlackNodeRef(referent=RedBlackNode.from_node(
+            node, right_ref=new_right))
 
-    def _assert_not_closed(self):
-        if self._storage.closed:
-            raise ValueError('Database closed.')
+    def _join_left(self, ref, height, key, value_ref, left_ref, left_height):
+        """
+        Method that descends the left spine of the taller tree to hang the shorter one.
+        
+        """
+        node = self._follow(ref)
+        if height == left_height and not self._isred(node):
+            return self._new_ref(left_ref, key, value_ref, ref, Color.RED)
+        child_height = height - 1 if node.color == Color.BLACK else height
+        new_left = self._join_left(node.left_ref, child_height, key,
+                                   value_ref, left_ref, left_height)
+        left = self._follow(new_left)
+        if node.color == Color.BLACK and left.color == Color.RED:
+            left_left = self._follow(left.left_ref)
+            if self._isred(left_left):
+                #two reds in a row below a black node: rotate right
+                newright = self._new_ref(left.right_ref, node.key, node.value_ref,
+                                         node.right_ref, Color.BLACK)
+                return self._new_ref(self._blacken(left_left), left.key,
+                                     left.value_ref, newright, Color.RED)
+        return RedBlackNodeRef(referent=RedBlackNode.from_node(
+            node, left_ref=new_left))
 
-    def close(self):
-        self._storage.close()
+    @staticmethod
+    def _balanced_shape(count):
+        """
+        Method that returns the black height of a balanced tree of count nodes and the depth of its red level.
+        
+        Notes
+        -----
+        
+        A tree whose subtree sizes differ by at most one at every node has its
+        first floor(log2(count + 1)) levels full. Coloring the nodes of the
+        incomplete level below them red, and every other node black, gives
+        every path the same black height. The red depth is -1 when the tree
+        is perfect.
+        
+        """
+        full_levels = (count + 1).bit_length() - 1
+        red_depth = -1 if 2 ** full_levels - 1 == count else full_levels
+        return full_levels, red_depth
 
-    def commit(self):
-        self._assert_not_closed()
-        self._tree.commit()
+    def _build(self, items, lo, hi, depth, red_depth):
+        """
+        Method that builds a balanced subtree from a sorted slice of (key, value_ref) pairs.
+        
+        Parameters
+        ----------
+        
+        items: list of (key, value_ref) pairs sorted by key
+        lo: index of the first pair of the slice
+        hi: index past the last pair of the slice
+        depth: depth of the subtree's root
+        red_depth: depth of the incomplete last level, whose nodes are red
+        
+        """
+        if lo == hi:
+            return RedBlackNodeRef()
+        mid = (lo + hi) // 2
+        key, value_ref = items[mid]
+        return self._new_ref(
+            self._build(items, lo, mid, depth + 1, red_depth),
+            key, value_ref,
+            self._build(items, mid + 1, hi, depth + 1, red_depth),
+            Color.RED if depth == red_depth else Color.BLACK)
 
-    def get(self, key):
-        self._assert_not_closed()
-        return self._tree.get(key)
+    def _union(self, ref, height, items, keys, lo, hi):
+        """
+        Method that merges a sorted slice of (key, value_ref) pairs into a subtree.
+        
+        Parameters
+        ----------
+        
+        ref: reference to the root of the subtree
+        height: black height of the subtree
+        items: list of (key, value_ref) pairs sorted by key
+        keys: the keys of items, for bisection
+        lo: index of the first pair of the slice
+        hi: index past the last pair of the slice
+        
+        Notes
+        -----
+        
+        The slice is split around each node's key on the way down, so every
+        node is visited at most once for the whole batch and subtrees that
+        receive no keys are shared untouched. Subtrees are joined back on the
+        way up, and empty positions receive a balanced tree built directly
+        from the remaining pairs.
+        
+        """
+        if lo == hi:
+            return ref, height
+        node = self._follow(ref)
+        if node is None:
+            count = hi - lo
+            full_levels, red_depth = self._balanced_shape(count)
+            return self._build(items, lo, hi, 0, red_depth), full_levels
+        split = bisect.bisect_left(keys, node.key, lo, hi)
+        found = split < hi and keys[split] == node.key
+        child_height = height - 1 if node.color == Color.BLACK else height
+        left_ref, left_height = self._union(
+            node.left_ref, child_height, items, keys, lo, split)
+        right_ref, right_height = self._union(
+            node.right_ref, child_height, items, keys, split + found, hi)
+        value_ref = items[split][1] if found else node.value_ref
+        return self._join(left_ref, left_height, node.key, value_ref,
+                          right_ref, right_height)
 
-    def set(self, key, value):
-        self._assert_not_closed()
-        return self._tree.set(key, value)
+    def set_many(self, pairs):
+        """
+        Method that sets many values in the tree in a single pass. Since the tree is immutable, a new tree is created.
+        
+        Parameter
+        ---------
+        
+        pairs: iterable of (key, value) pairs; for a repeated key the last value wins
+        
+        """
+        #a stable sort keeps repeated keys in the order given, so the last
+        #pair of each run of equal keys is the one to keep; keys need only
+        #be orderable, as in set, not hashable
+        batch = sorted(pairs, key=lambda pair: pair[0])
+        items = []
+        for i, (key, value) in enumerate(batch):
+            if i + 1 < len(batch) and not key < batch[i + 1][0]:
+                continue
+            items.append((key, ValueRef(value)))
+        keys = [key for key, _ in items]
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        tree_ref, height = self._union(
+            self._tree_ref, self._black_height(self._tree_ref),
+            items, keys, 0, len(items))
+        self._tree_ref, _ = self._blacken_ref(tree_ref, height)
 
-    def getRootKey(self):
-        return self._tree.rootkey()
+    def get_many(self, keys, default=None, strict=False):
+        """
+        Method that looks up many keys in a single descent of the tree.
+        
+        Parameters
+        ----------
+        
+        keys: sequence of keys, or a NumPy array of keys
+        default: value returned for keys that are not in the tree, optional
+        strict: throw a KeyError for the first missing key instead of returning default, optional
+        
+        Notes
+        -----
+        
+        The keys are sorted and, as in _union, the sorted slice is split
+        around each node's key on the way down, so a node on the path of
+        several keys is followed and decoded once for the whole batch, and so
+        is the value of a repeated key. Returns a list of the values in the
+        order of keys.
+        
+        """
+        keys, order, sorted_keys = self._sort_batch(keys)
+        values = [default] * len(order)
+        missing = []
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        stack = [(self._tree_ref, 0, len(order))]
+        while stack:
+            ref, lo, hi = stack.pop()
+            if lo == hi:
+                continue
+            node = self._follow(ref)
+            if node is None:
+                missing.extend(range(lo, hi))
+                continue
+            split = bisect.bisect_left(sorted_keys, node.key, lo, hi)
+            end = bisect.bisect_right(sorted_keys, node.key, split, hi)
+            if split < end:
+                value = self._follow(node.value_ref)
+                for i in range(split, end):
+                    values[order[i]] = value
+            stack.append((node.right_ref, end, hi))
+            stack.append((node.left_ref, lo, split))
+        if strict and missing:
+            raise KeyError(keys[min(order[i] for i in missing)])
+        return values
 
-    def delete(self, key):
-        self._assert_not_closed()
-        return self._tree.delete(key)
+    def load_sorted(self, pairs, count=None):
+        """
+        Method that fills an empty tree from pairs sorted by key, writing nodes as they are built.
+        
+        Parameters
+        ----------
+        
+        pairs: iterable of (key, value) pairs with strictly increasing keys
+        count: number of pairs, taken from len(pairs) when available, optional
+        
+        Notes
+        -----
+        
+        When the number of pairs is known the tree is built perfectly balanced:
+        the subtree sizes differ by at most one at every node, and only the
+        nodes of an incomplete last level are red. Otherwise the pairs are
+        consumed like a binary counter, where levels[h] holds a perfect,
+        all-black subtree of black height h followed by one pending pair, and
+        the remaining subtrees are joined from the shortest up at the end.
+        
+        Either way every node is written to storage once, after its children,
+        only O(log n) nodes are held in memory, and the root is committed once.
+        Returns the number of pairs loaded.
+        
+        """
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        if self._follow(self._tree_ref) is not None:
+            raise ValueError('The tree is not empty.')
+        if count is None and hasattr(pairs, '__len__'):
+            count = len(pairs)
+        stream = self._stored_pairs(pairs)
+        if count is not None:
+            _, red_depth = self._balanced_shape(count)
+            self._tree_ref = self._build_stream(
+                stream, count, 0, red_depth, self._new_writer(release=True))
+            if next(stream, None) is not None:
+                raise ValueError('More than %d pairs were given.' % count)
+        else:
+            count = self._load_unsized(stream)
+        self.commit()
+        return count
+
+    def lock_for_writing(self):
+        """
+        Method that takes the writer lock, loading the latest committed root unless it was held already.
+        
+        """
+        if self._storage.lock():
+            self._refresh_tree_ref()
+
+    def copy_to(self, storage, layout=None):
+        """
+        Method that writes the reachable part of the tree to another storage and commits it there.
+        
+        Parameters
+        ----------
+        
+        storage: an empty storage receiving the copy
+        layout: order in which the copy's nodes are written, defaults to the tree's layout, optional
+        
+        Notes
+        -----
+        
+        Keys are streamed in order into a perfectly balanced tree, so each
+        subtree of the copy is stored contiguously, children before parents.
+        Value records are copied as raw bytes without being decoded. Returns
+        the number of keys copied.
+        
+        """
+        target = RedBlackTree(storage, cache_size=0, layout=layout or self._layout)
+        if target._follow(target._tree_ref) is not None:
+            raise ValueError('The target storage is not empty.')
+        count = self._size(self._tree_ref)
+        _, red_depth = self._balanced_shape(count)
+        stream = ((node.key, self._copy_value(node.value_ref, storage))
+                  for node in self._walk(self._tree_ref))
+        target._tree_ref = target._build_stream(
+            stream, count, 0, red_depth, target._new_writer(release=True))
+        target.commit()
+        return count
+
+    def sample_values(self, samples):
+        """
+        Method that returns the stored bytes of about samples values spread evenly over the keys.
+        
+        Parameter
+        ---------
+        
+        samples: number of values wanted
+        
+        """
+        step = max(self._size(self._tree_ref) // max(samples, 1), 1)
+        return [self._value_bytes(node.value_ref)
+                for i, node in enumerate(self._walk(self._tree_ref))
+                if i % step == 0][:samples]
+
+    def _store_node(self, left_ref, key, value_ref, right_ref, color,
+                    depth=None, writer=None):
+        """
+        Method that writes a node whose children are already written, returning an address-only reference.
+        
+        Notes
+        -----
+        
+        With a BlockWriter the node is queued at its depth instead, and the
+        writer releases it from memory once its block is written.
+        
+        """
+        node_ref = self._new_ref(left_ref, key, value_ref, right_ref, color)
+        if writer is not None:
+            writer.add(node_ref, depth)
+            return node_ref
+        node_ref.store(self._storage)
+        #keep only the address so that written nodes can be freed
+        return RedBlackNodeRef(address=node_ref.address, size=node_ref.size)
+
+    def _build_stream(self, stream, count, depth, red_depth, writer=None):
+        """
+        Method that builds and writes a balanced subtree from the next count pairs of a stream.
+        
+        """
+        if count == 0:
+            return RedBlackNodeRef()
+        left_count = (count - 1) // 2
+        left_ref = self._build_stream(stream, left_count, depth + 1, red_depth,
+                                      writer)
+        pair = next(stream, None)
+        if pair is None:
+            raise ValueError('Fewer pairs than announced were given.')
+        key, value_ref = pair
+        right_ref = self._build_stream(stream, count - 1 - left_count,
+                                       depth + 1, red_depth, writer)
+        return self._store_node(left_ref, key, value_ref, right_ref,
+                                Color.RED if depth == red_depth else Color.BLACK,
+                                depth, writer)
+
+    def _load_unsized(self, stream):
+        """
+        Method that builds the tree from a stream of unknown length, returning the number of pairs.
+        
+        """
+        levels = []
+        count = 0
+        for key, value_ref in stream:
+            count += 1
+            carry = RedBlackNodeRef()
+            height = 0
+            while height < len(levels) and levels[height] is not None:
+                left_ref, left_key, left_value_ref = levels[height]
+                levels[height] = None
+                carry = self._store_node(left_ref, left_key, left_value_ref,
+                                         carry, Color.BLACK)
+                height += 1
+            if height == len(levels):
+                levels.append(None)
+            levels[height] = (carry, key, value_ref)
+        tree_ref, tree_height = RedBlackNodeRef(), 0
+        for height, level in enumerate(levels):
+            if level is not None:
+                left_ref, key, value_ref = level
+                tree_ref, tree_height = self._join(
+                    left_ref, height, key, value_ref, tree_ref, tree_height)
+        self._tree_ref, _ = self._blacken_ref(tree_ref, tree_height)
+        return count
+
+    def delete(self, key):
+        """
+        Method that deletes the node of a key. Since the tree is immutable, a new tree is created.
+        
+        Parameter
+        ---------
+        
+        key: a lookup value that will throw a KeyError if it doesn't exist in the tree
+        
+        Notes
+        -----
+        
+        The tree above the removed key is rebuilt with joins on the way back up,
+        which keep every path at the same black height. Neighbouring subtrees
+        differ by at most one in black height, so each join copies O(1) nodes
+        and a deletion creates O(log n) new nodes in total.
+        
+        """
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        tree_ref, height = self._remove(
+            self._tree_ref, self._black_height(self._tree_ref), key)
+        self._tree_ref, _ = self._blacken_ref(tree_ref, height)
+
+    def _remove(self, ref, height, key):
+        """
+        Method that removes a key from a subtree, returning the new subtree and its black height.
+        
+        Parameters
+        ----------
+        
+        ref: reference to the root of the subtree
+        height: black height of the subtree
+        key: a lookup value
+        
+        """
+        node = self._follow(ref)
+        if node is None:
+            raise KeyError
+        child_height = height - 1 if node.color == Color.BLACK else height
+        if key < node.key:
+            left_ref, left_height = self._remove(node.left_ref, child_height, key)
+            return self._join(left_ref, left_height, node.key, node.value_ref,
+                              node.right_ref, child_height)
+        elif key > node.key:
+            right_ref, right_height = self._remove(node.right_ref, child_height, key)
+            return self._join(node.left_ref, child_height, node.key,
+                              node.value_ref, right_ref, right_height)
+        if self._follow(node.left_ref) is None:
+            return node.right_ref, child_height
+        #the largest key on the left takes the place of the removed one
+        left_ref, left_height, last_key, last_value_ref = self._remove_last(
+            node.left_ref, child_height)
+        return self._join(left_ref, left_height, last_key, last_value_ref,
+                          node.right_ref, child_height)
+
+    def _remove_last(self, ref, height):
+        """
+        Method that removes the largest key of a non-empty subtree.
+        
+        Notes
+        -----
+        
+        Returns the new subtree, its black height, and the removed key and value reference.
+        
+        """
+        node = self._follow(ref)
+        child_height = height - 1 if node.color == Color.BLACK else height
+        if self._follow(node.right_ref) is None:
+            return node.left_ref, child_height, node.key, node.value_ref
+        right_ref, right_height, key, value_ref = self._remove_last(
+            node.right_ref, child_height)
+        tree_ref, tree_height = self._join(node.left_ref, child_height, node.key,
+                                           node.value_ref, right_ref, right_height)
+        return tree_ref, tree_height, key, value_ref
+
+    def _size(self, ref):
+        """
+        Method that returns the number of nodes under a reference.
+        
+        Parameter
+        ---------
+        
+        ref: reference to the root of the subtree
+        
+        Notes
+        -----
+        
+        Sizes are read from the reference without visiting the subtree. Only
+        subtrees written without sizes, such as pickle-format ones, are counted.
+        
+        """
+        size = ref.size
+        if size is None:
+            node = self._follow(ref)
+            size = node.size
+            if size is None:
+                size = self._size(node.left_ref) + self._size(node.right_ref) + 1
+        return size
+
+    def __len__(self):
+        """
+        Method that returns the number of keys in the tree.
+        
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        return self._size(self._tree_ref)
+
+    def rank(self, key):
+        """
+        Method that returns the number of keys smaller than a key, whether or not the key is present.
+        
+        Parameter
+        ---------
+        
+        key: a lookup value
+        
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        rank = 0
+        node = self._follow(self._tree_ref)
+        while node is not None:
+            if key < node.key:
+                node = self._follow(node.left_ref)
+            elif key > node.key:
+                rank += self._size(node.left_ref) + 1
+                node = self._follow(node.right_ref)
+            else:
+                return rank + self._size(node.left_ref)
+        return rank
+
+    def select(self, index):
+        """
+        Method that returns the key at a position in key order, counting from 0.
+        
+        Parameter
+        ---------
+        
+        index: position of the key, negative values count from the end; an IndexError is thrown if it is out of range
+        
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        size = self._size(self._tree_ref)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('Index out of range.')
+        node = self._follow(self._tree_ref)
+        while True:
+            left_size = self._size(node.left_ref)
+            if index < left_size:
+                node = self._follow(node.left_ref)
+            elif index > left_size:
+                index -= left_size + 1
+                node = self._follow(node.right_ref)
+            else:
+                return node.key
+
+    def count(self, lo=None, hi=None):
+        """
+        Method that returns the number of keys with lo <= key < hi.
+        
+        Parameters
+        ----------
+        
+        lo: smallest key counted, None for no lower bound, optional
+        hi: key at which to stop counting, excluded, None for no upper bound, optional
+        
+        """
+        upper = len(self) if hi is None else self.rank(hi)
+        lower = 0 if lo is None else self.rank(lo)
+        return max(upper - lower, 0)
+
+    def validate(self):
+        """
+        Method that checks the red-black invariants of the whole tree.
+        
+        Notes
+        -----
+        
+        Raises ValueError when the keys are out of order, the root is red, a
+        red node has a red child, two paths have different black heights or a
+        stored subtree size is wrong.
+        Otherwise returns the number of keys, the height and the black height.
+        
+        """
+        root = self._follow(self._tree_ref)
+        if self._isred(root):
+            raise ValueError('The root is red.')
+        size, height, black_height = self._validate(root, None, None)
+        return {'size': size, 'height': height, 'black_height': black_height}
+
+    def _validate(self, node, lo, hi):
+        """
+        Method that checks the subtree under a node, returning its size, height and black height.
+        
+        """
+        if node is None:
+            return 0, 0, 0
+        if (lo is not None and not lo < node.key) or \
+                (hi is not None and not node.key < hi):
+            raise ValueError('Key %r is out of order.' % (node.key,))
+        left = self._follow(node.left_ref)
+        right = self._follow(node.right_ref)
+        if node.color == Color.RED and (self._isred(left) or self._isred(right)):
+            raise ValueError('Red node %r has a red child.' % (node.key,))
+        left_size, left_height, left_black = self._validate(left, lo, node.key)
+        right_size, right_height, right_black = self._validate(right, node.key, hi)
+        if left_black != right_black:
+            raise ValueError('Black heights differ under %r.' % (node.key,))
+        if node.size is not None and node.size != left_size + right_size + 1:
+            raise ValueError('Wrong subtree size at %r.' % (node.key,))
+        return (left_size + right_size + 1,
+                max(left_height, right_height) + 1,
+                left_black + (node.color == Color.BLACK))
+
+
+#the trees a file can be stored as, recorded as its node format
+ENGINE_REDBLACK = 'redblack'
+ENGINE_BTREE = 'btree'
+ENGINE_FORMATS = {None: None, ENGINE_REDBLACK: Storage.FORMAT_BINARY,
+                  ENGINE_BTREE: Storage.FORMAT_BTREE}
+
+
+def engine_of(storage):
+    "return the engine a storage's file was created with"
+    if storage.node_format == Storage.FORMAT_BTREE:
+        return ENGINE_BTREE
+    return ENGINE_REDBLACK
+
+
+def open_tree(storage, cache_size=1024, layout=RedBlackTree.LAYOUT_DEPTH_FIRST,
+              root_address=None):
+    """
+    Function that returns the tree reading a storage, of the engine its file was created with.
+    
+    Parameters
+    ----------
+    
+    storage: the storage of the database
+    cache_size: number of decoded nodes or pages kept in memory, optional
+    layout: order in which new red-black nodes are written, optional
+    root_address: root the tree is pinned to instead of following commits, optional
+    
+    """
+    if engine_of(storage) == ENGINE_BTREE:
+        #imported here since the B+tree module builds on this one
+        from red_black_tree.btree import BTree
+        return BTree(storage, cache_size, root_address=root_address)
+    return RedBlackTree(storage, cache_size, layout, root_address)
+
+
+def connect(dbname, cache_size=1024, use_mmap=False,
+            layout=RedBlackTree.LAYOUT_DEPTH_FIRST,
+            durability=Storage.DURABILITY_FLUSH, value_codec=None,
+            compression=None, compress_threshold=64, inline_threshold=64,
+            readonly=False, engine=None, write_buffer=False,
+            bloom_filter=False):
+    if readonly:
+        #readers never lock, so they need an existing file
+        f = open(dbname, 'rb')
+    else:
+        try:
+            f = open(dbname, 'r+b')
+        except IOError:
+            fd = os.open(dbname, os.O_RDWR | os.O_CREAT)
+            f = os.fdopen(fd, 'r+b')
+    return DBDB(f, cache_size, use_mmap, path=dbname, layout=layout,
+                durability=durability, value_codec=value_codec,
+                compression=compression, compress_threshold=compress_threshold,
+                inline_threshold=inline_threshold, engine=engine,
+                write_buffer=write_buffer, bloom_filter=bloom_filter)
+
+
+#values a compression dictionary is trained on
+DICTIONARY_SAMPLES = 1000
+
+
+def bulk_load(dbname, sorted_iterable, count=None, cache_size=1024,
+              layout=RedBlackTree.LAYOUT_DEPTH_FIRST, value_codec=None,
+              compression=None, compress_threshold=64, inline_threshold=64,
+              engine=None):
+    """
+    Function that builds a new database from (key, value) pairs sorted by key.
+    
+    Parameters
+    ----------
+    
+    dbname: path of the database, which must be empty
+    sorted_iterable: iterable of (key, value) pairs with strictly increasing keys
+    count: number of pairs, needed for a perfectly balanced tree when sorted_iterable has no len(), optional
+    cache_size: number of decoded nodes kept in memory while joining, optional
+    layout: order in which nodes are written, 'depth_first' or 'blocked', optional
+    value_codec: name of the codec the values are stored with, optional
+    compression: None, 'zlib' or 'lzma', optional
+    compress_threshold: records shorter than this many bytes are stored uncompressed, optional
+    inline_threshold: values encoding to fewer bytes are stored inside their node record, optional
+    engine: 'redblack' or 'btree', optional
+    
+    Notes
+    -----
+    
+    The tree is built bottom-up in O(n), streaming each node to storage once
+    and committing the root once at the end. Memory use is bounded by the
+    height of the tree rather than by the number of pairs.
+    
+    With zlib compression, a dictionary is first trained on the leading
+    DICTIONARY_SAMPLES values and stored in the file.
+    
+    Returns the number of pairs loaded.
+    
+    """
+    db = connect(dbname, cache_size, layout=layout, value_codec=value_codec,
+                 compression=compression, compress_threshold=compress_threshold,
+                 inline_threshold=inline_threshold, engine=engine)
+    try:
+        if db._storage.compression == record_compression.ZLIB:
+            if count is None and hasattr(sorted_iterable, '__len__'):
+                count = len(sorted_iterable)
+            pairs = iter(sorted_iterable)
+            sample = list(itertools.islice(pairs, DICTIONARY_SAMPLES))
+            encode = db._storage.value_codec.encode
+            db._storage.set_dictionary(record_compression.train_dictionary(
+                [encode(value) for _, value in sample]))
+            sorted_iterable = itertools.chain(sample, pairs)
+        return db._tree.load_sorted(sorted_iterable, count)
+    finally:
+        db.close()
+
+
+CompactionStats = namedtuple(
+    'CompactionStats', ['keys', 'bytes_before', 'bytes_after',
+                        'bytes_reclaimed', 'elapsed'])
+
+
+class Snapshot(object):
+    """
+    Read-only view of a database as it was at one commit.
+    
+    A snapshot reads the file through its own handle and never takes the
+    writer lock, so it is not blocked by writers and sees none of their
+    later commits. Since records are never overwritten, it stays valid
+    after the database is compacted.
+    """
+
+    def __init__(self, f, record, cache_size=1024, use_mmap=False):
+        """
+        The constructor of the class takes for arguments an open file and the commit to read
+        
+        Parameters
+        ----------
+        
+        f: the database file, opened for reading
+        record: the CommitRecord of the commit, or None for an empty database
+        cache_size: number of decoded nodes kept in memory, optional
+        use_mmap: read through a memory map of the file, optional
+        
+        """
+        self._storage = Storage(f, use_mmap)
+        self.commit_id = record.commit_id if record else None
+        self.timestamp = record.timestamp if record else None
+        self.root_address = record.root_address if record else 0
+        self._tree = open_tree(self._storage, cache_size,
+                               root_address=self.root_address)
+
+    def _assert_not_closed(self):
+        if self._storage.closed:
+            raise ValueError('Snapshot closed.')
+
+    def close(self):
+        self._storage.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, key):
+        self._assert_not_closed()
+        return self._tree.get(key)
+
+    def get_many(self, keys, default=None, strict=False):
+        self._assert_not_closed()
+        return self._tree.get_many(keys, default, strict)
+
+    def range(self, lo=None, hi=None, reverse=False):
+        self._assert_not_closed()
+        return self._tree.range(lo, hi, reverse)
+
+    def items(self):
+        self._assert_not_closed()
+        return self._tree.items()
+
+    def rank(self, key):
+        self._assert_not_closed()
+        return self._tree.rank(key)
+
+    def select(self, index):
+        self._assert_not_closed()
+        return self._tree.select(index)
+
+    def count(self, lo=None, hi=None):
+        self._assert_not_closed()
+        return self._tree.count(lo, hi)
+
+    def __len__(self):
+        self._assert_not_closed()
+        return len(self._tree)
+
+
+class DBDB(object):
+    #key filters are sized for twice the keys of the tree, and at least
+    #this many, and rebuilt once that many keys have been added
+    BLOOM_MIN_CAPACITY = 1024
+    BLOOM_ERROR_RATE = 0.01
+
+    def __init__(self, f, cache_size=1024, use_mmap=False, path=None,
+                 layout=RedBlackTree.LAYOUT_DEPTH_FIRST,
+                 durability=Storage.DURABILITY_FLUSH, value_codec=None,
+                 compression=None, compress_threshold=64, inline_threshold=64,
+                 engine=None, write_buffer=False, bloom_filter=False):
+        if engine not in ENGINE_FORMATS:
+            raise ValueError('Unknown engine %r.' % (engine,))
+        self._path = path
+        self._cache_size = cache_size
+        self._use_mmap = use_mmap
+        self._layout = layout
+        self._durability = durability
+        self._value_codec = value_codec
+        self._compression = compression
+        self._compress_threshold = compress_threshold
+        self._inline_threshold = inline_threshold
+        #the engine a new file is created with; an existing file keeps its own
+        self._engine = engine
+        self._commit_stats = CommitStats()
+        #reads inside read_transaction() use the root pinned at its start
+        self._pinned = False
+        #with a write buffer, sets and deletes reach the tree only when it
+        #is merged in, at commit or before a read that needs the tree
+        self._buffer = WriteBuffer() if write_buffer else None
+        #whether the file gets a key filter at the next commit; once it has
+        #one, every writer keeps it up to date
+        self._bloom_filter = bloom_filter
+        self._open(f)
+
+    def _open(self, f):
+        self._storage = Storage(f, self._use_mmap, self._durability,
+                                self._value_codec, self._compression,
+                                self._compress_threshold,
+                                self._inline_threshold,
+                                ENGINE_FORMATS[self._engine])
+        engine = engine_of(self._storage)
+        if self._engine not in (None, engine):
+            self._storage.close()
+            raise ValueError('The file was created with the %s engine.' %
+                             engine)
+        try:
+            self._tree = open_tree(self._storage, self._cache_size,
+                                   self._layout)
+        except StorageRetired:
+            #the file was swapped out between opening and reading it
+            self._reopen()
+
+    def _reopen(self):
+        "follow the path to the file that replaced a retired one"
+        if self._path is None:
+            raise ValueError('Database file was replaced; reconnect by path.')
+        readonly = self._storage.readonly
+        self._storage.close()
+        self._open(open(self._path, 'rb' if readonly else 'r+b'))
+
+    def _call(self, method, *args):
+        "run a tree method, reopening the file first if it was compacted"
+        self._assert_not_closed()
+        try:
+            return getattr(self._tree, method)(*args)
+        except StorageRetired:
+            self._reopen()
+            return getattr(self._tree, method)(*args)
+
+    def _assert_not_closed(self):
+        if self._storage.closed:
+            raise ValueError('Database closed.')
+
+    def _assert_writable(self):
+        self._assert_not_closed()
+        if self._pinned:
+            raise ValueError('Cannot write inside a read transaction.')
+
+    def close(self):
+        if self._buffer:
+            #uncommitted writes are dropped, as those in the tree are
+            self._buffer.drain()
+        self._storage.close()
+
+    @contextmanager
+    def read_transaction(self):
+        """
+        Method that pins the committed root for the reads of a with block.
+        
+        Notes
+        -----
+        
+        Reads in the block see the database as it was when the block started:
+        they neither look at the superblock nor see later commits, and never
+        wait for a writer. Writes are refused until the block ends.
+        
+        """
+        self._assert_writable()
+        self._call('pin')
+        self._pinned = True
+        try:
+            yield self
+        finally:
+            self._pinned = False
+            self._tree.unpin()
+
+    def _merge_buffer(self):
+        "apply the buffered writes to the tree, which keeps them until committed"
+        if not self._buffer:
+            return
+        pairs, deleted = self._buffer.drain()
+        if pairs:
+            self._tree.set_many(pairs)
+        for key in deleted:
+            self._tree.delete(key)
+
+    def _in_tree(self, key):
+        "return whether the tree, without the buffer, holds key"
+        try:
+            self._call('get', key)
+        except KeyError:
+            return False
+        return True
+
+    def _add_keys(self, keys):
+        "add keys written under the lock to the file's key filter, if any"
+        bloom = self._storage.bloom
+        if bloom is not None:
+            for key in keys:
+                bloom.add(key)
+
+    def _build_filter(self, tree):
+        "return a key filter holding the keys of tree"
+        size = len(tree)
+        bloom = BloomFilter.for_capacity(
+            max(2 * size, self.BLOOM_MIN_CAPACITY), self.BLOOM_ERROR_RATE)
+        for key in tree.keys():
+            bloom.add(key)
+        return bloom
+
+    def _prepare_filter(self):
+        "rebuild the key filter before a commit if it is new, stale or full"
+        storage = self._storage
+        bloom = storage.bloom
+        if bloom is None and not self._bloom_filter:
+            return
+        #deleted keys stay in the filter, so it fills up with every key
+        #added rather than with the size of the tree
+        if bloom is None or storage.bloom_stale or \
+                bloom.count > bloom.capacity:
+            storage.set_bloom(self._build_filter(self._tree))
+
+    def _filtered_out(self, key):
+        "return whether the key filter shows that key is not in the tree"
+        if self._pinned:
+            #the filter is for the newest root, not for the pinned one
+            return False
+        try:
+            bloom = self._storage.key_filter()
+        except StorageRetired:
+            self._reopen()
+            return False
+        return bloom is not None and key not in bloom
+
+    def commit(self):
+        self._assert_writable()
+        start = time.perf_counter()
+        self._merge_buffer()
+        #the filter must be checked against the latest file under the lock
+        self._call('lock_for_writing')
+        self._prepare_filter()
+        self._tree.commit()
+        self._commit_stats.record(start, time.perf_counter())
+
+    def commit_stats(self):
+        return self._commit_stats.stats(self._storage.syncs)
+
+    def get(self, key):
+        if self._buffer:
+            value = self._buffer.lookup(key)
+            if value is WriteBuffer.DELETED:
+                raise KeyError
+            if value is not WriteBuffer.MISSING:
+                return value
+        if self._filtered_out(key):
+            raise KeyError
+        return self._call('get', key)
+
+    def __contains__(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def get_many(self, keys, default=None, strict=False):
+        self._merge_buffer()
+        bloom = None
+        if not self._pinned:
+            self._assert_not_closed()
+            try:
+                bloom = self._storage.key_filter()
+            except StorageRetired:
+                self._reopen()
+        if bloom is None:
+            return self._call('get_many', keys, default, strict)
+        keys = list(keys)
+        maybe = [key in bloom for key in keys]
+        if strict and not all(maybe):
+            raise KeyError(keys[maybe.index(False)])
+        #only the keys the filter cannot rule out are looked up in the tree
+        found = iter(self._call('get_many', [
+            key for key, hit in zip(keys, maybe) if hit], default, strict))
+        return [next(found) if hit else default for hit in maybe]
+
+    def set(self, key, value):
+        self._assert_writable()
+        if self._buffer is None:
+            self._call('set', key, value)
+        else:
+            #the lock is taken at the first write, as without a buffer
+            self._call('lock_for_writing')
+            self._buffer.put(key, value)
+        self._add_keys([key])
+
+    def set_many(self, pairs):
+        self._assert_writable()
+        pairs = list(pairs)
+        if self._buffer is None:
+            self._call('set_many', pairs)
+        else:
+            self._call('lock_for_writing')
+            for key, value in pairs:
+                self._buffer.put(key, value)
+        self._add_keys(key for key, _ in pairs)
+
+    def getRootKey(self):
+        self._merge_buffer()
+        return self._tree.rootkey()
+
+    def delete(self, key):
+        self._assert_writable()
+        if self._buffer is None:
+            return self._call('delete', key)
+        self._call('lock_for_writing')
+        value = self._buffer.lookup(key)
+        if value is WriteBuffer.DELETED:
+            raise KeyError
+        if self._in_tree(key):
+            self._buffer.put(key, WriteBuffer.DELETED)
+        elif value is WriteBuffer.MISSING:
+            raise KeyError
+        else:
+            #the key was only ever buffered, so the tree has nothing to delete
+            self._buffer.discard(key)
+
+    def range(self, lo=None, hi=None, reverse=False):
+        self._merge_buffer()
+        return self._call('range', lo, hi, reverse)
+
+    def items(self):
+        self._merge_buffer()
+        return self._call('items')
+
+    def rank(self, key):
+        self._merge_buffer()
+        return self._call('rank', key)
+
+    def select(self, index):
+        self._merge_buffer()
+        return self._call('select', index)
+
+    def count(self, lo=None, hi=None):
+        self._merge_buffer()
+        return self._call('count', lo, hi)
+
+    def __len__(self):
+        self._merge_buffer()
+        return self._call('__len__')
+
+    def cache_stats(self):
+        return self._tree.cache_stats()
+
+    def history(self):
+        "return the CommitRecords of the file, newest first"
+        self._assert_not_closed()
+        return list(self._storage.history())
+
+    def snapshot(self, commit_id=None, timestamp=None):
+        """
+        Method that opens a read-only Snapshot of the database at a past commit.
+        
+        Parameters
+        ----------
+        
+        commit_id: id of the commit, as listed by history(), optional
+        timestamp: time.time() value; the newest commit made at or before it is used, optional
+        
+        Notes
+        -----
+        
+        Without arguments the snapshot is of the newest commit. A KeyError is
+        raised when no commit matches. Compaction keeps commit ids increasing
+        but only carries the newest commit over, so older commits can no
+        longer be opened once the file has been compacted.
+        
+        """
+        self._assert_not_closed()
+        if self._path is None:
+            raise ValueError('Snapshots need the database path.')
+        if commit_id is not None and timestamp is not None:
+            raise ValueError('Give a commit id or a timestamp, not both.')
+        try:
+            self._storage.get_root_address()
+        except StorageRetired:
+            self._reopen()
+        record = None
+        for candidate in self._storage.history():
+            if commit_id is not None:
+                if candidate.commit_id == commit_id:
+                    record = candidate
+                    break
+                if candidate.commit_id < commit_id:
+                    break
+            elif timestamp is None or candidate.timestamp <= timestamp:
+                record = candidate
+                break
+        if record is None and (commit_id is not None or timestamp is not None):
+            raise KeyError(commit_id if commit_id is not None else timestamp)
+        return Snapshot(open(self._path, 'rb'), record, self._cache_size,
+                        self._use_mmap)
+
+    def compact(self, layout=None):
+        """
+        Method that rewrites the file with only the keys and values reachable from the committed root.
+        
+        Parameter
+        ---------
+        
+        layout: order in which nodes are written, defaults to the database's layout, optional
+        
+        Notes
+        -----
+        
+        The copy is written next to the file and swapped in with an atomic
+        rename. The writer lock is held throughout, so no commit can be lost,
+        while readers keep using the old file until they next refresh their
+        root, at which point they find it retired and reopen the path.
+        Returns a CompactionStats with the bytes reclaimed and elapsed time.
+        
+        """
+        self._assert_writable()
+        if self._path is None:
+            raise ValueError('Compaction needs the database path.')
+        if self._storage.locked:
+            raise ValueError('Commit changes before compacting.')
+        start = time.time()
+        self._call('lock_for_writing')
+        bytes_before = self._storage.size()
+        temp_path = self._path + '.compact'
+        try:
+            fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+            #values are copied as raw bytes, so the codec must carry over
+            target = Storage(
+                os.fdopen(fd, 'r+b'), value_codec=self._storage.value_codec,
+                compression=record_compression.NAMES[self._storage.compression],
+                compress_threshold=self._storage.compress_threshold,
+                inline_threshold=self._inline_threshold,
+                node_format=ENGINE_FORMATS[engine_of(self._storage)])
+            try:
+                if target.compression == record_compression.ZLIB:
+                    #the copy gets a dictionary trained on the current values
+                    target.set_dictionary(record_compression.train_dictionary(
+                        self._tree.sample_values(DICTIONARY_SAMPLES)))
+                #commit ids carry on from the file being replaced
+                last_commit = next(self._storage.history(), None)
+                if last_commit is not None:
+                    target.first_commit_id = last_commit.commit_id + 1
+                if self._storage.bloom is not None or self._bloom_filter:
+                    #the copy gets a filter of exactly the keys it holds
+                    target.set_bloom(self._build_filter(self._tree))
+                keys = self._tree.copy_to(target, layout)
+                target.sync()
+            finally:
+                target.close()
+            os.replace(temp_path, self._path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self._storage.unlock()
+            raise
+        self._storage.retire()
+        self._reopen()
+        bytes_after = self._storage.size()
+        return CompactionStats(keys, bytes_before, bytes_after,
+                               bytes_before - bytes_after, time.time() - start)
@@ -0,0 +1,176 @@
+"""
+Lookup service that spreads point lookups over several processes.
+
+Each worker process opens its own read-only connection to the database, so
+lookups run on as many cores as there are workers instead of on the one
+the interpreter lock allows. Batches of keys are handed to the workers and
+the results come back in the order of the keys:
+
+    with LookupService("/tmp/test.dbdb", processes=4) as service:
+        values = service.get_many(keys)
+
+Run as a script, it measures lookup throughput for 1 to N processes:
+
+    python -m red_black_tree.service /tmp/test.dbdb --processes 8
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+import time
+
+from red_black_tree.red_black_tree import connect
+
+#the connection of a worker process, opened by _open_worker
+_db = None
+
+
+def _open_worker(dbname, cache_size, use_mmap):
+    "open the read-only connection of a worker process"
+    global _db
+    _db = connect(dbname, cache_size, use_mmap, readonly=True)
+
+
+def _lookup_batch(task):
+    "return the values of a batch of keys, default for missing ones"
+    keys, default = task
+    #the whole batch is read from one committed root, in one descent
+    with _db.read_transaction():
+        values = _db.get_many(keys, default)
+    #slices of a map cannot be sent back to the parent
+    return [bytes(value) if isinstance(value, memoryview) else value
+            for value in values]
+
+
+class LookupService(object):
+    """
+    Pool of worker processes answering lookups on one database file.
+    """
+
+    def __init__(self, dbname, processes=None, batch_size=1024,
+                 cache_size=1024, use_mmap=True, start_method=None):
+        """
+        The constructor of the class takes for arguments the path of the database
+
+        Parameters
+        ----------
+
+        dbname: path of an existing database
+        processes: number of worker processes, defaults to the number of cores, optional
+        batch_size: number of keys sent to a worker at a time, optional
+        cache_size: number of decoded nodes each worker keeps in memory, optional
+        use_mmap: whether workers read through a memory map of the file, optional
+        start_method: multiprocessing start method, e.g. 'spawn', optional
+
+        """
+        if batch_size < 1:
+            raise ValueError('The batch size must be positive.')
+        self.processes = processes or os.cpu_count() or 1
+        self.batch_size = batch_size
+        context = multiprocessing.get_context(start_method)
+        self._pool = context.Pool(self.processes, _open_worker,
+                                  (dbname, cache_size, use_mmap))
+
+    def get_many(self, keys, default=None):
+        """
+        Method that returns the values of keys, in the same order.
+
+        Parameters
+        ----------
+
+        keys: iterable of keys
+        default: value returned for keys that are not in the database, optional
+
+        Notes
+        -----
+
+        Each batch sees one committed root, but batches handled by different
+        workers may see different commits if a writer commits meanwhile.
+
+        """
+        keys = list(keys)
+        tasks = [(keys[start:start + self.batch_size], default)
+                 for start in range(0, len(keys), self.batch_size)]
+        return list(itertools.chain.from_iterable(
+            self._pool.map(_lookup_batch, tasks)))
+
+    def get(self, key, default=None):
+        return self.get_many([key], default)[0]
+
+    def close(self):
+        "let the workers finish and wait for them to exit"
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def benchmark(dbname, lookups=100000, processes=None, batch_size=1024,
+              use_mmap=True):
+    """
+    Function that measures lookup throughput of a database for growing numbers of processes.
+
+    Parameters
+    ----------
+
+    dbname: path of an existing, non-empty database
+    lookups: number of random keys looked up for each number of processes, optional
+    processes: largest number of processes tried, defaults to the number of cores, optional
+    batch_size: number of keys sent to a worker at a time, optional
+    use_mmap: whether workers read through a memory map of the file, optional
+
+    Notes
+    -----
+
+    Returns a list of (processes, lookups per second) pairs, for 1 to
+    processes workers. Pool start-up is not timed.
+
+    """
+    db = connect(dbname, readonly=True)
+    try:
+        size = len(db)
+        if not size:
+            raise ValueError('The database is empty.')
+        keys = [db.select(random.randrange(size)) for _ in range(lookups)]
+    finally:
+        db.close()
+    results = []
+    for count in range(1, (processes or os.cpu_count() or 1) + 1):
+        with LookupService(dbname, count, batch_size,
+                           use_mmap=use_mmap) as service:
+            #warm the workers up before the clock starts
+            service.get_many(keys[:batch_size * count])
+            start = time.perf_counter()
+            service.get_many(keys)
+            elapsed = time.perf_counter() - start
+        results.append((count, lookups / elapsed))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure multi-process lookup throughput of a database.')
+    parser.add_argument('dbname', help='path of a database file')
+    parser.add_argument('--lookups', type=int, default=100000,
+                        help='random keys looked up for each process count')
+    parser.add_argument('--processes', type=int,
+                        help='largest number of processes, defaults to the '
+                             'number of cores')
+    parser.add_argument('--batch-size', type=int, default=1024,
+                        help='keys sent to a worker at a time')
+    args = parser.parse_args(argv)
+    results = benchmark(args.dbname, args.lookups, args.processes,
+                        args.batch_size)
+    base = results[0][1]
+    for count, rate in results:
+        print('%2d processes: %10.0f lookups/s  %5.2fx' % (
+            count, rate, rate / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,17 @@
 import unittest
-from immutable_tree import *
-from red_black_tree import *
+import asyncio
+from red_black_tree.immutable_tree import *
+from red_black_tree.red_black_tree import *
+from red_black_tree import compact
+from red_black_tree.service import LookupService, benchmark
+from red_black_tree.btree import BTree
+from red_black_tree.bloom import BloomFilter
+from red_black_tree import lsm
+from red_black_tree import async_db
 import numpy as np
 import os
+import random
+import threading
 
 class ImmutableTreeTest(unittest.TestCase): 
 	"""
@@ -137,6 +146,20 @@ class ImmutableTreeTest(unittest.TestCase):
 		db3 = it_connect("/tmp/test2.dbdb")
 		self.assertEqual(db3.get("pavlos"), "aged")
         
+	def test_items(self):
+		'''
+		Verify that items are yielded in key order
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = it_connect("/tmp/test2.dbdb")
+		db.set("rahul", "aged")
+		db.set("pavlos", "aged")
+		db.set("kobe", "stillyoung")
+		self.assertEqual(list(db.items()), [("kobe", "stillyoung"),
+		                                    ("pavlos", "aged"), ("rahul", "aged")])
+		self.assertEqual(list(db.range("l", reverse=True)),
+		                 [("rahul", "aged"), ("pavlos", "aged")])
+
 class RedBlackTreeTest(unittest.TestCase): 
 	"""
 	These tests concern the RedBlackTree Class
@@ -280,11 +303,1543 @@ class RedBlackTreeTest(unittest.TestCase):
 		
 		db3 = connect("/tmp/test2.dbdb")
 		self.assertEqual(db3.get("pavlos"),"aged")
+
+	def test_manyKeys(self):
+		'''
+		Verify that every key survives the rotations of a larger tree
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		keys = np.random.RandomState(0).permutation(200)
+		for k in keys:
+			db.set(int(k), str(k))
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		for k in keys:
+			self.assertEqual(db.get(int(k)), str(k))
+
+	def test_setMany(self):
+		'''
+		Verify that a batch merged in one pass matches individual sets
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		rng = np.random.RandomState(1)
+		expected = {}
+		for size in [1, 5, 40, 300]:
+			batch = [(int(k), str(rng.rand())) for k in rng.randint(0, 500, size)]
+			db.set_many(batch)
+			expected.update(batch)
+			self.assertEqual(db._tree.validate()['size'], len(expected))
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		for k, v in expected.items():
+			self.assertEqual(db.get(k), v)
+
+	def test_setManyLastWins(self):
+		'''
+		Verify that the last value of a repeated key in a batch is kept
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		db.set("pavlos", "aged")
+		db.set_many([("rahul", "aged"), ("pavlos", "young"), ("rahul", "young")])
+		self.assertEqual(db.get("pavlos"), "young")
+		self.assertEqual(db.get("rahul"), "young")
+
+	def test_insertStopsBalancing(self):
+		'''
+		Verify that an insert only balances while the red rule may be broken above it
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		keys = list(range(0, 2000, 2))
+		random.Random(7).shuffle(keys)
+		for k in keys:
+			db.set(k, str(k))
+		db._tree.validate()
+		calls = []
+		balance = db._tree.balance
+		db._tree.balance = lambda node: calls.append(node) or balance(node)
+		db.set(500, "replaced")
+		self.assertEqual(calls, [])
+		db.set(501, "new")
+		self.assertLess(len(calls), db._tree.validate()['height'])
+		self.assertEqual(db.get(500), "replaced")
+		self.assertEqual(db.get(501), "new")
+		self.assertEqual(len(db), 1001)
+
+	def test_slots(self):
+		'''
+		Verify that nodes and refs carry no per-instance dictionary
+		'''
+		node = RedBlackNode(RedBlackNodeRef(), "pavlos", ValueRef("aged"), RedBlackNodeRef())
+		for obj in [node, node.left_ref, node.value_ref, BinaryNodeRef(),
+				BinaryNode(BinaryNodeRef(), "rahul", ValueRef("young"), BinaryNodeRef())]:
+			self.assertFalse(hasattr(obj, '__dict__'))
+		self.assertEqual(RedBlackNodeRef(referent=node).size, 1)
+
+	def test_setManyUnhashableKeys(self):
+		'''
+		Verify that set_many accepts the orderable, unhashable keys that set accepts
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		db.set([1], "a")
+		db.set_many([([2], "b"), ([0], "c"), ([2], "d")])
+		db.commit()
+		self.assertEqual(list(db.items()), [([0], "c"), ([1], "a"), ([2], "d")])
+
+	def test_bulkLoad(self):
+		'''
+		Verify that a sized sorted input yields a perfectly balanced tree
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		pairs = [(k, str(k)) for k in range(1000)]
+		self.assertEqual(bulk_load("/tmp/test2.dbdb", pairs), 1000)
+		db = connect("/tmp/test2.dbdb")
+		info = db._tree.validate()
+		self.assertEqual(info['size'], 1000)
+		self.assertEqual(info['height'], 10)
+		for k, v in pairs:
+			self.assertEqual(db.get(k), v)
+
+	def test_bulkLoadStream(self):
+		'''
+		Verify that a generator of unknown length is loaded into a valid tree
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		bulk_load("/tmp/test2.dbdb", ((k, str(k)) for k in range(0, 999, 3)))
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(db._tree.validate()['size'], 333)
+		self.assertEqual(db.get(300), "300")
+		with self.assertRaises(KeyError):
+			db.get(301)
+
+	def test_bulkLoadErrors(self):
+		'''
+		Verify that unsorted input and non-empty databases are rejected
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		with self.assertRaises(ValueError):
+			bulk_load("/tmp/test2.dbdb", [("rahul", "aged"), ("kobe", "young")])
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		db.set("pavlos", "aged")
+		db.commit()
+		db.close()
+		with self.assertRaises(ValueError):
+			bulk_load("/tmp/test2.dbdb", [("rahul", "aged")])
+
+	def test_range(self):
+		'''
+		Verify that range scans yield the pairs in order within the bounds
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		keys = np.random.RandomState(2).permutation(100)
+		db.set_many((int(k), str(k)) for k in keys[:60])
+		db.commit()
+		for k in keys[60:]:
+			db.set(int(k), str(k))
+		self.assertEqual(list(db.items()), [(k, str(k)) for k in range(100)])
+		self.assertEqual([k for k, v in db.range(10, 20)], list(range(10, 20)))
+		self.assertEqual([k for k, v in db.range(10.5, 20, reverse=True)],
+		                 list(range(19, 10, -1)))
+		self.assertEqual([k for k, v in db.range(hi=3)], [0, 1, 2])
+		self.assertEqual([k for k, v in db.range(97, reverse=True)], [99, 98, 97])
+		self.assertEqual(list(db.range(50, 50)), [])
+
+	def test_orderStatistics(self):
+		'''
+		Verify rank, select, count and len against a sorted list
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		keys = [int(k) for k in np.random.RandomState(3).permutation(300)[:150]]
+		db.set_many((k, str(k)) for k in keys[:100])
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		for k in keys[100:]:
+			db.set(k, str(k))
+		expected = sorted(keys)
+		self.assertEqual(len(db), 150)
+		self.assertEqual(db._tree.validate()['size'], 150)
+		for i, k in enumerate(expected):
+			self.assertEqual(db.select(i), k)
+			self.assertEqual(db.rank(k), i)
+		self.assertEqual(db.select(-1), expected[-1])
+		with self.assertRaises(IndexError):
+			db.select(150)
+		self.assertEqual(db.rank(-1), 0)
+		self.assertEqual(db.rank(1000), 150)
+		self.assertEqual(db.count(), 150)
+		self.assertEqual(db.count(50, 100), len([k for k in keys if 50 <= k < 100]))
+		self.assertEqual(db.count(100, 50), 0)
+
+	def test_legacySizes(self):
+		'''
+		Verify that len works on pickle-format files written without sizes
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		with open("/tmp/test2.dbdb", "wb") as f:
+			f.write(b"\x00" * Storage.SUPERBLOCK_SIZE)
+		db = connect("/tmp/test2.dbdb")
+		storage = db._storage
+		def write_node(left, key, right, color):
+			return storage.write(pickle.dumps({
+				'left': left, 'key': key, 'value': storage.write(str(key).encode()),
+				'right': right, 'color': color}))
+		left = write_node(0, 1, 0, Color.RED)
+		right = write_node(0, 3, 0, Color.RED)
+		storage.commit_root_address(write_node(left, 2, right, Color.BLACK))
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(len(db), 3)
+		self.assertEqual(db.select(2), 3)
+		self.assertEqual(db.rank(3), 2)
+		db.set(4, "4")
+		self.assertEqual(len(db), 4)
+		self.assertEqual(db.get(3), "3")
+
+	def test_deleteBalance(self):
+		'''
+		Verify that heavy deletion keeps the red-black invariants
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		bulk_load("/tmp/test2.dbdb", [(k, str(k)) for k in range(500)])
+		db = connect("/tmp/test2.dbdb")
+		keys = np.random.RandomState(4).permutation(500)
+		for i, k in enumerate(keys[:450]):
+			db.delete(int(k))
+			if i % 50 == 0:
+				db.commit()
+				self.assertEqual(db._tree.validate()['size'], 499 - i)
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		info = db._tree.validate()
+		self.assertEqual(info['size'], 50)
+		self.assertLessEqual(info['height'], 2 * np.log2(51))
+		self.assertEqual([k for k, v in db.items()], sorted(int(k) for k in keys[450:]))
+		with self.assertRaises(KeyError):
+			db.delete(int(keys[0]))
+
+	def test_nodeFormat(self):
+		'''
+		Verify that typed keys round-trip through the binary node record
+		'''
+		for key in ["rahul", b"rahul", -7, 2.5, 2**70, (1, "a")]:
+			node = RedBlackNode(RedBlackNodeRef(address=1), key,
+			                    ValueRef(address=2), RedBlackNodeRef(address=3),
+			                    Color.BLACK)
+			data = RedBlackNodeRef.referent_to_bytes(node)
+			decoded = RedBlackNodeRef.bytes_to_referent(data)
+			self.assertEqual(decoded.key, key)
+			self.assertEqual(type(decoded.key), type(key))
+			self.assertEqual(decoded.left_ref.address, 1)
+			self.assertEqual(decoded.value_ref.address, 2)
+			self.assertEqual(decoded.right_ref.address, 3)
+			self.assertEqual(decoded.color, Color.BLACK)
+		self.assertLess(len(data), len(pickle.dumps({
+			'left': 1, 'key': key, 'value': 2, 'right': 3, 'color': 1})))
+
+	def test_legacyPickleFile(self):
+		'''
+		Verify that files without a format header keep using pickle
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		with open("/tmp/test2.dbdb", "wb") as f:
+			f.write(b"\x00" * Storage.SUPERBLOCK_SIZE)
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(db._storage.node_format, Storage.FORMAT_PICKLE)
+		db.set("pavlos", "aged")
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(db.get("pavlos"), "aged")
+		root = db._storage.read(db._storage.get_root_address())
+		self.assertEqual(pickle.loads(root)['key'], "pavlos")
+		db.close()
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(db._storage.node_format, Storage.FORMAT_BINARY)
         
+class MmapStorageTest(unittest.TestCase):
+	"""
+	These tests concern the memory-mapped read path of Storage
+	"""
+	def test_readsAreViews(self):
+		'''
+		Verify that mapped reads return memoryview slices of the file
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", use_mmap=True)
+		db.set("pavlos", "aged")
+		db.commit()
+		self.assertIsInstance(db._storage.read(db._storage.get_root_address()),
+		                      memoryview)
+		self.assertEqual(db.get("pavlos"), "aged")
+		db.close()
+
+	def test_remapOnGrowth(self):
+		'''
+		Verify that a mapped reader sees commits from another connection
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		reader = connect("/tmp/test2.dbdb", cache_size=0, use_mmap=True)
+		writer = connect("/tmp/test2.dbdb")
+		for k in range(100):
+			writer.set(k, str(k) * 50)
+		writer.commit()
+		for k in range(100):
+			self.assertEqual(reader.get(k), str(k) * 50)
+		writer.set(7, "young")
+		writer.commit()
+		self.assertEqual(reader.get(7), "young")
+		writer.close()
+		reader.close()
+
+class CompactionTest(unittest.TestCase):
+	"""
+	These tests concern compaction of the append-only file
+	"""
+	def test_compact(self):
+		'''
+		Verify that compaction keeps the data and reclaims dead records
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		for k in range(200):
+			db.set(k, str(k))
+			db.commit()
+		for k in range(0, 200, 2):
+			db.delete(k)
+		db.commit()
+		stats = db.compact()
+		self.assertEqual(stats.keys, 100)
+		self.assertGreater(stats.bytes_reclaimed, 0)
+		self.assertEqual(stats.bytes_after, os.path.getsize("/tmp/test2.dbdb"))
+		self.assertEqual(list(db.items()), [(k, str(k)) for k in range(1, 200, 2)])
+		self.assertEqual(db._tree.validate()['size'], 100)
+		db.set(0, "0")
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(db.get(0), "0")
+		self.assertEqual(len(db), 101)
+
+	def test_readersFollowSwap(self):
+		'''
+		Verify that other connections keep working and follow the new file
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		db.set_many((k, str(k)) for k in range(50))
+		db.commit()
+		reader = connect("/tmp/test2.dbdb")
+		scan = reader.range(10, 20)
+		writer = connect("/tmp/test2.dbdb")
+		db.compact()
+		self.assertEqual([k for k, v in scan], list(range(10, 20)))
+		self.assertEqual(reader.get(7), "7")
+		writer.set(7, "seven")
+		writer.commit()
+		self.assertEqual(reader.get(7), "seven")
+		self.assertEqual(db.get(7), "seven")
+
+	def test_commandLine(self):
+		'''
+		Verify the standalone compaction tool
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		db.set("pavlos", "aged")
+		db.commit()
+		db.set("pavlos", "young")
+		db.commit()
+		db.close()
+		compact.main(["/tmp/test2.dbdb"])
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(db.get("pavlos"), "young")
+
+class LayoutTest(unittest.TestCase):
+	"""
+	These tests concern the block-clustered node layout
+	"""
+	def test_blockedCommit(self):
+		'''
+		Verify that incremental commits in the blocked layout read back
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", layout='blocked')
+		for k in range(300):
+			db.set(k, str(k))
+			if k % 7 == 0:
+				db.commit()
+		db.delete(5)
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(db.get(299), "299")
+		self.assertEqual(len(db), 299)
+		db._tree.validate()
+
+	def test_blocksShareAPage(self):
+		'''
+		Verify that a bulk loaded block of nodes lies within one page
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		bulk_load("/tmp/test2.dbdb", [(k, str(k)) for k in range(5000)],
+			layout='blocked')
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(db._tree.validate()['size'], 5000)
+		page = db._tree._tree_ref.address // BlockWriter.PAGE_SIZE
+		for side in ('left_ref', 'right_ref'):
+			ref = db._tree._tree_ref
+			for depth in range(BlockWriter(None).levels):
+				self.assertEqual(ref.address // BlockWriter.PAGE_SIZE, page)
+				ref = getattr(db._tree._follow(ref), side)
+
+	def test_compactBlocked(self):
+		'''
+		Verify that compaction can switch a file to the blocked layout
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		db.set_many((k, str(k)) for k in range(1000))
+		db.commit()
+		compact.main(["--layout", "blocked", "/tmp/test2.dbdb"])
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(list(db.range(10, 13)), [(10, "10"), (11, "11"), (12, "12")])
+		self.assertEqual(db._tree.validate()['size'], 1000)
+
+	def test_blockedPickleFile(self):
+		'''
+		Verify that the blocked layout writes files still in the pickle format
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		with open("/tmp/test2.dbdb", "wb") as f:
+			f.write(b"\x00" * Storage.SUPERBLOCK_SIZE)
+		db = connect("/tmp/test2.dbdb", layout='blocked')
+		db.set_many((k, str(k)) for k in range(500))
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(db._storage.node_format, Storage.FORMAT_PICKLE)
+		self.assertEqual(db._tree.validate()['size'], 500)
+
+	def test_unknownLayout(self):
+		os.system("rm /tmp/test2.dbdb")
+		with self.assertRaises(ValueError):
+			connect("/tmp/test2.dbdb", layout='veb')
+
+
+class DurabilityTest(unittest.TestCase):
+	"""
+	These tests concern durability modes and group commit
+	"""
+	def test_modes(self):
+		'''
+		Verify that each durability mode commits and counts its syncs
+		'''
+		for durability, syncs in [('flush', 0), ('fsync', 6), ('group', 6)]:
+			os.system("rm /tmp/test2.dbdb")
+			db = connect("/tmp/test2.dbdb", durability=durability)
+			for k in range(3):
+				db.set(k, str(k))
+				db.commit()
+			stats = db.commit_stats()
+			self.assertEqual(stats['commits'], 3)
+			self.assertEqual(stats['syncs'], syncs)
+			self.assertGreater(stats['commits_per_second'], 0)
+			self.assertGreaterEqual(stats['max_latency'], stats['mean_latency'])
+			db.close()
+			db = connect("/tmp/test2.dbdb")
+			self.assertEqual(list(db.items()), [(0, "0"), (1, "1"), (2, "2")])
+		with self.assertRaises(ValueError):
+			connect("/tmp/test2.dbdb", durability='none')
+
+	def test_groupCommit(self):
+		'''
+		Verify that concurrent writers keep every commit and share syncs
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		connect("/tmp/test2.dbdb").close()
+		dbs = [connect("/tmp/test2.dbdb", durability='group') for t in range(8)]
+		def work(t):
+			for k in range(20):
+				dbs[t].set((t, k), str(k))
+				dbs[t].commit()
+		threads = [threading.Thread(target=work, args=(t,)) for t in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		syncs = sum(db.commit_stats()['syncs'] for db in dbs)
+		self.assertLess(syncs, 2 * 8 * 20)
+		db = connect("/tmp/test2.dbdb")
+		self.assertEqual(len(db), 160)
+		self.assertEqual(db.get((7, 19)), "19")
+		db._tree.validate()
+
+	def _submitPending(self, db, key, value):
+		'''
+		Commit a key in group mode up to the point where its root waits for the leader
+		'''
+		db.set(key, value)
+		db._tree._tree_ref.store(db._storage)
+		root_address = db._tree._tree_ref.address
+		history_address = db._storage._append_history(root_address)
+		db._storage._f.flush()
+		db._storage._group.submit(root_address, history_address)
+		db._storage.unlock()
+
+	def test_groupSharesSync(self):
+		'''
+		Verify that one leader sync makes every waiting root durable
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		first = connect("/tmp/test2.dbdb", durability='group')
+		second = connect("/tmp/test2.dbdb", durability='group')
+		self._submitPending(first, "a", "1")
+		self._submitPending(second, "b", "2")
+		group = first._storage._group
+		group.wait(1, first._storage)
+		self.assertEqual(group.durable, 2)
+		self.assertEqual(first._storage.syncs + second._storage.syncs, 2)
+		self.assertEqual(list(connect("/tmp/test2.dbdb").items()), [("a", "1"), ("b", "2")])
+
+	def test_otherModesSeePendingRoots(self):
+		'''
+		Verify that writers and compaction in other modes keep roots waiting for a group sync
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		group = connect("/tmp/test2.dbdb", durability='group')
+		self._submitPending(group, "a", "1")
+		db = connect("/tmp/test2.dbdb")
+		db.set("b", "2")
+		db.commit()
+		self.assertEqual(list(connect("/tmp/test2.dbdb").items()), [("a", "1"), ("b", "2")])
+		self._submitPending(group, "c", "3")
+		stats = connect("/tmp/test2.dbdb").compact()
+		self.assertEqual(stats.keys, 3)
+		group.set("d", "4")
+		group.commit()
+		self.assertEqual(len(connect("/tmp/test2.dbdb")), 4)
+
+
+class ValueCodecTest(unittest.TestCase):
+	"""
+	These tests concern the value codecs recorded in the superblock
+	"""
+	def test_roundTrips(self):
+		'''
+		Verify that every codec reads back what it wrote, after reopening
+		'''
+		values = {
+			'str': "pavlos",
+			'bytes': b"\x00\xffraw",
+			'int': -2**40,
+			'float': 0.125,
+			'structured': {"a": [1, 2.5, None, True], "b": b"x", "c": 2**70},
+		}
+		for codec, value in values.items():
+			os.system("rm /tmp/test2.dbdb")
+			db = connect("/tmp/test2.dbdb", value_codec=codec)
+			db.set("k", value)
+			db.commit()
+			db.close()
+			db = connect("/tmp/test2.dbdb")
+			self.assertEqual(db._storage.value_codec.name, codec)
+			self.assertEqual(db.get("k"), value)
+			db.close()
+
+	def test_numpy(self):
+		'''
+		Verify that arrays keep their dtype and shape, and are read without copying on mmap
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		array = np.arange(12, dtype=np.float32).reshape(3, 4)
+		db = connect("/tmp/test2.dbdb", value_codec='numpy')
+		db.set(1, array)
+		db.set(2, np.array([], dtype=np.int16))
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb", use_mmap=True)
+		stored = db.get(1)
+		self.assertEqual(stored.dtype, np.float32)
+		self.assertTrue(np.array_equal(stored, array))
+		self.assertFalse(stored.flags.writeable)
+		self.assertEqual(db.get(2).shape, (0,))
+
+	def test_codecMismatch(self):
+		'''
+		Verify that a file cannot be opened with another codec, and keeps it on compaction
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", value_codec='int')
+		db.set("k", 7)
+		db.commit()
+		with self.assertRaises(ValueError):
+			connect("/tmp/test2.dbdb", value_codec='float')
+		with self.assertRaises(ValueError):
+			connect("/tmp/test2.dbdb", value_codec='pickle')
+		db.compact()
+		self.assertEqual(db._storage.value_codec.name, 'int')
+		self.assertEqual(db.get("k"), 7)
+
+
+class CompressionTest(unittest.TestCase):
+	"""
+	These tests concern compressed records and the trained dictionary
+	"""
+	def _values(self):
+		return [(k, '{"user": %d, "name": "user%d", "status": "active"}' % (k, k * 7))
+			for k in range(2000)]
+
+	def test_roundTrips(self):
+		'''
+		Verify that compressed files read back, also through mmap
+		'''
+		for compression in ['zlib', 'lzma']:
+			os.system("rm /tmp/test2.dbdb")
+			db = connect("/tmp/test2.dbdb", compression=compression, compress_threshold=16)
+			db.set("short", "x")
+			db.set("long", "pavlos " * 100)
+			db.commit()
+			db.close()
+			for use_mmap in [False, True]:
+				db = connect("/tmp/test2.dbdb", use_mmap=use_mmap)
+				self.assertEqual(db.get("short"), "x")
+				self.assertEqual(db.get("long"), "pavlos " * 100)
+				db.close()
+			self.assertLess(os.path.getsize("/tmp/test2.dbdb"), Storage.SUPERBLOCK_SIZE + 400)
+			with self.assertRaises(ValueError):
+				connect("/tmp/test2.dbdb", compression='lzma' if compression == 'zlib' else 'zlib')
+
+	def test_threshold(self):
+		'''
+		Verify that records under the threshold are stored raw behind their tag
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", compression='zlib', compress_threshold=1000)
+		db.set("k", "a" * 500)
+		db.commit()
+		value = db._tree._follow(db._tree._tree_ref).value_ref
+		with open("/tmp/test2.dbdb", "rb") as f:
+			f.seek(value.address + Storage.INTEGER_LENGTH)
+			self.assertEqual(f.read(4), b"\x00aaa")
+
+	def test_dictionary(self):
+		'''
+		Verify that bulk_load and compact store a trained dictionary that shrinks short values
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", compression='zlib', compress_threshold=16)
+		db.set_many(self._values())
+		db.commit()
+		plain = os.path.getsize("/tmp/test2.dbdb")
+		self.assertIsNone(db._storage.dictionary)
+		db.compact()
+		self.assertIsNotNone(db._storage.dictionary)
+		self.assertLess(os.path.getsize("/tmp/test2.dbdb"), plain)
+		self.assertEqual(db.get(1999), self._values()[1999][1])
+		with self.assertRaises(ValueError):
+			db._storage.set_dictionary(b"abc")
+		os.system("rm /tmp/test2.dbdb")
+		bulk_load("/tmp/test2.dbdb", self._values(), compression='zlib', compress_threshold=16)
+		db = connect("/tmp/test2.dbdb")
+		self.assertIsNotNone(db._storage.dictionary)
+		self.assertEqual(list(db.items()), self._values())
+		self.assertEqual(db._tree.validate()['height'], 11)
+
+
+class InlineValueTest(unittest.TestCase):
+	"""
+	These tests concern values stored inside their node record
+	"""
+	def test_smallValuesInline(self):
+		'''
+		Verify that only values under the threshold are inlined, and read with their node
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", inline_threshold=16)
+		db.set("small", "aged")
+		db.set("large", "young" * 10)
+		db.set("empty", "")
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb", cache_size=0)
+		reads = []
+		read = db._storage.read
+		db._storage.read = lambda address: reads.append(address) or read(address)
+		self.assertEqual(db.get("small"), "aged")
+		self.assertEqual(db.get("empty"), "")
+		#the root, kept decoded while no commit happens, and one child for
+		#each lookup, no value records
+		self.assertEqual(len(reads), 3)
+		self.assertEqual(db.get("large"), "young" * 10)
+		#the root's value
+		self.assertEqual(len(reads), 4)
+		root = db._tree._follow(db._tree._tree_ref)
+		self.assertEqual(root.key, "large")
+		self.assertNotEqual(root.value_ref.address, 0)
+		self.assertEqual(db._tree._follow(root.right_ref).value_ref.address, 0)
+
+	def test_inlineUpdatesAndCompaction(self):
+		'''
+		Verify that inline values survive path copies, deletes and compaction
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		db.set_many((k, str(k)) for k in range(300))
+		db.commit()
+		for k in range(0, 300, 3):
+			db.delete(k)
+		db.set(1, "x" * 100)
+		db.commit()
+		db.compact()
+		expected = [(k, "x" * 100 if k == 1 else str(k)) for k in range(300) if k % 3]
+		self.assertEqual(list(db.items()), expected)
+		db = connect("/tmp/test2.dbdb", inline_threshold=0)
+		db.set(2, "two")
+		db.commit()
+		self.assertEqual(list(db.range(1, 3)), [(1, "x" * 100), (2, "two")])
+
+
+class NodeCacheTest(unittest.TestCase):
+	"""
+	These tests concern the NodeCache shared by tree lookups
+	"""
+	def test_lru(self):
+		'''
+		Verify that the least recently used node is evicted first
+		'''
+		cache = NodeCache(2)
+		cache.put(1, "a")
+		cache.put(2, "b")
+		self.assertEqual(cache.get(1), "a")
+		cache.put(3, "c")
+		self.assertIsNone(cache.get(2))
+		self.assertEqual(cache.get(3), "c")
+		self.assertEqual(cache.stats(), {'size': 2, 'capacity': 2,
+		                                 'hits': 2, 'misses': 1,
+		                                 'evictions': 1})
+
+	def test_warmLookups(self):
+		'''
+		Verify that repeated lookups are served from the cache
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		for k in range(50):
+			db.set(k, str(k))
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb", cache_size=16)
+		db.get(7)
+		misses = db.cache_stats()['misses']
+		self.assertEqual(db.get(7), "7")
+		self.assertEqual(db.cache_stats()['misses'], misses)
+		for k in range(50):
+			self.assertEqual(db.get(k), str(k))
+		self.assertLessEqual(db.cache_stats()['size'], 16)
+		self.assertGreater(db.cache_stats()['evictions'], 0)
+		self.assertIsNone(connect("/tmp/test2.dbdb", cache_size=0).cache_stats())
+
+class SnapshotTest(unittest.TestCase):
+	"""
+	These tests concern the commit history and read-only snapshots
+	"""
+	def _commitVersions(self, **kwargs):
+		'''
+		Commit three versions of key 1 and return the database
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", **kwargs)
+		for version in range(3):
+			db.set(1, "v%d" % version)
+			db.set(version + 10, "new")
+			db.commit()
+		return db
+
+	def test_history(self):
+		'''
+		Verify that every commit is recorded, newest first
+		'''
+		db = self._commitVersions()
+		history = db.history()
+		self.assertEqual([record.commit_id for record in history], [3, 2, 1])
+		self.assertEqual(history[0].root_address, db._storage.get_root_address())
+		self.assertGreaterEqual(history[0].timestamp, history[2].timestamp)
+		db.close()
+		db = self._commitVersions(durability='group')
+		self.assertEqual([record.commit_id for record in db.history()], [3, 2, 1])
+		db.close()
+		self.assertEqual(connect("/tmp/test2.dbdb").history()[0].commit_id, 3)
+
+	def test_snapshot(self):
+		'''
+		Verify that old commits are read back by id and by timestamp
+		'''
+		db = self._commitVersions()
+		history = db.history()
+		with db.snapshot(commit_id=1) as snapshot:
+			self.assertEqual(snapshot.get(1), "v0")
+			self.assertEqual(len(snapshot), 2)
+			with self.assertRaises(KeyError):
+				snapshot.get(11)
+		with db.snapshot(timestamp=history[1].timestamp) as snapshot:
+			self.assertEqual(snapshot.commit_id, 2)
+			self.assertEqual(list(snapshot.items()), [(1, "v1"), (10, "new"), (11, "new")])
+		with db.snapshot() as snapshot:
+			self.assertEqual(snapshot.commit_id, 3)
+			self.assertEqual(snapshot.get(1), "v2")
+		with self.assertRaises(KeyError):
+			db.snapshot(commit_id=4)
+		with self.assertRaises(KeyError):
+			db.snapshot(timestamp=history[2].timestamp - 1)
+		db.close()
+
+	def test_snapshotIgnoresWriters(self):
+		'''
+		Verify that a snapshot reads while a writer holds the lock and misses its later commits
+		'''
+		db = self._commitVersions()
+		snapshot = db.snapshot()
+		db.set(1, "uncommitted")
+		self.assertTrue(db._storage.locked)
+		self.assertEqual(snapshot.get(1), "v2")
+		db.commit()
+		self.assertEqual(snapshot.get(1), "v2")
+		self.assertFalse(snapshot._storage.locked)
+		snapshot.close()
+		with self.assertRaises(ValueError):
+			snapshot.get(1)
+		db.close()
+
+	def test_snapshotAfterCompaction(self):
+		'''
+		Verify that open snapshots survive compaction and commit ids continue
+		'''
+		db = self._commitVersions()
+		snapshot = db.snapshot(commit_id=1)
+		db.compact()
+		self.assertEqual(snapshot.get(1), "v0")
+		self.assertEqual([record.commit_id for record in db.history()], [4])
+		with self.assertRaises(KeyError):
+			db.snapshot(commit_id=1)
+		db.set(1, "v3")
+		db.commit()
+		with db.snapshot(commit_id=4) as compacted:
+			self.assertEqual(compacted.get(1), "v2")
+		snapshot.close()
+		db.close()
+
+	def test_emptySnapshot(self):
+		'''
+		Verify that a database without commits has an empty snapshot
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		with db.snapshot() as snapshot:
+			self.assertIsNone(snapshot.commit_id)
+			self.assertEqual(len(snapshot), 0)
+		db.close()
+
+class ReaderTest(unittest.TestCase):
+	"""
+	These tests concern read-only connections and read transactions
+	"""
+	def test_readonly(self):
+		'''
+		Verify that a read-only connection never locks and follows new commits
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		writer = connect("/tmp/test2.dbdb")
+		writer.set(1, "a")
+		writer.commit()
+		reader = connect("/tmp/test2.dbdb", readonly=True)
+		writer.set(2, "b")
+		self.assertTrue(writer._storage.locked)
+		self.assertEqual(reader.get(1), "a")
+		with self.assertRaises(KeyError):
+			reader.get(2)
+		writer.commit()
+		self.assertEqual(reader.get(2), "b")
+		with self.assertRaises(ValueError):
+			reader.set(3, "c")
+		with self.assertRaises(ValueError):
+			reader.compact()
+		writer.compact()
+		self.assertEqual(reader.get(2), "b")
+		self.assertTrue(reader._storage.readonly)
+		reader.close()
+		writer.close()
+		os.system("rm /tmp/test2.dbdb")
+		with self.assertRaises(IOError):
+			connect("/tmp/test2.dbdb", readonly=True)
+
+	def test_rootKeptBetweenReads(self):
+		'''
+		Verify that the decoded root is reused until a commit changes it
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb")
+		db.set(1, "a")
+		db.commit()
+		reader = connect("/tmp/test2.dbdb", readonly=True)
+		reader.get(1)
+		root_ref = reader._tree._tree_ref
+		reader.get(1)
+		self.assertIs(reader._tree._tree_ref, root_ref)
+		db.set(1, "b")
+		db.commit()
+		self.assertEqual(reader.get(1), "b")
+		self.assertIsNot(reader._tree._tree_ref, root_ref)
+		reader.close()
+		db.close()
+
+	def test_readTransaction(self):
+		'''
+		Verify that reads in a transaction keep their root and skip the superblock
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		writer = connect("/tmp/test2.dbdb")
+		writer.set(1, "a")
+		writer.commit()
+		reader = connect("/tmp/test2.dbdb")
+		with reader.read_transaction():
+			self.assertEqual(reader.get(1), "a")
+			writer.set(1, "b")
+			writer.commit()
+			reader._storage.get_root_address = None
+			self.assertEqual(reader.get(1), "a")
+			self.assertEqual(list(reader.items()), [(1, "a")])
+			with self.assertRaises(ValueError):
+				reader.set(2, "c")
+			del reader._storage.get_root_address
+		self.assertEqual(reader.get(1), "b")
+		reader.set(2, "c")
+		with self.assertRaises(ValueError):
+			with reader.read_transaction():
+				pass
+		reader.commit()
+		reader.close()
+		writer.close()
+
+class ServiceTest(unittest.TestCase):
+	"""
+	These tests concern the multi-process lookup service
+	"""
+	def test_getMany(self):
+		'''
+		Verify that lookups spread over workers come back in order
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		bulk_load("/tmp/test2.dbdb", [(k, str(k)) for k in range(1000)])
+		keys = [random.randrange(1100) for _ in range(500)]
+		with LookupService("/tmp/test2.dbdb", processes=2, batch_size=64) as service:
+			self.assertEqual(service.get_many(keys),
+				[str(k) if k < 1000 else None for k in keys])
+			self.assertEqual(service.get_many([5000], default="missing"), ["missing"])
+			self.assertEqual(service.get(7), "7")
+			self.assertEqual(service.get_many([]), [])
+
+	def test_bytesValues(self):
+		'''
+		Verify that values read from a memory map are sent back as bytes
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", value_codec='bytes')
+		db.set(1, b"x" * 100)
+		db.commit()
+		db.close()
+		with LookupService("/tmp/test2.dbdb", processes=1) as service:
+			self.assertEqual(service.get(1), b"x" * 100)
+
+	def test_benchmark(self):
+		'''
+		Verify that the benchmark reports a rate for each number of processes
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		bulk_load("/tmp/test2.dbdb", [(k, str(k)) for k in range(100)])
+		results = benchmark("/tmp/test2.dbdb", lookups=200, processes=2, batch_size=50)
+		self.assertEqual([count for count, rate in results], [1, 2])
+		self.assertTrue(all(rate > 0 for count, rate in results))
+
+class GetManyTest(unittest.TestCase):
+	"""
+	These tests concern batched lookups
+	"""
+	def setUp(self):
+		os.system("rm /tmp/test2.dbdb")
+		bulk_load("/tmp/test2.dbdb", [(k, str(k)) for k in range(0, 200, 2)])
+		self.db = connect("/tmp/test2.dbdb", cache_size=0)
+
+	def tearDown(self):
+		self.db.close()
+
+	def test_order(self):
+		'''
+		Verify that values come back in the order of the keys, with defaults for missing keys
+		'''
+		keys = [random.randrange(-5, 205) for _ in range(300)]
+		expected = [str(k) if k % 2 == 0 and 0 <= k < 200 else None for k in keys]
+		self.assertEqual(self.db.get_many(keys), expected)
+		self.assertEqual(self.db.get_many([3, 4, 4], default="none"), ["none", "4", "4"])
+		self.assertEqual(self.db.get_many([]), [])
+
+	def test_numpyKeys(self):
+		'''
+		Verify that a NumPy array of keys is looked up like a list
+		'''
+		keys = np.array([10, 199, 0, 10, 57])
+		self.assertEqual(self.db.get_many(keys), ["10", None, "0", "10", None])
+
+	def test_strict(self):
+		'''
+		Verify that strict lookups throw a KeyError for the first missing key
+		'''
+		with self.assertRaises(KeyError) as error:
+			self.db.get_many([4, 9, 300, 1], strict=True)
+		self.assertEqual(error.exception.args, (9,))
+		self.assertEqual(self.db.get_many([4, 6], strict=True), ["4", "6"])
+
+	def test_nodesReadOnce(self):
+		'''
+		Verify that a batch reads each node at most once
+		'''
+		reads = []
+		read = self.db._storage.read
+		self.db._storage.read = lambda address: reads.append(address) or read(address)
+		self.db.get_many(list(range(200)) * 2)
+		self.assertEqual(len(reads), len(set(reads)))
+		self.assertEqual(len(reads), 100)
+
+	def test_uncommitted(self):
+		'''
+		Verify that a writer's batch sees its own uncommitted changes
+		'''
+		self.db.set(1, "one")
+		self.db.delete(2)
+		self.assertEqual(self.db.get_many([1, 2]), ["one", None])
+
+class BTreeTest(unittest.TestCase):
+	"""
+	These tests concern the B+tree engine
+	"""
+	def test_randomOperations(self):
+		'''
+		Verify that random sets, deletes and commits on small pages match a dictionary
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		storage = Storage(open("/tmp/test2.dbdb", "w+b"), node_format=Storage.FORMAT_BTREE)
+		tree = BTree(storage, cache_size=16, order=4)
+		expected = {}
+		for step in range(2000):
+			key = random.randrange(300)
+			if random.random() < 0.6:
+				tree.set(key, str(step))
+				expected[key] = str(step)
+			elif key in expected:
+				tree.delete(key)
+				del expected[key]
+			else:
+				with self.assertRaises(KeyError):
+					tree.delete(key)
+			if step % 100 == 0:
+				tree.commit()
+		tree.commit()
+		self.assertEqual(tree.validate()[0], len(expected))
+		self.assertEqual(list(tree.items()), sorted(expected.items()))
+		storage.close()
+
+	def test_connect(self):
+		'''
+		Verify that the engine is recorded in the file and used when it is reopened
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", engine='btree')
+		for k in range(500):
+			db.set(k, str(k))
+		db.delete(7)
+		db.commit()
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		self.assertIsInstance(db._tree, BTree)
+		self.assertEqual(len(db), 499)
+		self.assertEqual(db.get(499), "499")
+		with self.assertRaises(KeyError):
+			db.get(7)
+		self.assertEqual(list(db.range(5, 10)), [(5, "5"), (6, "6"), (8, "8"), (9, "9")])
+		self.assertEqual([k for k, v in db.range(hi=3, reverse=True)], [2, 1, 0])
+		self.assertEqual(db.rank(10), 9)
+		self.assertEqual(db.select(-1), 499)
+		self.assertEqual(db.count(0, 10), 9)
+		self.assertEqual(db.get_many([3, 7, 9]), ["3", None, "9"])
+		self.assertEqual(db._tree.validate()[1], 2)
+		db.close()
+		with self.assertRaises(ValueError):
+			connect("/tmp/test2.dbdb", engine='redblack')
+		with self.assertRaises(ValueError):
+			connect("/tmp/test2.dbdb", engine='avl')
+
+	def test_pagesAligned(self):
+		'''
+		Verify that pages are written without straddling a 4 KiB page of the file
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		bulk_load("/tmp/test2.dbdb", [(k, "value %d" % k) for k in range(5000)], engine='btree')
+		db = connect("/tmp/test2.dbdb")
+		pages = [db._tree._tree_ref]
+		while pages:
+			ref = pages.pop()
+			data = db._storage.read(ref.address)
+			self.assertEqual(ref.address // 4096, (ref.address + 8 + len(data) - 1) // 4096)
+			page = db._tree._follow(ref)
+			if not page.leaf:
+				pages.extend(page.children)
+		self.assertEqual(db._tree.validate(), (5000, 3))
+		db.close()
+
+	def test_compactionAndSnapshots(self):
+		'''
+		Verify that compaction keeps the engine, and snapshots read old B+tree roots
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", engine='btree', compression='zlib')
+		db.set_many([(k, "v%d" % k) for k in range(300)])
+		db.commit()
+		for k in range(0, 300, 2):
+			db.delete(k)
+		db.commit()
+		with db.snapshot(commit_id=1) as snapshot:
+			self.assertEqual(len(snapshot), 300)
+			self.assertEqual(snapshot.get(4), "v4")
+		stats = db.compact()
+		self.assertGreater(stats.bytes_reclaimed, 0)
+		self.assertIsInstance(db._tree, BTree)
+		self.assertEqual(list(db.items()), [(k, "v%d" % k) for k in range(1, 300, 2)])
+		db._tree.validate()
+		with self.assertRaises(ValueError):
+			db.compact(layout='blocked')
+		with db.read_transaction():
+			self.assertEqual(db.get(1), "v1")
+		db.close()
+
+class WriteBufferTest(unittest.TestCase):
+	"""
+	These tests concern the write buffer
+	"""
+	def test_buffer(self):
+		'''
+		Verify that the buffer keeps one sorted entry per key
+		'''
+		buffer = WriteBuffer()
+		for key in [5, 1, 3, 1]:
+			buffer.put(key, str(key))
+		buffer.put(3, WriteBuffer.DELETED)
+		self.assertEqual(len(buffer), 3)
+		self.assertEqual(buffer.lookup(1), "1")
+		self.assertIs(buffer.lookup(3), WriteBuffer.DELETED)
+		self.assertIs(buffer.lookup(2), WriteBuffer.MISSING)
+		buffer.discard(5)
+		buffer.discard(6)
+		self.assertEqual(len(buffer), 2)
+		buffer = WriteBuffer()
+		buffer.put([1], "unhashable")
+		buffer.put([0], "keys")
+		self.assertEqual(buffer.lookup([1]), "unhashable")
+		buffer = WriteBuffer()
+		buffer.put(2, "b")
+		buffer.put(1, "a")
+		buffer.put(3, WriteBuffer.DELETED)
+		self.assertEqual(buffer.drain(), ([(1, "a"), (2, "b")], [3]))
+		self.assertEqual(len(buffer), 0)
+
+	def test_buffered(self):
+		'''
+		Verify that buffered writes are read back, and reach the tree at commit
+		'''
+		for engine in ['redblack', 'btree']:
+			os.system("rm /tmp/test2.dbdb")
+			db = connect("/tmp/test2.dbdb", engine=engine, write_buffer=True)
+			db.set(1, "a")
+			db.set(2, "b")
+			db.commit()
+			for k in range(100):
+				db.set(3, str(k))
+			db.delete(1)
+			db.set(4, "d")
+			db.delete(4)
+			with self.assertRaises(KeyError):
+				db.delete(1)
+			with self.assertRaises(KeyError):
+				db.delete(4)
+			with self.assertRaises(KeyError):
+				db.get(1)
+			self.assertEqual(db.get(3), "99")
+			self.assertEqual(db.get(2), "b")
+			self.assertEqual(db._tree.get(2), "b")
+			with self.assertRaises(KeyError):
+				db._tree.get(3)
+			self.assertTrue(db._storage.locked)
+			other = connect("/tmp/test2.dbdb")
+			self.assertEqual(list(other.items()), [(1, "a"), (2, "b")])
+			other.close()
+			db.commit()
+			self.assertEqual(list(db.items()), [(2, "b"), (3, "99")])
+			db.close()
+			db = connect("/tmp/test2.dbdb")
+			self.assertEqual(list(db.items()), [(2, "b"), (3, "99")])
+			db.close()
+
+	def test_readsMergeBuffer(self):
+		'''
+		Verify that ordered and batched reads see buffered writes
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", write_buffer=True)
+		db.set_many([(k, str(k)) for k in range(10)])
+		db.delete(4)
+		self.assertEqual(len(db), 9)
+		self.assertEqual(db.rank(5), 4)
+		db.set(4, "four")
+		self.assertEqual(db.get_many([4, 5]), ["four", "5"])
+		db.delete(0)
+		self.assertEqual(db.select(0), 1)
+		self.assertEqual(db.count(2, 6), 4)
+		self.assertEqual(list(db.range(3, 6)), [(3, "3"), (4, "four"), (5, "5")])
+		db.commit()
+		self.assertEqual(len(db), 9)
+		db.set(20, "x")
+		db.close()
+		db = connect("/tmp/test2.dbdb")
+		with self.assertRaises(KeyError):
+			db.get(20)
+		db.close()
+
+class LSMTest(unittest.TestCase):
+	"""
+	These tests concern the log-structured mode and its Bloom filters
+	"""
+	def test_bloom(self):
+		'''
+		Verify that a Bloom filter has no false negatives and few false positives
+		'''
+		bloom = BloomFilter.for_capacity(1000, 0.01)
+		for k in range(1000):
+			bloom.add(k)
+		self.assertTrue(all(k in bloom for k in range(1000)))
+		self.assertIn(5.0, bloom)
+		self.assertIn(True, bloom)
+		false_positives = sum(k in bloom for k in range(1000, 11000))
+		self.assertLess(false_positives, 300)
+		copy = BloomFilter.from_bytes(bloom.to_bytes())
+		self.assertTrue(all(k in copy for k in range(1000)))
+		self.assertEqual(sum(k in copy for k in range(1000, 11000)), false_positives)
+
+	def test_runs(self):
+		'''
+		Verify that writes are read back across the memory table and runs, newest first
+		'''
+		os.system("rm -rf /tmp/test2.lsm")
+		db = lsm.connect("/tmp/test2.lsm", memtable_size=100, background=False)
+		for k in range(250):
+			db.set(k, str(k))
+		self.assertEqual(len(db.runs()), 2)
+		db.set(3, "three")
+		db.delete(4)
+		db.commit()
+		db.set(5, "five")
+		db.delete(6)
+		with self.assertRaises(KeyError):
+			db.delete(1000)
+		self.assertEqual(db.get(3), "three")
+		self.assertEqual(db.get(5), "five")
+		self.assertEqual(db.get(200), "200")
+		for key in [4, 6, 1000]:
+			with self.assertRaises(KeyError):
+				db.get(key)
+		self.assertNotIn(4, db)
+		self.assertIn(7, db)
+		self.assertEqual(list(db.range(2, 8)), [(2, "2"), (3, "three"), (5, "five"), (7, "7")])
+		self.assertEqual(list(db.range(2, 8, reverse=True)), [(7, "7"), (5, "five"), (3, "three"), (2, "2")])
+		self.assertEqual(len(db), 248)
+		db.close()
+		db = lsm.connect("/tmp/test2.lsm", background=False)
+		#the uncommitted writes are lost
+		self.assertEqual(db.get(5), "5")
+		self.assertEqual(db.get(3), "three")
+		with self.assertRaises(KeyError):
+			db.get(4)
+		db.close()
+		with self.assertRaises(ValueError):
+			lsm.connect("/tmp/test2.lsm", value_codec='int')
+
+	def test_merge(self):
+		'''
+		Verify that merging keeps the newest values and drops tombstones with the oldest run
+		'''
+		os.system("rm -rf /tmp/test2.lsm")
+		db = lsm.connect("/tmp/test2.lsm", value_codec='int', background=False)
+		expected = {}
+		random.seed(7)
+		for _ in range(20):
+			for _ in range(50):
+				key = random.randrange(300)
+				if key in expected and random.random() < 0.3:
+					db.delete(key)
+					del expected[key]
+				else:
+					db.set(key, key * 2)
+					expected[key] = key * 2
+			db.commit()
+			self.assertLessEqual(len(db.runs()), 20)
+		before = len(db.runs())
+		db.wait_for_merges()
+		self.assertLess(len(db.runs()), before)
+		self.assertEqual(list(db.items()), sorted(expected.items()))
+		for key in range(300):
+			self.assertEqual(key in db, key in expected)
+		files = [name for name in os.listdir("/tmp/test2.lsm") if name.startswith("run-")]
+		self.assertEqual(len(files), 2 * len(db.runs()))
+		db.max_runs = 1
+		db.wait_for_merges()
+		self.assertEqual(db.runs(), [len(expected)])
+		db.close()
+		db = lsm.connect("/tmp/test2.lsm", background=False)
+		self.assertEqual(dict(db.items()), expected)
+		db.close()
+
+	def test_background(self):
+		'''
+		Verify that the background thread merges runs while the database is used
+		'''
+		os.system("rm -rf /tmp/test2.lsm")
+		db = lsm.connect("/tmp/test2.lsm", memtable_size=50, max_runs=2)
+		for k in range(2000):
+			db.set(k, str(k))
+		db.commit()
+		self.assertEqual(len(db), 2000)
+		self.assertEqual(db.get(1234), "1234")
+		db.close()
+		db = lsm.connect("/tmp/test2.lsm", background=False)
+		self.assertLessEqual(len(db.runs()), 3)
+		self.assertEqual(list(db.items()), [(k, str(k)) for k in range(2000)])
+		db.close()
+
+class KeyFilterTest(unittest.TestCase):
+	"""
+	These tests concern the key filter kept in a database file
+	"""
+	def test_missesSkipTree(self):
+		'''
+		Verify that lookups of absent keys read no node once the file has a filter
+		'''
+		for engine in ['redblack', 'btree']:
+			os.system("rm /tmp/test2.dbdb")
+			db = connect("/tmp/test2.dbdb", engine=engine, bloom_filter=True)
+			db.set_many((k, str(k)) for k in range(0, 2000, 2))
+			db.commit()
+			db.close()
+			db = connect("/tmp/test2.dbdb", cache_size=0)
+			reads = []
+			read = db._storage.read
+			db._storage.read = lambda address: reads.append(address) or read(address)
+			misses = 0
+			for k in range(1, 2000, 2):
+				with self.assertRaises(KeyError):
+					db.get(k)
+				self.assertNotIn(k, db)
+			#one percent of misses get past the filter
+			self.assertLess(len(reads), 100)
+			self.assertEqual(db.get(1000), "1000")
+			self.assertIn(np.int64(1000), db)
+			self.assertIn(1000.0, db)
+			self.assertEqual(db.get_many([1, 2, 3, 4], "?"), ["?", "2", "?", "4"])
+			with self.assertRaises(KeyError):
+				db.get_many([2, 3], strict=True)
+			db.close()
+
+	def test_keptByWriters(self):
+		'''
+		Verify that every writer keeps the filter up to date, including uncommitted keys
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", bloom_filter=True)
+		db.set(1, "a")
+		db.commit()
+		address = db._storage._read_bloom_root()[0]
+		other = connect("/tmp/test2.dbdb")
+		self.assertIsNotNone(other._storage.key_filter())
+		other.set(2, "b")
+		self.assertEqual(other.get(2), "b")
+		other.commit()
+		#new bits are written in place
+		self.assertEqual(db._storage._read_bloom_root(), (address, other._storage.get_root_address()))
+		self.assertEqual(db.get(2), "b")
+		db.delete(1)
+		db.set(3, "c")
+		db.commit()
+		self.assertEqual(other.get(3), "c")
+		self.assertNotIn(1, other)
+		reader = connect("/tmp/test2.dbdb", readonly=True)
+		self.assertEqual(reader.get_many([1, 2, 3]), [None, "b", "c"])
+		reader.close()
+		other.close()
+		db.close()
+
+	def test_untrustedFilter(self):
+		'''
+		Verify that a filter not covering the committed root is ignored, then rebuilt
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", bloom_filter=True)
+		db.set(1, "a")
+		db.commit()
+		address = db._storage._read_bloom_root()[0]
+		db.close()
+		#a crash after the filter was written for a root never committed
+		with open("/tmp/test2.dbdb", "r+b") as f:
+			f.seek(address)
+			f.write(struct.pack("!Q", 12345))
+		db = connect("/tmp/test2.dbdb")
+		self.assertIsNone(db._storage.key_filter())
+		self.assertEqual(db.get(1), "a")
+		db.set(2, "b")
+		self.assertTrue(db._storage.bloom_stale)
+		db.commit()
+		self.assertIsNotNone(db._storage.key_filter())
+		self.assertEqual(db.get_many([1, 2]), ["a", "b"])
+		db.close()
+
+	def test_growthAndCompaction(self):
+		'''
+		Verify that a full filter is rebuilt larger, and that compaction keeps a filter
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		db = connect("/tmp/test2.dbdb", bloom_filter=True)
+		db.set(0, "0")
+		db.commit()
+		capacity = db._storage.bloom.capacity
+		db.set_many((k, str(k)) for k in range(capacity + 1))
+		db.commit()
+		self.assertGreater(db._storage.bloom.capacity, 2 * capacity)
+		self.assertTrue(all(k in db for k in range(capacity + 1)))
+		for k in range(0, capacity + 1, 2):
+			db.delete(k)
+		db.commit()
+		db.compact()
+		bloom = db._storage.key_filter()
+		self.assertEqual(bloom.count, (capacity + 1) // 2)
+		self.assertEqual([k for k in range(capacity + 1) if k in db], list(range(1, capacity + 1, 2)))
+		db.close()
+
+class AsyncTest(unittest.TestCase):
+	"""
+	These tests concern the asyncio front-end
+	"""
+	def test_readsAndWrites(self):
+		'''
+		Verify that writes are read back before, during and after their commit
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		async def run():
+			db = await async_db.connect("/tmp/test2.dbdb", readers=2)
+			await db.set_many((k, str(k)) for k in range(100))
+			self.assertEqual(await db.get(5), "5")
+			commit = asyncio.ensure_future(db.commit())
+			await asyncio.sleep(0)
+			#queued, not yet written, and still readable
+			self.assertEqual(await db.get(6), "6")
+			await commit
+			await db.delete(5)
+			await db.set(200, "x")
+			with self.assertRaises(KeyError):
+				await db.get(5)
+			with self.assertRaises(KeyError):
+				await db.delete(300)
+			self.assertEqual(await db.get_many([4, 5, 200, 300], "?"), ["4", "?", "x", "?"])
+			self.assertTrue(await db.contains(7))
+			await db.set(7, "seven")
+			await db.close()
+			with self.assertRaises(ValueError):
+				await db.get(1)
+			db = await async_db.connect("/tmp/test2.dbdb")
+			self.assertEqual(await db.get(7), "7")
+			self.assertFalse(await db.contains(200))
+			self.assertTrue(await db.contains(5))
+			await db.close()
+		asyncio.run(run())
+
+	def test_coalescing(self):
+		'''
+		Verify that concurrent gets share one lookup, and queued commits one write
+		'''
+		os.system("rm /tmp/test2.dbdb")
+		async def run():
+			db = await async_db.connect("/tmp/test2.dbdb", value_codec='int')
+			await db.set_many((k, k) for k in range(1000))
+			await db.commit()
+			batches = []
+			read_many = db._read_many
+			db._read_many = lambda keys: batches.append(keys) or read_many(keys)
+			keys = [k % 50 for k in range(500)]
+			values = await asyncio.gather(*[db.get(k) for k in keys])
+			self.assertEqual(values, keys)
+			self.assertEqual(len(batches), 1)
+			self.assertEqual(sorted(batches[0]), list(range(50)))
+			self.assertEqual(await db.get_many([3000, 3001], -1), [-1, -1])
+			commits = []
+			write = db._write
+			db._write = lambda buffer: commits.append(len(buffer)) or write(buffer)
+			async def writer(k):
+				await db.set(k, -k)
+				await db.commit()
+			await asyncio.gather(*[writer(k) for k in range(10)])
+			self.assertLess(len(commits), 10)
+			self.assertEqual(sum(commits), 10)
+			self.assertEqual(await db.get_many(range(12)), [-k for k in range(10)] + [10, 11])
+			await db.close()
+			other = connect("/tmp/test2.dbdb")
+			self.assertEqual(other.get(9), -9)
+			other.close()
+			os.system("rm /tmp/test2.dbdb")
+			db = await async_db.connect("/tmp/test2.dbdb")
+			await db.set([1, 2], "list")
+			await db.commit()
+			#unhashable keys are read, if not shared
+			self.assertEqual(await db.get_many([[1, 2], [1, 2], [3]]), ["list", "list", None])
+			await db.close()
+		asyncio.run(run())
+
 def suite():
 	suite = unittest.TestSuite()
 	suite.addTest(unittest.makeSuite(ImmutableTreeTest))
 	suite.addTest(unittest.makeSuite(RedBlackTreeTest))
+	suite.addTest(unittest.makeSuite(NodeCacheTest))
+	suite.addTest(unittest.makeSuite(MmapStorageTest))
+	suite.addTest(unittest.makeSuite(CompactionTest))
+	suite.addTest(unittest.makeSuite(LayoutTest))
+	suite.addTest(unittest.makeSuite(DurabilityTest))
+	suite.addTest(unittest.makeSuite(ValueCodecTest))
+	suite.addTest(unittest.makeSuite(CompressionTest))
+	suite.addTest(unittest.makeSuite(InlineValueTest))
+	suite.addTest(unittest.makeSuite(SnapshotTest))
+	suite.addTest(unittest.makeSuite(ReaderTest))
+	suite.addTest(unittest.makeSuite(ServiceTest))
+	suite.addTest(unittest.makeSuite(GetManyTest))
+	suite.addTest(unittest.makeSuite(BTreeTest))
+	suite.addTest(unittest.makeSuite(WriteBufferTest))
+	suite.addTest(unittest.makeSuite(LSMTest))
+	suite.addTest(unittest.makeSuite(KeyFilterTest))
+	suite.addTest(unittest.makeSuite(AsyncTest))
 	return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,250 @@
+"""
+Value codecs: how the values of a database are turned into bytes and back.
+
+A database uses one codec for all of its values. The codec is chosen when the
+file is created and recorded in the superblock header, so a file is always
+read back with the codec it was written with:
+
+    db = connect("/tmp/test.dbdb", value_codec='numpy')
+"""
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class StrCodec(object):
+    "utf-8 strings, the format of files written before codecs existed"
+    id = 0
+    name = 'str'
+
+    @staticmethod
+    def encode(value):
+        return value.encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        return str(data, 'utf-8')
+
+
+class BytesCodec(object):
+    """
+    Raw bytes, stored and returned as they are.
+
+    Reads from a memory-mapped storage return a memoryview slice of the map,
+    so a value is never copied unless the caller copies it.
+    """
+    id = 1
+    name = 'bytes'
+
+    @staticmethod
+    def encode(value):
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            raise TypeError('The bytes codec stores bytes-like values only.')
+        return value
+
+    @staticmethod
+    def decode(data):
+        return data
+
+
+class IntCodec(object):
+    "64-bit signed integers"
+    id = 2
+    name = 'int'
+    FORMAT = struct.Struct("!q")
+
+    @classmethod
+    def encode(cls, value):
+        return cls.FORMAT.pack(value)
+
+    @classmethod
+    def decode(cls, data):
+        return cls.FORMAT.unpack(data)[0]
+
+
+class FloatCodec(object):
+    "double precision floats"
+    id = 3
+    name = 'float'
+    FORMAT = struct.Struct("!d")
+
+    @classmethod
+    def encode(cls, value):
+        return cls.FORMAT.pack(value)
+
+    @classmethod
+    def decode(cls, data):
+        return cls.FORMAT.unpack(data)[0]
+
+
+class StructuredCodec(object):
+    """
+    Nested None, bool, int, float, str, bytes, list and dict values.
+
+    Each value is a one-byte tag followed by a fixed-width number or a 4-byte
+    length and the payload, in the spirit of msgpack. Like msgpack, tuples are
+    read back as lists.
+    """
+    id = 4
+    name = 'structured'
+    NONE, TRUE, FALSE, INT, BIGINT, FLOAT, STR, BYTES, LIST, DICT = range(10)
+    TAG = struct.Struct("!B")
+    LENGTH = struct.Struct("!I")
+    INT_FORMAT = struct.Struct("!q")
+    FLOAT_FORMAT = struct.Struct("!d")
+
+    @classmethod
+    def encode(cls, value):
+        chunks = []
+        cls._encode(value, chunks)
+        return b''.join(chunks)
+
+    @classmethod
+    def _encode(cls, value, chunks):
+        "append the tagged encoding of value to chunks"
+        if value is None:
+            chunks.append(cls.TAG.pack(cls.NONE))
+        elif value is True:
+            chunks.append(cls.TAG.pack(cls.TRUE))
+        elif value is False:
+            chunks.append(cls.TAG.pack(cls.FALSE))
+        elif isinstance(value, int):
+            if -2**63 <= value < 2**63:
+                chunks.append(cls.TAG.pack(cls.INT) + cls.INT_FORMAT.pack(value))
+            else:
+                data = value.to_bytes((value.bit_length() + 8) // 8, 'big',
+                                      signed=True)
+                chunks.append(cls.TAG.pack(cls.BIGINT) +
+                              cls.LENGTH.pack(len(data)) + data)
+        elif isinstance(value, float):
+            chunks.append(cls.TAG.pack(cls.FLOAT) + cls.FLOAT_FORMAT.pack(value))
+        elif isinstance(value, str):
+            data = value.encode('utf-8')
+            chunks.append(cls.TAG.pack(cls.STR) + cls.LENGTH.pack(len(data)))
+            chunks.append(data)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            data = bytes(value)
+            chunks.append(cls.TAG.pack(cls.BYTES) + cls.LENGTH.pack(len(data)))
+            chunks.append(data)
+        elif isinstance(value, (list, tuple)):
+            chunks.append(cls.TAG.pack(cls.LIST) + cls.LENGTH.pack(len(value)))
+            for item in value:
+                cls._encode(item, chunks)
+        elif isinstance(value, dict):
+            chunks.append(cls.TAG.pack(cls.DICT) + cls.LENGTH.pack(len(value)))
+            for key, item in value.items():
+                cls._encode(key, chunks)
+                cls._encode(item, chunks)
+        else:
+            raise TypeError('Cannot encode %s values.' % type(value).__name__)
+
+    @classmethod
+    def decode(cls, data):
+        value, _ = cls._decode(data, 0)
+        return value
+
+    @classmethod
+    def _decode(cls, data, offset):
+        "return the value encoded at offset and the offset following it"
+        tag = data[offset]
+        offset += 1
+        if tag == cls.NONE:
+            return None, offset
+        if tag == cls.TRUE:
+            return True, offset
+        if tag == cls.FALSE:
+            return False, offset
+        if tag == cls.INT:
+            return cls.INT_FORMAT.unpack_from(data, offset)[0], offset + 8
+        if tag == cls.FLOAT:
+            return cls.FLOAT_FORMAT.unpack_from(data, offset)[0], offset + 8
+        length = cls.LENGTH.unpack_from(data, offset)[0]
+        offset += cls.LENGTH.size
+        if tag == cls.BIGINT:
+            return (int.from_bytes(data[offset:offset + length], 'big',
+                                   signed=True), offset + length)
+        if tag == cls.STR:
+            return str(data[offset:offset + length], 'utf-8'), offset + length
+        if tag == cls.BYTES:
+            return bytes(data[offset:offset + length]), offset + length
+        if tag == cls.LIST:
+            items = []
+            for _ in range(length):
+                item, offset = cls._decode(data, offset)
+                items.append(item)
+            return items, offset
+        if tag == cls.DICT:
+            items = {}
+            for _ in range(length):
+                key, offset = cls._decode(data, offset)
+                items[key], offset = cls._decode(data, offset)
+            return items, offset
+        raise ValueError('Unknown structured value tag %d.' % tag)
+
+
+class NumpyCodec(object):
+    """
+    NumPy arrays, stored as their dtype, shape and raw C-ordered buffer.
+
+    Arrays are read back as read-only views of the stored bytes, without
+    parsing or copying the data.
+    """
+    id = 5
+    name = 'numpy'
+    #dtype string length, number of dimensions
+    HEADER = struct.Struct("!BB")
+    DIMENSION = struct.Struct("!Q")
+
+    @classmethod
+    def encode(cls, value):
+        if np is None:
+            raise ImportError('The numpy codec needs NumPy installed.')
+        array = np.ascontiguousarray(value)
+        if array.dtype.hasobject:
+            raise TypeError('Arrays of Python objects cannot be stored.')
+        dtype = array.dtype.str.encode('ascii')
+        return b''.join([
+            cls.HEADER.pack(len(dtype), array.ndim),
+            dtype,
+            b''.join(cls.DIMENSION.pack(n) for n in array.shape),
+            array.tobytes()])
+
+    @classmethod
+    def decode(cls, data):
+        if np is None:
+            raise ImportError('The numpy codec needs NumPy installed.')
+        dtype_length, ndim = cls.HEADER.unpack_from(data)
+        offset = cls.HEADER.size
+        dtype = np.dtype(str(data[offset:offset + dtype_length], 'ascii'))
+        offset += dtype_length
+        shape = tuple(cls.DIMENSION.unpack_from(data, offset + i * 8)[0]
+                      for i in range(ndim))
+        offset += ndim * cls.DIMENSION.size
+        return np.frombuffer(data, dtype, offset=offset).reshape(shape)
+
+
+CODECS = [StrCodec, BytesCodec, IntCodec, FloatCodec, StructuredCodec,
+          NumpyCodec]
+_BY_ID = {codec.id: codec for codec in CODECS}
+_BY_NAME = {codec.name: codec for codec in CODECS}
+
+
+def get_codec(codec):
+    """
+    Function that returns the codec with the given name or id.
+
+    Parameter
+    ---------
+
+    codec: a codec name such as 'numpy', its id, or a codec class
+
+    """
+    if codec in CODECS:
+        return codec
+    found = _BY_ID.get(codec) if isinstance(codec, int) else _BY_NAME.get(codec)
+    if found is None:
+        raise ValueError('Unknown value codec %r.' % (codec,))
+    return found